@@ -5,19 +5,36 @@ Created on 12 Mar 2011
 '''
 import ptp
 from ptp.PtpUsbTransport import PtpUsbTransport
-from ptp.PtpAbstractTransport import PtpRequest
-from ptp.PtpSession import PtpSession, PtpException
+from ptp.PtpAbstractTransport import PtpRequest, PtpResponse, PtpDataReader, PtpTimeoutException
+from ptp.PtpSession import PtpSession, AsyncPtpSession, PtpException, Resyncing
+from ptp.PtpEventPump import PtpEventPump
+from ptp.PtpThreadedTransport import PtpThreadedTransport, PtpFuture
+from ptp.PtpDownload import PtpChunkedDownload, SupportsPartialObject
+from ptp.PtpObjectCatalog import PtpObjectCatalog
+from ptp.PtpPropertyCache import PtpPropertyCache
 from ptp import PtpValues
+from ptp import NikonSupport
 import time
+import os
 import logging
+import itertools
+import struct
+import sys
+import appconfig
 
 class CHDKPtpValues(object):
     """Values related to the CHDK PTP interface, taken from the core/ptp.h file"""
     CHDKOpcode = 0x9999
     
     class Commands(object):
+        UploadFile = 5
         ExecuteScript = 7
         ScriptStatus = 8
+        ReadScriptMsg = 10
+        WriteScriptMsg = 11
+        GetDisplayData = 12
+        RemoteCaptureIsReady = 13
+        RemoteCaptureGetData = 14
     
     class ScriptingLanguage(object):
         LUA = 0
@@ -33,46 +50,103 @@ class CHDKPtpValues(object):
         RUN = 0x1
         MSG = 0x2
     
-def executeScript(ptpSession, script, language=CHDKPtpValues.ScriptingLanguage.LUA, wait=False):
+    class MessageTypes(object): # of messages from a script, returned by ReadScriptMsg
+        NONE = 0 # no message waiting
+        ERR = 1 # the script failed, the message is the error
+        RET = 2 # the script ended, the message is what it returned
+        USER = 3 # sent by the script with write_usb_msg()
+    
+    class CaptureFormats(object): # flags, for init_usb_capture() and the remote capture commands
+        JPEG = 0x1
+        RAW = 0x2 # the sensor data of a DNG, follows its DNG_HEADER
+        DNG_HEADER = 0x4
+        DNG = 0x6
+        ERROR = 0x10000000 # from RemoteCaptureIsReady, remote capture is not active
+        LAST_CHUNK = 0 # from RemoteCaptureGetData, no chunks of this format follow
+        SEQUENTIAL = 0xffffffff # from RemoteCaptureGetData, the chunk follows on from the one before
+    
+    class LiveViewFlags(object): # what GetDisplayData sends
+        VIEWPORT = 0x1 # the live image
+        BITMAP = 0x2 # the camera's on screen display
+        PALETTE = 0x4 # the palette of the bitmap
+    
+    class FramebufferTypes(object): # of the viewport sent by GetDisplayData
+        YUV8 = 0 # 4 pixels in 6 bytes, U Y V Y Y Y
+        PAL8 = 1 # a byte per pixel, indexes into the palette
+        YUV8B = 2 # 2 pixels in 4 bytes, U Y V Y
+    
+    class WriteMessageStatus(object): # returned by WriteScriptMsg
+        OK = 0
+        NOTRUN = 1 # no script running
+        QFULL = 2 # the script's queue is full
+        BADID = 3 # the script is not the one running
+
+RESPONSE_TIMEOUT = 10 # seconds a CHDK command has to respond before the camera is taken to be stuck
+SCRIPT_TIMEOUT = 60 # seconds a script which is waited for has to finish
+# how everything waited for on the camera (scripts, replies, exposures, remote capture images) is polled, see pollWithBackoff()
+POLL_SPINS = 2 # checks made again straight away before waiting
+POLL_INTERVAL = 0.002 # seconds waited after the spins, doubled after each check
+MAX_POLL_INTERVAL = 0.05 # longest wait between checks
+
+def pollWithBackoff(check, timeout, description, spins=POLL_SPINS, pollInterval=POLL_INTERVAL, maxPollInterval=MAX_POLL_INTERVAL):
+    """Calls check until it returns something other than None. Quick results are caught by checking again straight away
+    a few times, after that the wait between checks doubles up to maxPollInterval, so slow ones (e.g. shooting) cost few
+    requests
+        params:
+            check - function taking no arguments, returning None while whatever it checks is not done yet
+            timeout - seconds to keep checking, a PtpTimeoutException is raised after that
+            description - what is being waited for, for the PtpTimeoutException's message
+            spins - number of times to check again without waiting in between
+            pollInterval - seconds to wait before the first check after the spins
+            maxPollInterval - longest wait between checks
+        returns what check returned"""
+    deadline = time.time() + timeout
+    wait = pollInterval
+    checks = 0
+    while True:
+        result = check()
+        if result != None:
+            return result
+        if time.time() > deadline:
+            raise PtpTimeoutException(description + " after " + str(timeout) + " s")
+        checks += 1
+        if checks > spins:
+            time.sleep(min(wait, max(deadline - time.time(), 0)))
+            wait = min(wait * 2, maxPollInterval)
+    
+@Resyncing(retry=False)
+def executeScript(ptpSession, script, language=CHDKPtpValues.ScriptingLanguage.LUA, wait=False, timeout=RESPONSE_TIMEOUT):
     """Attempts to execute the given script on the camera
         params:
             ptpSession - ptp session created using pyptp
             script - string containing the script to be executed on the camera
             language - the scripting language of the script, can be either LUA or UBASIC, values for this param are found in
                         CHDKPtpValues.ScriptingLanguage
-            wait - if wait is true the function will not return until the script has stopped running"""
+            wait - if wait is true the function will not return until the script has stopped running
+            timeout - seconds to wait for the camera to respond, a PtpTimeoutException is raised after that"""
     scriptraw = unicode(script)
     scriptraw += u'\u0000'
     script_ptp_request = PtpRequest(CHDKPtpValues.CHDKOpcode, ptpSession.sessionid, ptpSession.NewTransaction(), params=(CHDKPtpValues.Commands.ExecuteScript,language))
     ptpSession.transport.send_ptp_request(script_ptp_request)
     ptpSession.transport.send_ptp_data(script_ptp_request, scriptraw)
-    retryFlag = True
-    # retry until we get the response, otherwise get_ptp_response times out due to long script 
-    # and causes incorrect response to be sent next time & the program gets confused
-    while retryFlag:
-        try:
-            script_ptp_response = ptpSession.transport.get_ptp_response(script_ptp_request)
-            retryFlag = False
-        except:
-            pass
+    # the response can be a long time coming while the script starts, if it never comes any
+    # late response is recognised by its transaction id and skipped by the next command
+    script_ptp_response = ptpSession.transport.wait_ptp_response(script_ptp_request, timeout)
     if script_ptp_response.respcode != CHDKPtpValues.ResponseCodes.OK:
         raise Exception("CHDK PTP Response Code indicates something is wrong, Response Code: " + str(script_ptp_response.respcode))
     if wait:
         waitForScriptFinish(ptpSession)
+    # the camera numbers scripts, messages to a script are addressed by this
+    if len(script_ptp_response.params) > 0:
+        return script_ptp_response.params[0]
+    return None
         
-def getScriptStatus(ptpSession):
+@Resyncing(retry=True)
+def getScriptStatus(ptpSession, timeout=RESPONSE_TIMEOUT):
     """Returns tuple of two booleans (scriptrunning, msgwaiting)"""
     sstatus_ptp_request = PtpRequest(CHDKPtpValues.CHDKOpcode, ptpSession.sessionid, ptpSession.NewTransaction(), params=(CHDKPtpValues.Commands.ScriptStatus,))
     ptpSession.transport.send_ptp_request(sstatus_ptp_request)
-    retryFlag = True
-    # retry until we get the response, otherwise get_ptp_response times out due to long script 
-    # and causes incorrect response to be sent next time & the program gets confused
-    while retryFlag:
-        try:
-            sstatus_ptp_response = ptpSession.transport.get_ptp_response(sstatus_ptp_request)
-            retryFlag = False
-        except:
-            pass
+    sstatus_ptp_response = ptpSession.transport.wait_ptp_response(sstatus_ptp_request, timeout)
     if sstatus_ptp_response.respcode != CHDKPtpValues.ResponseCodes.OK:
         raise Exception("CHDK PTP Response Code indicates something is wrong, Response Code: " + str(sstatus_ptp_response.respcode))
     
@@ -84,24 +158,494 @@ def getScriptStatus(ptpSession):
         msgwaiting = True
     return (scriptrunning, msgwaiting)
 
-def waitForScriptFinish(ptpSession):
-    # wait until the script finishes
-    scriptrunning = True
-    while scriptrunning == True:
-        #logging.debug("requesting scriptstatus")
+def waitForScriptFinish(ptpSession, timeout=SCRIPT_TIMEOUT, spins=POLL_SPINS, pollInterval=POLL_INTERVAL, maxPollInterval=MAX_POLL_INTERVAL):
+    """Waits until the running script finishes, asking with pollWithBackoff()
+        params:
+            timeout - seconds to wait, a PtpTimeoutException is raised after that
+            spins, pollInterval, maxPollInterval - see pollWithBackoff()
+        returns the seconds spent waiting, which are also added to the transport's metrics"""
+    def finished():
         (scriptrunning, msgwaiting) = getScriptStatus(ptpSession)
-        time.sleep(0.25)
+        if not scriptrunning:
+            return True
+    start = time.time()
+    pollWithBackoff(finished, timeout, "Script still running", spins, pollInterval, maxPollInterval)
+    waited = time.time() - start
+    if ptpSession.transport.metrics != None:
+        ptpSession.transport.metrics.script_wait(waited)
+    return waited
+
+@Resyncing(retry=False)
+def readScriptMessage(ptpSession, timeout=RESPONSE_TIMEOUT):
+    """Reads the next message a script has sent to the host, messages are removed from the camera as they are read
+        returns tuple (msgtype, scriptid, message), msgtype is one of CHDKPtpValues.MessageTypes and is NONE if
+        there was no message waiting, message is the message as a string"""
+    msg_ptp_request = PtpRequest(CHDKPtpValues.CHDKOpcode, ptpSession.sessionid, ptpSession.NewTransaction(), params=(CHDKPtpValues.Commands.ReadScriptMsg,))
+    ptpSession.transport.send_ptp_request(msg_ptp_request)
+    rx = ptpSession.transport.get_ptp_data(msg_ptp_request)
+    if isinstance(rx, PtpResponse):
+        # the response came instead of the data
+        (msg_ptp_response, message) = (rx, "")
+    else:
+        message = rx[1]
+        msg_ptp_response = ptpSession.transport.wait_ptp_response(msg_ptp_request, timeout)
+    if msg_ptp_response.respcode != CHDKPtpValues.ResponseCodes.OK:
+        raise Exception("CHDK PTP Response Code indicates something is wrong, Response Code: " + str(msg_ptp_response.respcode))
+    (msgtype, subtype, scriptid) = msg_ptp_response.params[0:3]
+    return (msgtype, scriptid, message)
+
+@Resyncing(retry=False)
+def writeScriptMessage(ptpSession, scriptId, message, timeout=RESPONSE_TIMEOUT):
+    """Queues a message for the running script, which reads it with read_usb_msg()
+        params:
+            scriptId - id of the script, as returned by executeScript()
+            message - string to send
+        returns one of CHDKPtpValues.WriteMessageStatus"""
+    msg_ptp_request = PtpRequest(CHDKPtpValues.CHDKOpcode, ptpSession.sessionid, ptpSession.NewTransaction(), params=(CHDKPtpValues.Commands.WriteScriptMsg, scriptId))
+    ptpSession.transport.send_ptp_request(msg_ptp_request)
+    ptpSession.transport.send_ptp_data(msg_ptp_request, str(message))
+    msg_ptp_response = ptpSession.transport.wait_ptp_response(msg_ptp_request, timeout)
+    if msg_ptp_response.respcode != CHDKPtpValues.ResponseCodes.OK:
+        raise Exception("CHDK PTP Response Code indicates something is wrong, Response Code: " + str(msg_ptp_response.respcode))
+    return msg_ptp_response.params[0]
+
+@Resyncing(retry=True)
+def remoteCaptureIsReady(ptpSession):
+    """Asks whether the image of a shot taken after init_usb_capture() is ready to fetch
+        returns tuple (formats, imagenumber), formats is a mask of the CHDKPtpValues.CaptureFormats which can be
+        fetched with remoteCaptureGetData(), 0 while the camera is still shooting"""
+    rc_ptp_request = PtpRequest(CHDKPtpValues.CHDKOpcode, ptpSession.sessionid, ptpSession.NewTransaction(), params=(CHDKPtpValues.Commands.RemoteCaptureIsReady,))
+    (rc_ptp_response, rx) = ptpSession.transport.ptp_simple_transaction(rc_ptp_request)
+    if rc_ptp_response.respcode != CHDKPtpValues.ResponseCodes.OK:
+        raise Exception("CHDK PTP Response Code indicates something is wrong, Response Code: " + str(rc_ptp_response.respcode))
+    if rc_ptp_response.params[0] & CHDKPtpValues.CaptureFormats.ERROR:
+        raise Exception("Remote capture is not active on the camera")
+    return (rc_ptp_response.params[0], rc_ptp_response.params[1])
+
+@Resyncing(retry=False)
+def remoteCaptureGetChunk(ptpSession, captureFormat):
+    """Fetches the next chunk of one format of a remote capture, chunks are removed from the camera as they are read
+        returns tuple (data, last, offset), offset is where data goes in the file or CaptureFormats.SEQUENTIAL"""
+    rc_ptp_request = PtpRequest(CHDKPtpValues.CHDKOpcode, ptpSession.sessionid, ptpSession.NewTransaction(), params=(CHDKPtpValues.Commands.RemoteCaptureGetData, captureFormat))
+    (rc_ptp_response, rx) = ptpSession.transport.ptp_simple_transaction(rc_ptp_request, receiving=True)
+    if rc_ptp_response.respcode != CHDKPtpValues.ResponseCodes.OK:
+        raise Exception("CHDK PTP Response Code indicates something is wrong, Response Code: " + str(rc_ptp_response.respcode))
+    data = ""
+    if rx != None:
+        data = rx[1]
+    (size, more, offset) = rc_ptp_response.params[0:3]
+    return (data, more == CHDKPtpValues.CaptureFormats.LAST_CHUNK, offset)
+
+def remoteCaptureGetData(ptpSession, captureFormat, stream):
+    """Fetches one format of a remote capture chunk by chunk, writing it to stream, which must be able to seek
+    for cameras which send chunks out of order
+        returns the number of bytes written"""
+    total = 0
+    last = False
+    while not last:
+        (data, last, offset) = remoteCaptureGetChunk(ptpSession, captureFormat)
+        if offset != CHDKPtpValues.CaptureFormats.SEQUENTIAL:
+            stream.seek(offset)
+        stream.write(data)
+        total += len(data)
+    return total
+
+# GetDisplayData starts with this header, the version then offsets into the data of the palette and of
+# the viewport and bitmap framebuffer descriptions, an offset of 0 means it was not sent
+LIVE_VIEW_HEADER = struct.Struct("<7i")
+# a framebuffer description, type, offset of its pixels, row length in pixels, visible width and height, then margins
+FRAMEBUFFER_DESC = struct.Struct("<9i")
+
+@Resyncing(retry=True)
+def getDisplayData(ptpSession, flags=CHDKPtpValues.LiveViewFlags.VIEWPORT):
+    """Gets a frame of the camera's live view, the camera must be in shooting mode for the viewport to be live
+        params:
+            flags - which of CHDKPtpValues.LiveViewFlags to send
+        returns the data as a string, see decodeViewportLuma()"""
+    lv_ptp_request = PtpRequest(CHDKPtpValues.CHDKOpcode, ptpSession.sessionid, ptpSession.NewTransaction(), params=(CHDKPtpValues.Commands.GetDisplayData, flags))
+    (lv_ptp_response, rx) = ptpSession.transport.ptp_simple_transaction(lv_ptp_request, receiving=True)
+    if lv_ptp_response.respcode != CHDKPtpValues.ResponseCodes.OK or rx == None:
+        raise Exception("CHDK PTP Response Code indicates something is wrong, Response Code: " + str(lv_ptp_response.respcode))
+    return rx[1]
+
+def decodeViewportLuma(data):
+    """Pulls the brightness of each pixel out of the viewport of a frame from getDisplayData(), enough for framing
+    and focusing, and only slicing so quick enough to keep up with the camera
+        returns tuple (width, height, bytesperline, luma), luma is a bytearray of a byte per pixel with rows of
+        bytesperline bytes, of which the first width are visible"""
+    data = buffer(data)
+    (version_major, version_minor, aspect, palette_type, palette_start, vp_start, bm_start) = LIVE_VIEW_HEADER.unpack_from(data)
+    if vp_start == 0:
+        raise Exception("Live view data has no viewport")
+    (fb_type, data_start, buffer_width, visible_width, visible_height) = FRAMEBUFFER_DESC.unpack_from(data, vp_start)[0:5]
+    if fb_type == CHDKPtpValues.FramebufferTypes.YUV8:
+        # Y bytes are 1, 3, 4 and 5 of each 6
+        pixels = bytearray(data[data_start:data_start + buffer_width * visible_height * 6 // 4])
+        luma = bytearray(len(pixels) * 4 // 6)
+        luma[0::4] = pixels[1::6]
+        luma[1::4] = pixels[3::6]
+        luma[2::4] = pixels[4::6]
+        luma[3::4] = pixels[5::6]
+    elif fb_type == CHDKPtpValues.FramebufferTypes.YUV8B:
+        pixels = bytearray(data[data_start:data_start + buffer_width * visible_height * 2])
+        luma = bytearray(len(pixels) // 2)
+        luma[0::2] = pixels[1::4]
+        luma[1::2] = pixels[3::4]
+    else:
+        raise Exception("Live view framebuffer type " + str(fb_type) + " is not supported")
+    return (visible_width, visible_height, buffer_width, luma)
+
+def readJpegThumbnail(path):
+    """Reads the thumbnail a camera embeds in the Exif data of its jpegs, so there is something small to show for
+    an image without decoding all of it
+        returns the thumbnail as jpeg data, or None if the file has none"""
+    file = open(path, "rb")
+    try:
+        if file.read(2) != "\xff\xd8":
+            return None
+        while True:
+            marker = file.read(4)
+            if len(marker) < 4 or marker[0] != "\xff" or marker[1] in ("\xda", "\xd9"):
+                # the Exif data comes before the image data
+                return None
+            (length, ) = struct.unpack(">H", marker[2:])
+            segment = file.read(length - 2)
+            if marker[1] == "\xe1" and segment.startswith("Exif\x00\x00"):
+                return _exifThumbnail(segment[6:])
+    finally:
+        file.close()
+
+def _exifThumbnail(tiff):
+    byteorder = {"II": "<", "MM": ">"}.get(tiff[0:2])
+    if byteorder == None or len(tiff) < 8:
+        return None
+    try:
+        (ifd0, ) = struct.unpack_from(byteorder + "I", tiff, 4)
+        (count, ) = struct.unpack_from(byteorder + "H", tiff, ifd0)
+        # the thumbnail is described by the second IFD, which follows on from the first
+        (ifd1, ) = struct.unpack_from(byteorder + "I", tiff, ifd0 + 2 + count * 12)
+        if ifd1 == 0:
+            return None
+        (count, ) = struct.unpack_from(byteorder + "H", tiff, ifd1)
+        tags = {}
+        for entry in range(count):
+            (tag, type, valuecount, value) = struct.unpack_from(byteorder + "HHII", tiff, ifd1 + 2 + entry * 12)
+            tags[tag] = value
+    except struct.error:
+        return None
+    offset = tags.get(0x0201) # JPEGInterchangeFormat
+    length = tags.get(0x0202) # JPEGInterchangeFormatLength
+    if offset == None or length == None or tiff[offset:offset + 2] != "\xff\xd8":
+        return None
+    return tiff[offset:offset + length]
+
+@Resyncing(retry=False)
+def uploadFile(ptpSession, source, remotePath, size=None):
+    """Writes a file onto the camera's card, the data is streamed from source rather than read into memory first
+        params:
+            ptpSession - ptp session created using pyptp
+            source - string of the file's contents, or a file or iterator of strings to read them from
+            remotePath - path on the camera to write to, e.g. "A/CHDK/SCRIPTS/rti.lua"
+            size - size of the file in bytes, if None it is worked out from source"""
+    contents = PtpDataReader(source, size)
+    remotePath = str(remotePath)
+    # the data phase is the length of the path, the path, then the file itself
+    data = PtpDataReader(itertools.chain((struct.pack("<I", len(remotePath)) + remotePath, ), contents.chunks(64 * 1024)),
+                         4 + len(remotePath) + contents.size)
+    upload_ptp_request = PtpRequest(CHDKPtpValues.CHDKOpcode, ptpSession.sessionid, ptpSession.NewTransaction(), params=(CHDKPtpValues.Commands.UploadFile,))
+    ptpSession.transport.send_ptp_request(upload_ptp_request)
+    ptpSession.transport.send_ptp_data(upload_ptp_request, data, data.size)
+    upload_ptp_response = ptpSession.transport.wait_ptp_response(upload_ptp_request, RESPONSE_TIMEOUT)
+    if upload_ptp_response.respcode != CHDKPtpValues.ResponseCodes.OK:
+        raise Exception("CHDK PTP Response Code indicates something is wrong, Response Code: " + str(upload_ptp_response.respcode))
+
+def calibrateBulkReadSize(ptpSession, objectHandle, sampleBytes, sizes=(16*1024, 64*1024, 256*1024, 1024*1024, 4*1024*1024)):
+    """Times a partial read of an object already on the camera at each of the candidate bulk read sizes
+    and returns the size which gave the best throughput, the transport is left set to that size"""
+    bestSize = None
+    bestRate = 0
+    for size in sizes:
+        ptpSession.transport.set_bulk_read_size(size)
+        start = time.time()
+        ptpSession.GetPartialObject(objectHandle, 0, sampleBytes)
+        rate = sampleBytes / max(time.time() - start, 1e-6)
+        logging.debug("bulk read size " + str(size) + ": " + str(rate / (1024 * 1024)) + " MB/s")
+        if rate > bestRate:
+            bestSize = size
+            bestRate = rate
+    ptpSession.transport.set_bulk_read_size(bestSize)
+    return bestSize
+
+
+class CHDKCommandServer:
+    """Keeps one lua script running on the camera which carries out commands sent to it as script messages, so
+    a command costs a message each way rather than starting a new script and polling until it finishes.
+    
+    Each command is a chunk of lua, it is sent as "<sequence number> <lua>" and the script replies with
+    "<sequence number> ok <what the chunk returned>" or "<sequence number> err <error>", a reply with any other
+    number is left over from a command which was given up on and is skipped.
+    
+    What it saves is the camera compiling and starting a script for each command, waiting for a script to finish
+    costs little since waitForScriptFinish() polls with backoff. So it is only worth using on cameras which are
+    slow to start scripts, on one which starts them at once a command costs about the same either way."""
+    
+    script = """
+    -- rticap command server
+    while true do
+        local msg = read_usb_msg(100)
+        if msg == "quit" then
+            return
+        elseif msg then
+            local seq, chunk = string.match(msg, "^(%d+) (.*)$")
+            local ok, result = false, "malformed command"
+            if seq then
+                local f, err = loadstring(chunk)
+                ok, result = false, err
+                if f then
+                    ok, result = pcall(f)
+                end
+            end
+            if ok then
+                write_usb_msg(seq .. " ok " .. tostring(result), 1000)
+            else
+                write_usb_msg(tostring(seq) .. " err " .. tostring(result), 1000)
+            end
+        end
+    end
+    """
+    
+    def __init__(self, ptpSession, spins=POLL_SPINS, pollInterval=POLL_INTERVAL, maxPollInterval=MAX_POLL_INTERVAL):
+        """params:
+            ptpSession - ptp session created using pyptp
+            spins, pollInterval, maxPollInterval - how replies are polled for, see pollWithBackoff()"""
+        self.ptpSession = ptpSession
+        self.spins = spins
+        self.pollInterval = pollInterval
+        self.maxPollInterval = maxPollInterval
+        self.scriptId = None
+        self.sequence = 0
+    
+    def running(self):
+        return self.scriptId != None
+    
+    def start(self):
+        """Starts the script on the camera"""
+        self.scriptId = executeScript(self.ptpSession, self.script, CHDKPtpValues.ScriptingLanguage.LUA)
+        logging.debug("command server started as script " + str(self.scriptId))
+    
+    def stop(self):
+        """Asks the script to finish"""
+        if self.scriptId != None:
+            scriptId = self.scriptId
+            self.scriptId = None
+            writeScriptMessage(self.ptpSession, scriptId, "quit")
+    
+    def call(self, lua, timeout=SCRIPT_TIMEOUT):
+        """Runs a chunk of lua on the camera, starting the script first if it is not running
+            returns what the chunk returned, as a string
+            raises Exception if the chunk failed, PtpTimeoutException if there was no reply within timeout seconds"""
+        return self.waitForReply(self.send(lua), timeout)
+    
+    def send(self, lua):
+        """Sends a chunk of lua to be run on the camera without waiting for it, starting the script first if it is
+        not running
+            returns the command's sequence number, to pass to waitForReply()"""
+        if self.scriptId == None:
+            self.start()
+        self.sequence += 1
+        status = writeScriptMessage(self.ptpSession, self.scriptId, str(self.sequence) + " " + lua)
+        if status != CHDKPtpValues.WriteMessageStatus.OK:
+            # not ours any more (e.g. something else ran a script), start again next time
+            self.scriptId = None
+            raise Exception("Command server is not running, WriteScriptMsg status: " + str(status))
+        return self.sequence
+    
+    def waitForReply(self, sequence, timeout=SCRIPT_TIMEOUT):
+        """Waits for the reply to a command sent with send(), see call()"""
+        prefix = str(sequence) + " "
+        def reply():
+            (msgtype, scriptid, message) = readScriptMessage(self.ptpSession)
+            if msgtype != CHDKPtpValues.MessageTypes.NONE and self.scriptId != None and scriptid != self.scriptId:
+                # left over from an earlier script, e.g. one run while the server was stopped
+                logging.debug("skipping message from script " + str(scriptid) + ": " + message)
+            elif msgtype == CHDKPtpValues.MessageTypes.USER and message.startswith(prefix):
+                return message[len(prefix):]
+            elif msgtype in (CHDKPtpValues.MessageTypes.ERR, CHDKPtpValues.MessageTypes.RET):
+                self.scriptId = None
+                raise Exception("Command server stopped: " + message)
+        start = time.time()
+        message = pollWithBackoff(reply, timeout, "No reply to command", self.spins, self.pollInterval, self.maxPollInterval)
+        if self.ptpSession.transport.metrics != None:
+            self.ptpSession.transport.metrics.script_wait(time.time() - start)
+        (outcome, sep, result) = message.partition(" ")
+        if outcome != "ok":
+            raise Exception("Camera command failed: " + result)
+        return result
+
+
+class CHDKBurst:
+    """A lua script which shoots a fixed number of frames one after another, each as soon as the host says its
+    lighting is ready, so a sequence costs one script rather than one per shot.
+    
+    The host sends "go" for each frame and the script replies "exposed <frame number>" once the exposure is over,
+    while the camera is still saving the image, so the lighting can be moved on for the next frame straight away.
+    The focus is held half pressed for the whole burst."""
+    
+    script = """
+    -- rticap burst
+    local count, timeout = %i, %i
+    press("shoot_half")
+    repeat sleep(10) until get_shooting()
+    for i = 1, count do
+        if read_usb_msg(timeout) ~= "go" then
+            release("shoot_half")
+            error("no go for frame " .. i)
+        end
+        local exposures = get_exp_count()
+        press("shoot_full_only")
+        repeat sleep(10) until get_exp_count() ~= exposures
+        release("shoot_full_only")
+        write_usb_msg("exposed " .. i, 1000)
+    end
+    release("shoot_half")
+    """
+    
+    def __init__(self, ptpSession, count, frameTimeout=SCRIPT_TIMEOUT, spins=POLL_SPINS, pollInterval=POLL_INTERVAL, maxPollInterval=MAX_POLL_INTERVAL):
+        """params:
+            ptpSession - ptp session created using pyptp
+            count - number of frames to shoot
+            frameTimeout - seconds the script waits for each "go" before giving up
+            spins, pollInterval, maxPollInterval - how exposures are polled for, see pollWithBackoff()"""
+        self.ptpSession = ptpSession
+        self.count = count
+        self.frameTimeout = frameTimeout
+        self.spins = spins
+        self.pollInterval = pollInterval
+        self.maxPollInterval = maxPollInterval
+        self.scriptId = None
+        self.triggered = 0 # frames told to go
+        self.exposed = 0 # frames the camera has reported exposed
+    
+    def start(self):
+        """Starts the script on the camera, the camera must already be in shooting mode"""
+        self.scriptId = executeScript(self.ptpSession, self.script % (self.count, self.frameTimeout * 1000), CHDKPtpValues.ScriptingLanguage.LUA)
+        logging.debug("burst of " + str(self.count) + " started as script " + str(self.scriptId))
+    
+    def trigger(self):
+        """Tells the script to shoot the next frame"""
+        if self.triggered >= self.count:
+            raise Exception("All " + str(self.count) + " frames of the burst have been shot")
+        status = writeScriptMessage(self.ptpSession, self.scriptId, "go")
+        if status != CHDKPtpValues.WriteMessageStatus.OK:
+            raise Exception("Burst is not running, WriteScriptMsg status: " + str(status))
+        self.triggered += 1
+    
+    def waitForExposure(self, timeout=SCRIPT_TIMEOUT):
+        """Waits until the camera has finished exposing the last frame triggered
+            returns the frame number, counting from 1
+            raises Exception if the script stopped, PtpTimeoutException if the exposure did not finish within timeout seconds"""
+        def frameExposed():
+            if self.exposed >= self.triggered:
+                return self.exposed
+            (msgtype, scriptid, message) = readScriptMessage(self.ptpSession)
+            if msgtype != CHDKPtpValues.MessageTypes.NONE and self.scriptId != None and scriptid != self.scriptId:
+                # left over from an earlier script, e.g. the RET of a command server stopped to make way for the burst
+                logging.debug("skipping message from script " + str(scriptid) + ": " + message)
+            elif msgtype == CHDKPtpValues.MessageTypes.USER and message.startswith("exposed "):
+                self.exposed = int(message[len("exposed "):])
+                if self.exposed >= self.triggered:
+                    return self.exposed
+            elif msgtype in (CHDKPtpValues.MessageTypes.ERR, CHDKPtpValues.MessageTypes.RET):
+                raise Exception("Burst stopped after " + str(self.exposed) + " frames: " + message)
+        start = time.time()
+        pollWithBackoff(frameExposed, timeout, "Frame " + str(self.triggered) + " not exposed", self.spins, self.pollInterval, self.maxPollInterval)
+        if self.ptpSession.transport.metrics != None:
+            self.ptpSession.transport.metrics.script_wait(time.time() - start)
+        return self.exposed
+    
+    def finish(self):
+        """Waits for the script to finish, once every frame has been shot it only has to save the last images"""
+        waitForScriptFinish(self.ptpSession)
+
+
+class CHDKAsyncPtpSession(AsyncPtpSession):
+    """AsyncPtpSession with the CHDK scripting commands, each returns a PtpFuture and runs on the transport's worker thread"""
+
+    def executeScript(self, script, language=CHDKPtpValues.ScriptingLanguage.LUA, wait=False, timeout=RESPONSE_TIMEOUT):
+        return self.Call(executeScript, script, language, wait, timeout)
+
+    def getScriptStatus(self, timeout=RESPONSE_TIMEOUT):
+        return self.Call(getScriptStatus, timeout)
+
+    def waitForScriptFinish(self, timeout=SCRIPT_TIMEOUT, spins=POLL_SPINS, pollInterval=POLL_INTERVAL, maxPollInterval=MAX_POLL_INTERVAL):
+        return self.Call(waitForScriptFinish, timeout, spins, pollInterval, maxPollInterval)
+
+    def readScriptMessage(self, timeout=RESPONSE_TIMEOUT):
+        return self.Call(readScriptMessage, timeout)
+
+    def writeScriptMessage(self, scriptId, message, timeout=RESPONSE_TIMEOUT):
+        return self.Call(writeScriptMessage, scriptId, message, timeout)
+
+    def getDisplayData(self, flags=CHDKPtpValues.LiveViewFlags.VIEWPORT):
+        return self.Call(getDisplayData, flags)
 
 
 class CHDKPtpCapture:
+    transportConfigPath = 'config/TransportConfig.pkl'
+    calibrationSampleBytes = 2 * 1024 * 1024
+    captureTimeout = 10 # seconds to wait for the image of a shot to appear
+    downloadChunkSize = 1024 * 1024
+    downloadRetries = 3
+    
+    # values of the flash mode property (143 on the SX200IS)
+    FLASH_AUTO = 1
+    FLASH_OFF = 2
+    
     def __init__(self):
-        self.autofocuslocked = False
+        # what we know of the camera's state, None where it is not known, so the scripts setting it
+        # are only run when it needs changing, see invalidateState()
+        self.shootingMode = None # True once the camera is known to be in shooting (rec) mode
+        self.flashMode = None
+        self.autofocuslocked = None
+        self.eventPump = None
+        self.objectCatalog = None
+        self.commandServer = None
+        self.remoteCapture = False
+        self.burst = None # the CHDKBurst between startBurst() and finishBurst()
+    
+    @classmethod
+    def findCameras(cls):
+        """Returns a tuple of every ptp device on usb, any of which can be passed to connect()"""
+        return PtpUsbTransport.findptps()
     
-    def connect(self):
-        """Connects to the first available ptp device, ptpSession is used to access most ptp commands"""
-        ptps = PtpUsbTransport.findptps()
-        print ptps
-        self.ptpTransport = PtpUsbTransport(ptps[0])
+    def connect(self, bulkReadSize=None, calibrate=True, useEventPump=True, transport=None, collectMetrics=True, device=None, useWorkerThread=False,
+                useCommandServer=False, useRemoteCapture=False):
+        """Connects to the first available ptp device, ptpSession is used to access most ptp commands
+            params:
+                bulkReadSize - size of the bulk reads to use for downloads, if None the size cached for this camera is used
+                calibrate - if there is no cached size for this camera, time downloads at several sizes to find the best one
+                useEventPump - read camera events on a background thread rather than polling for them after each shot
+                transport - transport to the camera, if None a usb transport to device is used
+                collectMetrics - gather per operation timings on the transport, see getMetricsReport()
+                device - usb device of the camera (see findCameras()), if None the first ptp device on usb is used
+                useWorkerThread - do all i/o with this camera on a thread of its own, so inBackground() can run
+                                  operations on several cameras at once
+                useCommandServer - run the camera's scripts through a CHDKCommandServer rather than as scripts of
+                                   their own, this needs a CHDK build with script messages (PTP API 2 or later)
+                useRemoteCapture - shoot with captureToFile() rather than capture() and a download, this needs a CHDK
+                                   build with remote capture"""
+        if transport == None:
+            if device == None:
+                ptps = PtpUsbTransport.findptps()
+                print ptps
+                device = ptps[0]
+            transport = PtpUsbTransport(device)
+        if useWorkerThread:
+            transport = PtpThreadedTransport(transport)
+        self.ptpTransport = transport
+        if collectMetrics:
+            metrics = self.ptpTransport.enable_metrics()
+            metrics.subcommand_opcodes.add(CHDKPtpValues.CHDKOpcode)
         self.ptpSession = PtpSession(self.ptpTransport)
 
         self.vendorId = PtpValues.Vendors.STANDARD
@@ -112,15 +656,91 @@ class CHDKPtpCapture:
         self.vendorId = self.deviceInfo.VendorExtensionID
         print "model: " + self.deviceInfo.Model
         
+        if useEventPump:
+            pollFunc = None
+            if self.vendorId == PtpValues.Vendors.NIKON and isinstance(self.ptpTransport, PtpThreadedTransport) and \
+                    PtpValues.NikonOperations.CHECK_EVENTS in self.deviceInfo.OperationsSupported:
+                # nikons only report events when asked, on the bulk pipe, which the pump can only share with
+                # other threads through the worker thread's transaction lock
+                pollFunc = NikonSupport.CheckEvents
+            self.eventPump = PtpEventPump(self.ptpSession, pollFunc=pollFunc)
+            self.eventPump.start()
+            # property values are only cached while events can say when they change, which a nikon does not
+            # without the poll
+            if self.vendorId != PtpValues.Vendors.NIKON or pollFunc != None:
+                self.ptpSession.propertyCache = PtpPropertyCache(self.ptpSession, self.eventPump)
+                self.ptpSession.propertyCache.refresh(self.deviceInfo)
+        # without the event pump the catalog cannot see new shots, so is only used for what is on the card already
+        self.objectCatalog = PtpObjectCatalog(self.ptpSession, self.eventPump)
+        self.objectCatalog.refresh(readInfos=True)
+        if useCommandServer:
+            self.commandServer = CHDKCommandServer(self.ptpSession)
+        self.remoteCapture = useRemoteCapture
+        
+        self.configureBulkReadSize(bulkReadSize, calibrate)
+        
         return True
+    
+    def configureBulkReadSize(self, bulkReadSize=None, calibrate=True):
+        """Sets the bulk read size of the transport, an explicit size is used as given, otherwise the size
+        found by an earlier calibration of this camera model/serial, otherwise a new calibration is run
+        against an image already on the card (if there is one) and its result cached"""
+        if bulkReadSize == None:
+            config = appconfig.AppConfig(self.transportConfigPath)
+            cameraKey = self.deviceInfo.Model + ":" + self.deviceInfo.SerialNumber
+            bulkReadSize = config.getValue(cameraKey)
+            if bulkReadSize == None and calibrate:
+                objectHandle = self._findCalibrationObject()
+                if objectHandle != None:
+                    bulkReadSize = calibrateBulkReadSize(self.ptpSession, objectHandle, self.calibrationSampleBytes)
+                    config.setValue(cameraKey, bulkReadSize)
+        if bulkReadSize != None:
+            self.ptpTransport.set_bulk_read_size(bulkReadSize)
+        logging.debug("bulk read size " + str(self.ptpTransport.bulk_read_size))
+    
+    def _findCalibrationObject(self):
+        """Returns the handle of an object big enough to time downloads against, or None"""
+        if not SupportsPartialObject(self.deviceInfo):
+            return None
+        for objectHandle in self.objectCatalog.GetObjectHandles():
+            objectInfo = self.objectCatalog.GetObjectInfo(objectHandle)
+            if objectInfo.ObjectFormat != PtpValues.StandardObjectFormats.ASSOCIATION and objectInfo.ObjectCompressedSize >= self.calibrationSampleBytes:
+                return objectHandle
+        return None
+        
+    def runScript(self, lua_script):
+        """Runs a lua script on the camera and waits for it to finish, through the command server if there is one"""
+        try:
+            if self.commandServer != None:
+                return self.commandServer.call(lua_script)
+            executeScript(self.ptpSession, lua_script, CHDKPtpValues.ScriptingLanguage.LUA, wait=True)
+        except:
+            # a script which failed part way may have left the camera in any state
+            self.invalidateState()
+            raise
+    
+    def invalidateState(self):
+        """Forgets the camera's mode, flash and autofocus lock state, so the next operation needing each sets it
+        again. Call this if the camera may have been changed behind our back, e.g. from its own controls"""
+        self.shootingMode = None
+        self.flashMode = None
+        self.autofocuslocked = None
         
     def capture(self):
         """Captures an image and returns it's objectid"""
         self.activateShootingMode()
+        if self.eventPump != None:
+            # anything already queued belongs to an earlier operation
+            self.eventPump.clear()
         lua_script = "shoot()"
         logging.debug("sending script")
-        executeScript(self.ptpSession, lua_script, CHDKPtpValues.ScriptingLanguage.LUA, wait=True)
+        self.runScript(lua_script)
         logging.debug("script finished")
+        if self.eventPump != None:
+            evt = self.eventPump.waitForEvent(PtpValues.StandardEvents.OBJECT_ADDED, self.captureTimeout)
+            if evt == None:
+                raise Exception("Capture did not complete")
+            return evt.params[0]
         # below couple of lines in while loop taken from Capture.py of pyptp
         objectid = None
         while True:
@@ -132,8 +752,149 @@ class CHDKPtpCapture:
                 break
         return objectid
         
-    def activateShootingMode(self):
-        """Activates shooting mode on the camera, allowing the camera to shoot while under usb control"""
+    def startBurst(self, count):
+        """Starts shooting a burst of count frames from one script on the camera, call triggerBurstFrame() and
+        waitForBurstExposure() for each frame, then finishBurst() for the images. The images go to the card as
+        with capture(), remote capture is not used. Other camera operations must wait until the burst is finished"""
+        self.activateShootingMode()
+        if self.commandServer != None and self.commandServer.running():
+            # only one script can run at a time, the server is started again when next needed
+            self.commandServer.stop()
+            waitForScriptFinish(self.ptpSession)
+        if self.eventPump != None:
+            # anything already queued belongs to an earlier operation
+            self.eventPump.clear()
+        self.burst = CHDKBurst(self.ptpSession, count)
+        try:
+            self.burst.start()
+        except:
+            self.burst = None
+            self.invalidateState()
+            raise
+    
+    def triggerBurstFrame(self):
+        """Tells the camera to shoot the next frame of the burst, the lighting for it should already be set"""
+        self.__burstStep(self.burst.trigger)
+    
+    def waitForBurstExposure(self):
+        """Waits until the frame last triggered has been exposed, after which the lighting can be changed
+            returns the frame number, counting from 1"""
+        return self.__burstStep(self.burst.waitForExposure, self.captureTimeout)
+    
+    def finishBurst(self):
+        """Waits for the burst to finish once all its frames have been shot
+            returns the objectids of the images, in the order they were shot"""
+        burst = self.burst
+        self.burst = None
+        self.__burstStep(burst.finish)
+        objectids = []
+        for frame in range(burst.count):
+            if self.eventPump != None:
+                evt = self.eventPump.waitForEvent(PtpValues.StandardEvents.OBJECT_ADDED, self.captureTimeout)
+            else:
+                evt = self.ptpSession.CheckForEvent(None)
+                while evt != None and evt.eventcode != PtpValues.StandardEvents.OBJECT_ADDED:
+                    evt = self.ptpSession.CheckForEvent(None)
+            if evt == None:
+                raise Exception("Burst frame " + str(frame + 1) + " did not complete")
+            objectids.append(evt.params[0])
+        return objectids
+    
+    def captureBurst(self, count, beforeFrame=None):
+        """Shoots count frames from one script on the camera
+            params:
+                beforeFrame - called as beforeFrame(frameIndex) before each frame is shot, counting from 0, e.g. to
+                              change the lighting, the previous frame has been exposed by then
+            returns the objectids of the images, in the order they were shot"""
+        self.startBurst(count)
+        for frame in range(count):
+            if beforeFrame != None:
+                beforeFrame(frame)
+            self.triggerBurstFrame()
+            self.waitForBurstExposure()
+        return self.finishBurst()
+    
+    def __burstStep(self, func, *args):
+        try:
+            return func(*args)
+        except:
+            # the script gives up on its own once it stops hearing from us
+            self.burst = None
+            self.invalidateState()
+            raise
+        
+    def captureToFile(self, savepath, formats=CHDKPtpValues.CaptureFormats.JPEG, spins=POLL_SPINS, pollInterval=POLL_INTERVAL,
+                      maxPollInterval=MAX_POLL_INTERVAL):
+        """Shoots using CHDK's remote capture, the image goes from the camera's memory straight to savepath without
+        being written to its card, so there is nothing to download or delete afterwards
+            params:
+                formats - CaptureFormats.JPEG and/or CaptureFormats.DNG, a DNG is saved beside savepath with a .dng extension
+                spins, pollInterval, maxPollInterval - how the camera is polled for the image, see pollWithBackoff()
+            returns a list of the paths written"""
+        self.activateShootingMode()
+        lua_script = "init_usb_capture(%i,0,0)\nshoot()\ninit_usb_capture(0)" % formats
+        # the shot is held until we have fetched it, so the script can't be waited for until then
+        if self.commandServer != None:
+            sequence = self.commandServer.send(lua_script)
+        else:
+            executeScript(self.ptpSession, lua_script, CHDKPtpValues.ScriptingLanguage.LUA)
+        
+        paths = []
+        files = {}
+        try:
+            if formats & CHDKPtpValues.CaptureFormats.JPEG:
+                paths.append(savepath)
+                files[CHDKPtpValues.CaptureFormats.JPEG] = open(savepath, "wb")
+            if formats & CHDKPtpValues.CaptureFormats.DNG:
+                paths.append(os.path.splitext(savepath)[0] + ".dng")
+                # the header and the sensor data make up one file
+                files[CHDKPtpValues.CaptureFormats.DNG_HEADER] = files[CHDKPtpValues.CaptureFormats.RAW] = open(paths[-1], "wb")
+            def imageReady():
+                (ready, imagenumber) = remoteCaptureIsReady(self.ptpSession)
+                if ready & remaining:
+                    return ready & remaining
+            remaining = formats
+            while remaining:
+                # captureTimeout applies to each format in turn, a DNG is ready well before its jpeg
+                ready = pollWithBackoff(imageReady, self.captureTimeout, "Remote capture image not ready", spins, pollInterval, maxPollInterval)
+                # raw data is ready before the jpeg, and a DNG's header comes before its data
+                for captureFormat in (CHDKPtpValues.CaptureFormats.DNG_HEADER, CHDKPtpValues.CaptureFormats.RAW, CHDKPtpValues.CaptureFormats.JPEG):
+                    if ready & captureFormat:
+                        remoteCaptureGetData(self.ptpSession, captureFormat, files[captureFormat])
+                        remaining &= ~captureFormat
+        except:
+            self.invalidateState()
+            self.abortRemoteCapture()
+            raise
+        finally:
+            for file in set(files.values()):
+                file.close()
+        
+        if self.commandServer != None:
+            self.commandServer.waitForReply(sequence)
+        else:
+            waitForScriptFinish(self.ptpSession)
+        return paths
+        
+    def abortRemoteCapture(self):
+        """Stops a remote capture left waiting on the camera, e.g. by a captureToFile() which failed part way. Starting
+        a new script ends whatever script (or command server command) is stuck in shoot(), and this one turns remote
+        capture off, otherwise the camera keeps every shot waiting for us until it times out"""
+        if self.commandServer != None:
+            # its script is about to be replaced, it is started again when next needed
+            self.commandServer.scriptId = None
+        try:
+            executeScript(self.ptpSession, "init_usb_capture(0)", CHDKPtpValues.ScriptingLanguage.LUA, wait=True)
+        except Exception:
+            logging.exception("could not stop remote capture")
+    
+    def activateShootingMode(self, force=False):
+        """Activates shooting mode on the camera, allowing the camera to shoot while under usb control, unless it
+        is already known to be in shooting mode
+            params:
+                force - run the mode switch whatever state the camera is thought to be in"""
+        if self.shootingMode and not force:
+            return
         lua_script = """
         switch_mode_usb(1)
         rec,vid,mode=get_mode()
@@ -141,50 +902,107 @@ class CHDKPtpCapture:
             rec,vid,mode=get_mode()
         end
         """
-        executeScript(self.ptpSession, lua_script, CHDKPtpValues.ScriptingLanguage.LUA, wait=True)
+        self.runScript(lua_script)
+        # switching mode can reset the others
+        self.invalidateState()
+        self.shootingMode = True
          
     
     def disableFlash(self):
         self.activateShootingMode()
+        if self.flashMode == self.FLASH_OFF:
+            return
         lua_script = "set_prop(143,2) -- turns flash off on SX200IS"
-        executeScript(self.ptpSession, lua_script, CHDKPtpValues.ScriptingLanguage.LUA, wait=True)
+        self.runScript(lua_script)
+        self.flashMode = self.FLASH_OFF
     
     def enableAutoFlash(self):
         self.activateShootingMode()
+        if self.flashMode == self.FLASH_AUTO:
+            return
         lua_script = "set_prop(143,1) -- turns flash to auto on SX200IS"
-        executeScript(self.ptpSession, lua_script, CHDKPtpValues.ScriptingLanguage.LUA, wait=True)
+        self.runScript(lua_script)
+        self.flashMode = self.FLASH_AUTO
         
     def lockAutofocus(self):
         """Prevents the camera from autofocusing"""
         self.activateShootingMode()
+        if self.autofocuslocked == True:
+            return
         lua_script = "set_aflock(1)"
-        executeScript(self.ptpSession, lua_script, CHDKPtpValues.ScriptingLanguage.LUA, wait=True)
+        self.runScript(lua_script)
         self.autofocuslocked = True
     
     def unlockAutofocus(self):
         """Allows the camera to autofocus"""
         self.activateShootingMode()
+        if self.autofocuslocked == False:
+            return
         lua_script = "set_aflock(0)"
-        executeScript(self.ptpSession, lua_script, CHDKPtpValues.ScriptingLanguage.LUA, wait=True)
+        self.runScript(lua_script)
         self.autofocuslocked = False
         
     def autofocus(self):
         """Attempts to autofocus the camera"""
         self.activateShootingMode()
         lua_script = "press('shoot_half')"
-        executeScript(self.ptpSession, lua_script, CHDKPtpValues.ScriptingLanguage.LUA, wait=True)
+        self.runScript(lua_script)
         time.sleep(2) # we must wait for a short time for the autofocus to complete, otherwise if we lockAutofocus right afterwards we can cause the program to lock up
     
-    def downloadAndSaveObject(self, objectid, savepath):
-        file = open(savepath, "w")
-        self.ptpSession.GetObject(objectid, file)
-        file.close()
+    def downloadAndSaveObject(self, objectid, savepath, progressCallback=None):
+        """Downloads the object in chunks, a chunk which fails is tried again on its own rather than starting over
+            params:
+                progressCallback - if given it is called as progressCallback(bytesDone, totalBytes) after each chunk"""
+        objectSize = self.objectCatalog.GetObjectSize(objectid)
+        file = open(savepath, "wb")
+        try:
+            download = PtpChunkedDownload(self.ptpSession, objectid, file, objectSize=objectSize, chunkSize=self.downloadChunkSize, retries=self.downloadRetries,
+                                          progressCallback=progressCallback, usePartial=SupportsPartialObject(self.deviceInfo))
+            download.run()
+        finally:
+            file.close()
+    
+    def getThumbnail(self, objectid):
+        """Returns the jpeg thumbnail the camera keeps for an object, it is a small fraction of the size of the object
+        so can be shown while the object itself is still downloading. Where the camera has a medium sized thumbnail
+        (Nikon) that is returned instead"""
+        if PtpValues.NikonOperations.GET_THUMB_MEDIUM in self.deviceInfo.OperationsSupported and self.vendorId == PtpValues.Vendors.NIKON:
+            (size, data) = NikonSupport.GetThumbMedium(self.ptpSession, objectid)
+        else:
+            (size, data) = self.ptpSession.GetThumb(objectid)
+        return data
+    
+    def getLiveViewFrame(self):
+        """Gets the camera's live view as it is now, switching to shooting mode first if need be
+            returns tuple (width, height, bytesperline, luma), see decodeViewportLuma()"""
+        self.activateShootingMode()
+        return decodeViewportLuma(getDisplayData(self.ptpSession))
     
     def deleteObject(self, objectid):
         self.ptpSession.DeleteObject(objectid)
+        # not every camera raises OBJECT_REMOVED for deletions the host asked for
+        self.objectCatalog.remove(objectid)
         
     def getAutofocusLocked(self):
-        return self.autofocuslocked
+        return self.autofocuslocked == True
+    
+    def inBackground(self, func, *args):
+        """Runs func(*args) on this camera's worker thread and returns a PtpFuture for the result, func will
+        usually be one of this object's methods. Without a worker thread func is run straight away."""
+        if isinstance(self.ptpTransport, PtpThreadedTransport):
+            return self.ptpTransport.submit(func, *args)
+        future = PtpFuture()
+        try:
+            future._finish(func(*args), None)
+        except:
+            future._finish(None, sys.exc_info())
+        return future
+    
+    def getMetricsReport(self):
+        """Returns a table of the per operation timings gathered since connecting, or None if they are not being gathered"""
+        if self.ptpTransport.metrics == None:
+            return None
+        return self.ptpTransport.metrics.report(self.vendorId)
         
     #def close(self):
     #    del ptpSession
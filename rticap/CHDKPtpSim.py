@@ -0,0 +1,517 @@
+'''
+CHDKPtpSim - an in process stand in for a CHDK camera on the end of a PTP transport, for
+benchmarking and testing without a camera attached
+
+usage:
+    cam = CHDKPtp.CHDKPtpCapture()
+    cam.connect(transport=CHDKPtpSim.CHDKSimulatedTransport(objectSize=5*1024*1024))
+
+@author: Michael Hodgson
+'''
+import struct
+import threading
+import time
+import re
+from ptp.PtpAbstractTransport import PtpAbstractTransport, PtpResponse, PtpEvent, PtpDataReader, PtpTimeoutException
+from ptp import PtpValues
+from ptp.PtpSession import PtpPacker, PtpUnpacker
+from CHDKPtp import CHDKPtpValues, LIVE_VIEW_HEADER, FRAMEBUFFER_DESC
+
+STORAGE_ID = 0x00010001
+
+def _packString(string):
+    if len(string) == 0:
+        return struct.pack("<B", 0)
+    return struct.pack("<B", len(string) + 1) + (string + u'\u0000').encode('UTF-16-LE')
+
+def _packArray(fmt, values):
+    return struct.pack("<I%i%s" % (len(values), fmt), len(values), *values)
+
+def _exifSegment(thumbnail):
+    # APP1 holding a little endian TIFF with an empty IFD0, then IFD1 giving where the thumbnail is
+    tiff = "II*\x00" + struct.pack("<IHI", 8, 0, 14)
+    tiff += struct.pack("<HHHIIHHIII", 2, 0x0201, 4, 1, 44, 0x0202, 4, 1, len(thumbnail), 0) + thumbnail
+    return "\xff\xe1" + struct.pack(">H", 2 + 6 + len(tiff)) + "Exif\x00\x00" + tiff
+
+class SimulatedObject:
+    def __init__(self, handle, filename, size):
+        self.handle = handle
+        self.filename = filename
+        self.size = size
+
+class CHDKSimulatedTransport(PtpAbstractTransport):
+    """A PtpAbstractTransport which behaves like a CHDK camera, every shoot() adds a new image to the
+    card and raises OBJECT_ADDED once the script has finished"""
+
+    operationsSupported = (PtpValues.StandardOperations.GET_DEVICE_INFO, PtpValues.StandardOperations.OPEN_SESSION,
+                           PtpValues.StandardOperations.CLOSE_SESSION, PtpValues.StandardOperations.GET_STORAGE_IDS,
+                           PtpValues.StandardOperations.GET_OBJECT_HANDLES, PtpValues.StandardOperations.GET_OBJECT_INFO,
+                           PtpValues.StandardOperations.GET_OBJECT, PtpValues.StandardOperations.GET_THUMB,
+                           PtpValues.StandardOperations.DELETE_OBJECT, PtpValues.StandardOperations.GET_PARTIAL_OBJECT,
+                           PtpValues.StandardOperations.GET_DEVICE_PROP_DESC, PtpValues.StandardOperations.GET_DEVICE_PROP_VALUE,
+                           PtpValues.StandardOperations.SET_DEVICE_PROP_VALUE, CHDKPtpValues.CHDKOpcode)
+    eventsSupported = (PtpValues.StandardEvents.OBJECT_ADDED, PtpValues.StandardEvents.DEVICE_PROP_CHANGED)
+
+    def __init__(self, objectSize=4*1024*1024, thumbSize=8*1024, latency=0.001, bandwidth=20*1024*1024, scriptDuration=0.01, shootDuration=0.5,
+                 model="Simulated PowerShot", serialNumber="0", scriptResponseDelay=0, messageDuration=0.001, rawSize=15*1024*1024,
+                 remoteCaptureChunkSize=512*1024, cardWriteDuration=0, viewportSize=(720, 240)):
+        """params:
+            objectSize - size in bytes of each image shot, or a function objectSize(shotNumber) returning it
+            thumbSize - size in bytes of each thumbnail
+            latency - seconds added to every transaction
+            bandwidth - bytes per second of data phases, or None for no limit
+            scriptDuration - seconds any script runs for
+            shootDuration - further seconds a script which calls shoot() runs for
+            scriptResponseDelay - seconds a new script takes to compile and start, the response to ExecuteScript
+                                  comes back and the script runs after that
+            messageDuration - seconds a command sent to a running CHDKCommandServer script takes, shoot() adds
+                              shootDuration as it does for a script
+            rawSize - size in bytes of the sensor data of a remote capture DNG
+            remoteCaptureChunkSize - largest chunk a remote capture is sent in
+            cardWriteDuration - further seconds shoot() takes when the image is saved to the card, which a remote
+                                capture does not do
+            viewportSize - (width, height) of the live view, sent as YUV8"""
+        self.objectSize = objectSize
+        self.thumbSize = thumbSize
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.scriptDuration = scriptDuration
+        self.shootDuration = shootDuration
+        self.scriptResponseDelay = scriptResponseDelay
+        self.messageDuration = messageDuration
+        self.rawSize = rawSize
+        self.remoteCaptureChunkSize = remoteCaptureChunkSize
+        self.cardWriteDuration = cardWriteDuration
+        self.viewportSize = viewportSize
+        self.model = model
+        self.serialNumber = serialNumber
+        self.bulk_read_size = 64 * 1024
+        self.sessionid = 0
+
+        self.objects = {}
+        self.files = {} # path -> contents of each file uploaded
+        # propertyId -> [SimpleTypes data type, value]
+        self.properties = {PtpValues.StandardProperties.BATTERY_LEVEL: [PtpValues.SimpleTypes.UINT8, 100],
+                           PtpValues.StandardProperties.WHITE_BALANCE: [PtpValues.SimpleTypes.UINT16, 2],
+                           PtpValues.StandardProperties.F_NUMBER: [PtpValues.SimpleTypes.UINT16, 280],
+                           PtpValues.StandardProperties.FOCUS_MODE: [PtpValues.SimpleTypes.UINT16, 2],
+                           PtpValues.StandardProperties.EXPOSURE_TIME: [PtpValues.SimpleTypes.UINT32, 100]}
+        self.shotCount = 0
+        self.scriptEnd = 0
+        self.scriptCount = 0
+        self.messageCount = 0
+        self.displayCount = 0 # live view frames sent
+        self.serverScriptId = None # id of the running script if it serves messages (see CHDKCommandServer)
+        self.__scriptMessages = [] # (due, msgtype, scriptid, message) from the script to the host
+        self.__commandsEnd = 0
+        self.__remoteCapture = None # shot waiting to be fetched, see __startRemoteCapture()
+        self.__burst = None # the running CHDKBurst script, see __startBurst()
+        self.__nextHandle = 1
+        self.__pending = None
+        self.__responseDue = 0
+        self.__events = []
+        self.__eventCondition = threading.Condition()
+        self.__payloads = {}
+
+    def set_bulk_read_size(self, size):
+        self.bulk_read_size = size
+
+    def shoot(self, due=None):
+        """Adds a new image to the card, raising OBJECT_ADDED at time due (defaults to now)"""
+        self.shotCount += 1
+        size = self.objectSize
+        if callable(size):
+            size = size(self.shotCount)
+        handle = self.__nextHandle
+        self.__nextHandle += 1
+        self.objects[handle] = SimulatedObject(handle, "IMG_%04i.JPG" % self.shotCount, size)
+        self.postEvent(PtpValues.StandardEvents.OBJECT_ADDED, (handle, ), due)
+        return handle
+
+    def setProperty(self, propertyId, value):
+        """Changes a property as if from the camera's controls, raising DEVICE_PROP_CHANGED"""
+        self.properties[propertyId][1] = value
+        self.postEvent(PtpValues.StandardEvents.DEVICE_PROP_CHANGED, (propertyId, ))
+
+    def postEvent(self, eventcode, params=(), due=None):
+        """Queues an event on the interrupt endpoint, it is reported no earlier than time due"""
+        if due == None:
+            due = time.time()
+        self.__eventCondition.acquire()
+        try:
+            self.__events.append((due, PtpEvent(eventcode, self.sessionid, 0xffffffff, params)))
+            self.__events.sort(key=lambda e: e[0])
+            self.__eventCondition.notifyAll()
+        finally:
+            self.__eventCondition.release()
+
+    def send_ptp_request(self, request):
+        handler = self.__handlers.get(request.opcode)
+        if handler == None:
+            self.__pending = (request, None, self.__response(request, PtpValues.StandardResponses.OPERATION_NOT_SUPPORTED))
+        elif request.opcode == CHDKPtpValues.CHDKOpcode and request.params[0] in (CHDKPtpValues.Commands.ExecuteScript, CHDKPtpValues.Commands.UploadFile,
+                                                                                  CHDKPtpValues.Commands.WriteScriptMsg):
+            # the script, file or message arrives in the data phase
+            self.__pending = (request, None, None)
+        elif request.opcode == PtpValues.StandardOperations.SET_DEVICE_PROP_VALUE:
+            # as does the new value
+            self.__pending = (request, None, None)
+        else:
+            (data, response) = handler(self, request)
+            self.__pending = (request, data, response)
+
+    def send_ptp_data(self, request, data, size=None):
+        reader = PtpDataReader(data, size)
+        data = str(reader.read(reader.size))
+        self.__transfer(len(data))
+        if request.opcode == CHDKPtpValues.CHDKOpcode and request.params[0] == CHDKPtpValues.Commands.ExecuteScript:
+            self.__pending = (request, None, self.__executeScript(request, data))
+        elif request.opcode == CHDKPtpValues.CHDKOpcode and request.params[0] == CHDKPtpValues.Commands.UploadFile:
+            (length, ) = struct.unpack_from("<I", data)
+            self.files[data[4:4 + length]] = data[4 + length:]
+            self.__pending = (request, None, self.__response(request, CHDKPtpValues.ResponseCodes.OK))
+        elif request.opcode == CHDKPtpValues.CHDKOpcode and request.params[0] == CHDKPtpValues.Commands.WriteScriptMsg:
+            self.__pending = (request, None, self.__writeScriptMsg(request, data))
+        elif request.opcode == PtpValues.StandardOperations.SET_DEVICE_PROP_VALUE:
+            self.__pending = (request, None, self.__setDevicePropValue(request, data))
+        else:
+            self.__pending = (request, None, self.__response(request, PtpValues.StandardResponses.OK))
+
+    def get_ptp_data(self, request, stream = None):
+        (pendingRequest, data, response) = self.__pending
+        if data == None:
+            # an error, the response comes in place of the data
+            time.sleep(self.latency)
+            return response
+        self.__pending = (pendingRequest, None, response)
+
+        self.__transfer(len(data))
+        if stream == None:
+            return (len(data), str(data))
+        for offset in range(0, len(data), self.bulk_read_size):
+            stream.write(buffer(data, offset, self.bulk_read_size))
+        return (len(data), None)
+
+    def get_ptp_response(self, request, timeout=None):
+        wait = self.__responseDue - time.time()
+        if timeout != None and wait > timeout / 1000.0:
+            time.sleep(timeout / 1000.0)
+            raise PtpTimeoutException("No response within %i ms" % timeout)
+        (pendingRequest, data, response) = self.__pending
+        self.__pending = None
+        time.sleep(max(wait, 0) + self.latency)
+        return response
+
+    def check_ptp_event(self, sessionid, timeout=None):
+        deadline = None
+        if timeout:
+            deadline = time.time() + timeout / 1000.0
+        self.__eventCondition.acquire()
+        try:
+            while True:
+                now = time.time()
+                if len(self.__events) > 0 and self.__events[0][0] <= now:
+                    return self.__events.pop(0)[1]
+                wait = None
+                if len(self.__events) > 0:
+                    wait = self.__events[0][0] - now
+                if deadline != None:
+                    if now >= deadline:
+                        return None
+                    wait = min(wait, deadline - now) if wait != None else deadline - now
+                self.__eventCondition.wait(wait if wait != None else 1.0)
+        finally:
+            self.__eventCondition.release()
+
+    def __transfer(self, size):
+        if self.bandwidth != None:
+            time.sleep(size / float(self.bandwidth))
+
+    def __response(self, request, respcode, params=()):
+        return PtpResponse(respcode, request.sessionid, request.transactionid, params)
+
+    def __payload(self, size):
+        # images are all alike, so share one payload per size
+        if size not in self.__payloads:
+            exif = ""
+            if size >= 2 * self.thumbSize and self.thumbSize < 60000:
+                # an Exif thumbnail, as cameras put in their jpegs
+                exif = _exifSegment(str(self.__payload(self.thumbSize)))
+            self.__payloads[size] = bytearray('\xff\xd8' + exif + ('\x00' * max(0, size - 4 - len(exif))) + '\xff\xd9')[:size]
+        return self.__payloads[size]
+
+    def __executeScript(self, request, script):
+        self.scriptCount += 1
+        self.__responseDue = time.time() + self.scriptResponseDelay
+        if self.serverScriptId != None:
+            # a command server still running is stopped once its commands are done
+            self.scriptEnd = self.__commandsEnd
+        if self.scriptEnd == float("inf"):
+            # a script waiting on the host forever is killed rather than waited for
+            self.scriptEnd = time.time()
+        now = max(time.time(), self.scriptEnd) + self.scriptResponseDelay
+        self.scriptEnd = now + self.scriptDuration
+        self.serverScriptId = None
+        self.__burst = None
+        # a new script ends one held in a remote capture shoot()
+        self.__remoteCapture = None
+        # messages earlier scripts sent are left queued for the host, as they are on a camera, under their own script ids
+        if "-- rticap burst" in script:
+            self.__startBurst(script, now + self.scriptDuration)
+        elif "read_usb_msg" in script:
+            # a command server, it runs until told to quit
+            self.serverScriptId = self.scriptCount
+            self.scriptEnd = float("inf")
+            self.__commandsEnd = now + self.scriptDuration
+        elif "init_usb_capture(" in script and "shoot()" in script:
+            # the script is held in shoot() until the host has fetched the image
+            self.scriptEnd = float("inf")
+            self.__startRemoteCapture(script, now + self.scriptDuration + self.shootDuration, self.__finishRemoteCaptureScript)
+        elif "shoot()" in script:
+            self.scriptEnd += self.shootDuration + self.cardWriteDuration
+            self.shoot(self.scriptEnd)
+        return self.__response(request, CHDKPtpValues.ResponseCodes.OK, (self.scriptCount, ))
+
+    def __startBurst(self, script, ready):
+        # the script runs until its last frame is saved, each frame waits for a "go"
+        count = int(re.search(r"local count, timeout = (\d+)", script).group(1))
+        self.scriptEnd = float("inf")
+        self.__burst = {"id": self.scriptCount, "count": count, "frame": 0, "ready": ready, "saved": ready}
+
+    def __burstGo(self, request, message):
+        burst = self.__burst
+        if message != "go":
+            # anything else ends the script with an error, as read_usb_msg not giving "go" does
+            self.__scriptMessages.append((time.time(), CHDKPtpValues.MessageTypes.ERR, burst["id"], "no go for frame %i" % (burst["frame"] + 1)))
+            self.__burst = None
+            self.scriptEnd = time.time()
+            return self.__response(request, CHDKPtpValues.ResponseCodes.OK, (CHDKPtpValues.WriteMessageStatus.OK, ))
+        # frames are exposed one after another, saving each to the card overlaps the next exposure
+        burst["frame"] += 1
+        burst["ready"] = max(time.time(), burst["ready"]) + self.messageDuration + self.shootDuration
+        burst["saved"] = max(burst["ready"], burst["saved"]) + self.cardWriteDuration
+        self.shoot(burst["saved"])
+        self.__scriptMessages.append((burst["ready"], CHDKPtpValues.MessageTypes.USER, burst["id"], "exposed %i" % burst["frame"]))
+        if burst["frame"] >= burst["count"]:
+            self.__burst = None
+            self.scriptEnd = burst["saved"]
+        return self.__response(request, CHDKPtpValues.ResponseCodes.OK, (CHDKPtpValues.WriteMessageStatus.OK, ))
+
+    def __finishRemoteCaptureScript(self):
+        self.scriptEnd = time.time()
+
+    def __startRemoteCapture(self, script, due, finish):
+        # nothing goes on the card, the formats asked for are queued as chunks to be fetched from due on
+        self.shotCount += 1
+        formats = int(re.search(r"init_usb_capture\((\d+)", script).group(1))
+        chunks = {}
+        if formats & CHDKPtpValues.CaptureFormats.JPEG:
+            size = self.objectSize
+            if callable(size):
+                size = size(self.shotCount)
+            jpeg = self.__payload(size)
+            chunks[CHDKPtpValues.CaptureFormats.JPEG] = [(jpeg[offset:offset + self.remoteCaptureChunkSize], offset)
+                                                         for offset in range(0, size, self.remoteCaptureChunkSize)]
+        if formats & CHDKPtpValues.CaptureFormats.DNG_HEADER:
+            chunks[CHDKPtpValues.CaptureFormats.DNG_HEADER] = [(bytearray("II*\x00" + "\x00" * 8188), CHDKPtpValues.CaptureFormats.SEQUENTIAL)]
+        if formats & CHDKPtpValues.CaptureFormats.RAW:
+            raw = self.__payload(self.rawSize)
+            chunks[CHDKPtpValues.CaptureFormats.RAW] = [(raw[offset:offset + self.remoteCaptureChunkSize], CHDKPtpValues.CaptureFormats.SEQUENTIAL)
+                                                        for offset in range(0, self.rawSize, self.remoteCaptureChunkSize)]
+        self.__remoteCapture = {"due": due, "chunks": chunks, "finish": finish}
+
+    def __remoteCaptureIsReady(self, request):
+        if self.__remoteCapture == None:
+            return (None, self.__response(request, CHDKPtpValues.ResponseCodes.OK, (CHDKPtpValues.CaptureFormats.ERROR, 0)))
+        formats = 0
+        if time.time() >= self.__remoteCapture["due"]:
+            for (captureFormat, chunks) in self.__remoteCapture["chunks"].items():
+                if len(chunks) > 0:
+                    formats |= captureFormat
+        return (None, self.__response(request, CHDKPtpValues.ResponseCodes.OK, (formats, self.shotCount)))
+
+    def __remoteCaptureGetData(self, request):
+        rc = self.__remoteCapture
+        if rc == None or time.time() < rc["due"] or len(rc["chunks"].get(request.params[1], ())) == 0:
+            return (None, self.__response(request, CHDKPtpValues.ResponseCodes.GeneralError))
+        chunks = rc["chunks"][request.params[1]]
+        (data, offset) = chunks.pop(0)
+        more = 1
+        if len(chunks) == 0:
+            more = CHDKPtpValues.CaptureFormats.LAST_CHUNK
+            if sum([len(c) for c in rc["chunks"].values()]) == 0:
+                # the shot is done, so is whatever was waiting on it
+                self.__remoteCapture = None
+                rc["finish"]()
+        return (data, self.__response(request, CHDKPtpValues.ResponseCodes.OK, (len(data), more, offset)))
+
+    def __getDisplayData(self, request):
+        self.displayCount += 1
+        (width, height) = self.viewportSize
+        vp_start = 0
+        pixels = ""
+        if request.params[1] & CHDKPtpValues.LiveViewFlags.VIEWPORT:
+            vp_start = LIVE_VIEW_HEADER.size
+            # a grey ramp across each group of 4 pixels
+            pixels = "\x00\x40\x00\x80\xc0\xff" * (width * height // 4)
+        data = bytearray(LIVE_VIEW_HEADER.pack(2, 1, 0, 0, 0, vp_start, 0))
+        if vp_start:
+            data += FRAMEBUFFER_DESC.pack(CHDKPtpValues.FramebufferTypes.YUV8, vp_start + FRAMEBUFFER_DESC.size, width, width, height, 0, 0, 0, 0)
+            data += pixels
+        return (data, self.__response(request, CHDKPtpValues.ResponseCodes.OK))
+
+    def __writeScriptMsg(self, request, message):
+        if self.__burst != None and request.params[1] == self.__burst["id"]:
+            self.messageCount += 1
+            return self.__burstGo(request, message)
+        if self.serverScriptId == None:
+            return self.__response(request, CHDKPtpValues.ResponseCodes.OK, (CHDKPtpValues.WriteMessageStatus.NOTRUN, ))
+        if request.params[1] != self.serverScriptId:
+            return self.__response(request, CHDKPtpValues.ResponseCodes.OK, (CHDKPtpValues.WriteMessageStatus.BADID, ))
+        self.messageCount += 1
+        if message == "quit":
+            self.scriptEnd = self.__commandsEnd
+            self.__scriptMessages.append((self.__commandsEnd, CHDKPtpValues.MessageTypes.RET, self.serverScriptId, ""))
+            self.serverScriptId = None
+            return self.__response(request, CHDKPtpValues.ResponseCodes.OK, (CHDKPtpValues.WriteMessageStatus.OK, ))
+        # commands are carried out one after another, as the script reads them
+        (seq, sep, chunk) = message.partition(" ")
+        self.__commandsEnd = max(time.time(), self.__commandsEnd) + self.messageDuration
+        if "init_usb_capture(" in chunk and "shoot()" in chunk:
+            # the reply waits until the host has fetched the image
+            serverScriptId = self.serverScriptId
+            def finish():
+                self.__commandsEnd = time.time()
+                self.__scriptMessages.append((self.__commandsEnd, CHDKPtpValues.MessageTypes.USER, serverScriptId, seq + " ok nil"))
+            self.__startRemoteCapture(chunk, self.__commandsEnd + self.shootDuration, finish)
+            return self.__response(request, CHDKPtpValues.ResponseCodes.OK, (CHDKPtpValues.WriteMessageStatus.OK, ))
+        if "shoot()" in chunk:
+            self.__commandsEnd += self.shootDuration + self.cardWriteDuration
+            self.shoot(self.__commandsEnd)
+        reply = seq + " ok nil"
+        if "error(" in chunk:
+            reply = seq + " err simulated error"
+        self.__scriptMessages.append((self.__commandsEnd, CHDKPtpValues.MessageTypes.USER, self.serverScriptId, reply))
+        return self.__response(request, CHDKPtpValues.ResponseCodes.OK, (CHDKPtpValues.WriteMessageStatus.OK, ))
+
+    def __readScriptMsg(self, request):
+        if len(self.__scriptMessages) == 0 or self.__scriptMessages[0][0] > time.time():
+            return (bytearray(), self.__response(request, CHDKPtpValues.ResponseCodes.OK, (CHDKPtpValues.MessageTypes.NONE, 0, 0, 0)))
+        (due, msgtype, scriptid, message) = self.__scriptMessages.pop(0)
+        # every message is sent as a string
+        return (bytearray(message), self.__response(request, CHDKPtpValues.ResponseCodes.OK, (msgtype, 4, scriptid, len(message))))
+
+    def __chdk(self, request):
+        if request.params[0] == CHDKPtpValues.Commands.ScriptStatus:
+            status = 0
+            if time.time() < self.scriptEnd:
+                status |= CHDKPtpValues.ScriptStatus.RUN
+            if len(self.__scriptMessages) > 0 and self.__scriptMessages[0][0] <= time.time():
+                status |= CHDKPtpValues.ScriptStatus.MSG
+            return (None, self.__response(request, CHDKPtpValues.ResponseCodes.OK, (status, )))
+        elif request.params[0] == CHDKPtpValues.Commands.ReadScriptMsg:
+            return self.__readScriptMsg(request)
+        elif request.params[0] == CHDKPtpValues.Commands.GetDisplayData:
+            return self.__getDisplayData(request)
+        elif request.params[0] == CHDKPtpValues.Commands.RemoteCaptureIsReady:
+            return self.__remoteCaptureIsReady(request)
+        elif request.params[0] == CHDKPtpValues.Commands.RemoteCaptureGetData:
+            return self.__remoteCaptureGetData(request)
+        return (None, self.__response(request, CHDKPtpValues.ResponseCodes.ParameterNotSupported))
+
+    def __getDevicePropDesc(self, request):
+        if request.params[0] not in self.properties:
+            return (None, self.__response(request, PtpValues.StandardResponses.DEVICE_PROP_NOT_SUPPORTED))
+        ((typeId, is_array, fmt), value) = self.properties[request.params[0]]
+        packer = PtpPacker()
+        packer.pack("<HHB", request.params[0], typeId, 1)
+        packer.pack_simpletype(is_array, fmt, value)
+        packer.pack_simpletype(is_array, fmt, value)
+        packer.pack("<B", 0)
+        return (bytearray(packer.data()), self.__response(request, PtpValues.StandardResponses.OK))
+
+    def __getDevicePropValue(self, request):
+        if request.params[0] not in self.properties:
+            return (None, self.__response(request, PtpValues.StandardResponses.DEVICE_PROP_NOT_SUPPORTED))
+        ((typeId, is_array, fmt), value) = self.properties[request.params[0]]
+        packer = PtpPacker()
+        packer.pack_simpletype(is_array, fmt, value)
+        return (bytearray(packer.data()), self.__response(request, PtpValues.StandardResponses.OK))
+
+    def __setDevicePropValue(self, request, data):
+        if request.params[0] not in self.properties:
+            return self.__response(request, PtpValues.StandardResponses.DEVICE_PROP_NOT_SUPPORTED)
+        (typeId, is_array, fmt) = self.properties[request.params[0]][0]
+        self.setProperty(request.params[0], PtpUnpacker(data).unpack_simpletype(is_array, fmt))
+        return self.__response(request, PtpValues.StandardResponses.OK)
+
+    def __openSession(self, request):
+        return (None, self.__response(request, PtpValues.StandardResponses.OK))
+
+    def __closeSession(self, request):
+        return (None, self.__response(request, PtpValues.StandardResponses.OK))
+
+    def __getDeviceInfo(self, request):
+        data = struct.pack("<HIH", 100, PtpValues.Vendors.CANON, 100) + _packString(u"CHDK simulator")
+        data += struct.pack("<H", 0)
+        data += _packArray("H", self.operationsSupported)
+        data += _packArray("H", self.eventsSupported)
+        data += _packArray("H", sorted(self.properties.keys()))
+        data += _packArray("H", (PtpValues.StandardObjectFormats.EXIF_JPEG, ))
+        data += _packArray("H", (PtpValues.StandardObjectFormats.EXIF_JPEG, ))
+        data += _packString(u"Canon Inc.") + _packString(unicode(self.model)) + _packString(u"1-1.0.0.0") + _packString(unicode(self.serialNumber))
+        return (bytearray(data), self.__response(request, PtpValues.StandardResponses.OK))
+
+    def __getStorageIDs(self, request):
+        return (bytearray(_packArray("I", (STORAGE_ID, ))), self.__response(request, PtpValues.StandardResponses.OK))
+
+    def __getObjectHandles(self, request):
+        return (bytearray(_packArray("I", sorted(self.objects.keys()))), self.__response(request, PtpValues.StandardResponses.OK))
+
+    def __getObjectInfo(self, request):
+        obj = self.objects.get(request.params[0])
+        if obj == None:
+            return (None, self.__response(request, PtpValues.StandardResponses.INVALID_OBJECT_HANDLE))
+        data = struct.pack("<IHHIHIIIIIIIHII", STORAGE_ID, PtpValues.StandardObjectFormats.EXIF_JPEG, 0, obj.size,
+                           PtpValues.StandardObjectFormats.JFIF, self.thumbSize, 160, 120, 4000, 3000, 24, 0, 0, 0, 0)
+        data += _packString(unicode(obj.filename)) + _packString(u"") + _packString(u"") + _packString(u"")
+        return (bytearray(data), self.__response(request, PtpValues.StandardResponses.OK))
+
+    def __getObject(self, request):
+        obj = self.objects.get(request.params[0])
+        if obj == None:
+            return (None, self.__response(request, PtpValues.StandardResponses.INVALID_OBJECT_HANDLE))
+        return (self.__payload(obj.size), self.__response(request, PtpValues.StandardResponses.OK))
+
+    def __getThumb(self, request):
+        if request.params[0] not in self.objects:
+            return (None, self.__response(request, PtpValues.StandardResponses.INVALID_OBJECT_HANDLE))
+        return (self.__payload(self.thumbSize), self.__response(request, PtpValues.StandardResponses.OK))
+
+    def __getPartialObject(self, request):
+        (handle, offset, count) = request.params
+        obj = self.objects.get(handle)
+        if obj == None:
+            return (None, self.__response(request, PtpValues.StandardResponses.INVALID_OBJECT_HANDLE))
+        count = max(0, min(count, obj.size - offset))
+        return (self.__payload(obj.size)[offset:offset + count], self.__response(request, PtpValues.StandardResponses.OK, (count, )))
+
+    def __deleteObject(self, request):
+        if self.objects.pop(request.params[0], None) == None:
+            return (None, self.__response(request, PtpValues.StandardResponses.INVALID_OBJECT_HANDLE))
+        return (None, self.__response(request, PtpValues.StandardResponses.OK))
+
+    __handlers = {PtpValues.StandardOperations.OPEN_SESSION: __openSession,
+                  PtpValues.StandardOperations.CLOSE_SESSION: __closeSession,
+                  PtpValues.StandardOperations.GET_DEVICE_INFO: __getDeviceInfo,
+                  PtpValues.StandardOperations.GET_STORAGE_IDS: __getStorageIDs,
+                  PtpValues.StandardOperations.GET_OBJECT_HANDLES: __getObjectHandles,
+                  PtpValues.StandardOperations.GET_OBJECT_INFO: __getObjectInfo,
+                  PtpValues.StandardOperations.GET_OBJECT: __getObject,
+                  PtpValues.StandardOperations.GET_THUMB: __getThumb,
+                  PtpValues.StandardOperations.GET_PARTIAL_OBJECT: __getPartialObject,
+                  PtpValues.StandardOperations.DELETE_OBJECT: __deleteObject,
+                  PtpValues.StandardOperations.GET_DEVICE_PROP_DESC: __getDevicePropDesc,
+                  PtpValues.StandardOperations.GET_DEVICE_PROP_VALUE: __getDevicePropValue,
+                  PtpValues.StandardOperations.SET_DEVICE_PROP_VALUE: __setDevicePropValue,
+                  CHDKPtpValues.CHDKOpcode: __chdk}
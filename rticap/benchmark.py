@@ -0,0 +1,493 @@
+'''
+benchmark - host side performance measurements which do not need a camera or dome attached
+
+usage:
+    python benchmark.py [name ...]
+
+with no names every benchmark is run
+
+@author: Michael Hodgson
+'''
+
+import sys
+import os
+import time
+import struct
+import shutil
+import tempfile
+import usb
+
+from ptp.PtpUsbTransport import PtpUsbTransport
+from ptp.PtpAbstractTransport import PtpRequest
+from ptp import PtpValues
+from ptp import PtpSession
+import domecontroller
+
+class FakeUsbEndpoint:
+    def __init__(self, type, address):
+        self.type = type
+        self.address = address
+        self.maxPacketSize = 512
+
+class FakeUsbInterface:
+    interfaceClass = PtpUsbTransport.USB_CLASS_PTP
+    endpoints = [FakeUsbEndpoint(usb.ENDPOINT_TYPE_BULK, 0x81),
+                 FakeUsbEndpoint(usb.ENDPOINT_TYPE_BULK, 0x02),
+                 FakeUsbEndpoint(usb.ENDPOINT_TYPE_INTERRUPT, 0x83)]
+
+class FakeUsbConfiguration:
+    interfaces = [[FakeUsbInterface()]]
+
+class FakeUsbHandle:
+    """Mimics a legacy pyusb device handle, serving a single GetObject data phase and response
+    in packets of whatever size the transport asks for"""
+
+    def __init__(self, payloadSize):
+        self.payloadSize = payloadSize
+        self.rewind(1)
+
+    def rewind(self, transactionid):
+        self.written = 0
+        self.writes = 0
+        header = struct.pack("<IHHI", 12 + self.payloadSize, PtpUsbTransport.PTP_USB_CONTAINER_DATA, PtpValues.StandardOperations.GET_OBJECT, transactionid)
+        response = struct.pack("<IHHI", 12, PtpUsbTransport.PTP_USB_CONTAINER_RESPONSE, PtpValues.StandardResponses.OK, transactionid)
+        # hold each container as a tuple of ints, which is what legacy pyusb returns from bulkRead
+        self.containers = [tuple(ord(c) for c in header + ('\xa5' * self.payloadSize)), tuple(ord(c) for c in response)]
+        self.offset = 0
+
+    def setConfiguration(self, configuration):
+        pass
+
+    def claimInterface(self, interface):
+        pass
+
+    def releaseInterface(self, interface):
+        pass
+
+    def bulkWrite(self, ep, data, timeout):
+        self.written += len(data)
+        self.writes += 1
+        return len(data)
+
+    def bulkRead(self, ep, size, timeout):
+        # a transfer never crosses a container boundary, as the device ends each one with a short packet
+        if len(self.containers) == 0:
+            return ()
+        pkt = self.containers[0][self.offset:self.offset + size]
+        self.offset += len(pkt)
+        if self.offset == len(self.containers[0]):
+            self.containers.pop(0)
+            self.offset = 0
+        return pkt
+
+class FakeUsbDevice:
+    deviceClass = 0
+    configurations = [FakeUsbConfiguration()]
+
+    def __init__(self, payloadSize):
+        self.handle = FakeUsbHandle(payloadSize)
+
+    def open(self):
+        return self.handle
+
+class NullStream:
+    def write(self, data):
+        pass
+
+def _legacyGetData(handle, urb_size=512):
+    """The receive loop as it was before the zero copy path, kept here as the baseline to compare against"""
+    pkt = ''.join([chr(x) for x in handle.bulkRead(0x81, urb_size, 5000)])
+    (data_size, container_type, code, transactionid) = struct.unpack("<IHHI", pkt[0:12])
+    data_size -= 12
+    buffer = pkt[12:12 + min(len(pkt) - 12, data_size)]
+    done = len(buffer)
+    while done != data_size:
+        pkt = ''.join([chr(x) for x in handle.bulkRead(0x81, urb_size, 5000)])
+        toread = min(len(pkt), data_size - done)
+        buffer += pkt[0:toread]
+        done += toread
+    return (data_size, buffer)
+
+def _report(name, nbytes, seconds):
+    print "%-40s %8.2f MB/s" % (name, (nbytes / (1024.0 * 1024.0)) / seconds)
+
+def benchmarkGetObject(payloadSize=5 * 1024 * 1024, repeats=3, readSizes=(512, 64 * 1024, 1024 * 1024)):
+    """Measures host side throughput of receiving a GetObject data phase, before and after the zero copy path,
+    and at each of the given bulk read sizes"""
+    device = FakeUsbDevice(payloadSize)
+    transport = PtpUsbTransport(device)
+
+    best = None
+    for i in range(repeats):
+        device.handle.rewind(1)
+        start = time.time()
+        _legacyGetData(device.handle)
+        elapsed = time.time() - start
+        best = elapsed if best == None else min(best, elapsed)
+    _report("GetObject legacy (string)", payloadSize, best)
+
+    for readSize in readSizes:
+        transport.set_bulk_read_size(readSize)
+        for (name, stream) in (("GetObject to memory", None), ("GetObject to stream", NullStream())):
+            best = None
+            for i in range(repeats):
+                device.handle.rewind(1)
+                request = PtpRequest(PtpValues.StandardOperations.GET_OBJECT, 1, 1, (1, ))
+                start = time.time()
+                transport.get_ptp_data(request, stream)
+                transport.get_ptp_response(request)
+                elapsed = time.time() - start
+                best = elapsed if best == None else min(best, elapsed)
+            _report("%s, %i byte reads" % (name, readSize), payloadSize, best)
+
+def benchmarkSendData(payloadSize=5 * 1024 * 1024, repeats=3, writeSizes=(64 * 1024, 1024 * 1024)):
+    """Measures host side throughput of sending a SendObject data phase from a string, a file and an iterator
+    of small chunks, at each of the given bulk write sizes"""
+    device = FakeUsbDevice(0)
+    transport = PtpUsbTransport(device)
+    payload = '\xa5' * payloadSize
+    source = tempfile.TemporaryFile()
+    source.write(payload)
+
+    for writeSize in writeSizes:
+        transport.set_bulk_write_size(writeSize)
+        sources = (("from string", lambda: payload),
+                   ("from file", lambda: (source.seek(0), source)[1]),
+                   ("from 4K chunks", lambda: (payload[i:i + 4096] for i in xrange(0, payloadSize, 4096))))
+        for (name, makeData) in sources:
+            best = None
+            for i in range(repeats):
+                data = makeData()
+                device.handle.rewind(1)
+                request = PtpRequest(PtpValues.StandardOperations.SEND_OBJECT, 1, 1)
+                start = time.time()
+                transport.send_ptp_data(request, data, payloadSize)
+                elapsed = time.time() - start
+                best = elapsed if best == None else min(best, elapsed)
+            _report("SendObject %s, %i byte writes" % (name, writeSize), payloadSize, best)
+    source.close()
+
+class _LegacyUnpacker:
+    """PtpUnpacker as it was before it read through a memoryview with compiled structs, kept as the baseline"""
+    def __init__(self, raw):
+        self.raw = raw
+        self.offset = 0
+
+    def unpack(self, fmt):
+        fmtsize = struct.calcsize(fmt)
+        result = struct.unpack(fmt, self.raw[self.offset:self.offset + fmtsize])
+        self.offset += fmtsize
+        return result
+
+    def unpack_string(self):
+        strLen = ord(self.raw[self.offset])
+        self.offset += 1
+        result = self.raw[self.offset:self.offset + (strLen * 2)].decode('UTF-16-LE')
+        self.offset += strLen * 2
+        if result[-1:] == '\0':
+            result = result[:-1]
+        return result
+
+    def unpack_array(self, fmt):
+        (arrayCount, ) = struct.unpack("<I", self.raw[self.offset:self.offset + 4])
+        self.offset += 4
+        fmtsize = struct.calcsize(fmt)
+        result = struct.unpack("<%i%s" % (arrayCount, fmt), self.raw[self.offset:self.offset + (fmtsize * arrayCount)])
+        self.offset += arrayCount * fmtsize
+        return result
+
+    def unpack_simpletype(self, is_array, fmt):
+        if fmt == "_STR":
+            return self.unpack_string()
+        if is_array:
+            return self.unpack_array(fmt)
+        return self.unpack("<" + fmt)[0]
+
+    def unpack_simpletypes(self, fmt, count):
+        # enumerations were built up a value at a time
+        result = ()
+        while count:
+            result += (self.unpack_simpletype(False, fmt), )
+            count -= 1
+        return result
+
+def _sampleDatasets():
+    """Returns a list of (name, parser class, raw dataset) for the parsing benchmark"""
+    from CHDKPtpSim import _packString, _packArray
+    deviceInfo = struct.pack("<HIH", 100, PtpValues.Vendors.CANON, 100) + _packString(u"CHDK simulator") + struct.pack("<H", 0)
+    deviceInfo += _packArray("H", range(0x1001, 0x1020) + range(0x9001, 0x9080)) + _packArray("H", range(0x4001, 0x400e))
+    deviceInfo += _packArray("H", range(0x5001, 0x5020) + range(0xd001, 0xd040)) + _packArray("H", (0x3801, )) + _packArray("H", (0x3801, 0x3000))
+    deviceInfo += _packString(u"Canon Inc.") + _packString(u"Canon PowerShot SX200 IS") + _packString(u"1-1.0.0.0") + _packString(u"0123456789abcdef")
+
+    objectInfo = struct.pack("<IHHIHIIIIIIIHII", 0x00010001, 0x3801, 0, 4 * 1024 * 1024, 0x3808, 8192, 160, 120, 4000, 3000, 24, 0, 0, 0, 0)
+    objectInfo += _packString(u"IMG_0001.JPG") + _packString(u"20110312T120000.0") + _packString(u"20110312T120000.0") + _packString(u"")
+
+    enumInfo = struct.pack("<HHBHHBH", 0x500e, 0x0004, 1, 0, 1, 2, 64) + struct.pack("<64H", *range(64))
+    strInfo = struct.pack("<HHB", 0x5011, 0xffff, 1) + _packString(u"20110312T120000.0") * 2 + struct.pack("<B", 0)
+    return [("DeviceInfo", PtpSession.PtpDeviceInfo, deviceInfo),
+            ("ObjectInfo", PtpSession.PtpObjectInfo, objectInfo),
+            ("PropInfo, 64 value enumeration", PtpSession.PtpDevicePropertyInfo, enumInfo),
+            ("PropInfo, string", PtpSession.PtpDevicePropertyInfo, strInfo)]
+
+def benchmarkParse(iterations=20000, repeats=5):
+    """Measures parsing of the datasets making up most PTP traffic other than images, with the current
+    unpacker and the one it replaced"""
+    for (name, parser, raw) in _sampleDatasets():
+        for (label, unpacker) in (("legacy", _LegacyUnpacker), ("current", PtpSession.PtpUnpacker)):
+            saved = PtpSession.PtpUnpacker
+            PtpSession.PtpUnpacker = unpacker
+            try:
+                # best of several runs, a single run is at the mercy of whatever else the machine is doing
+                elapsed = None
+                for run in range(repeats):
+                    start = time.time()
+                    for i in xrange(iterations):
+                        parser(raw)
+                    elapsed = min(elapsed, time.time() - start) if elapsed != None else time.time() - start
+            finally:
+                PtpSession.PtpUnpacker = saved
+            print "%-40s %8.2f us" % ("%s %s" % (name, label), elapsed * 1e6 / iterations)
+
+class NullDomeController:
+    """Stands in for domecontroller.DomeController, switching LEDs takes no time"""
+    def __init__(self):
+        self.currentLED = 0
+
+    def activateLED(self, ledIndex):
+        pass
+
+    def nextLED(self):
+        self.currentLED = (self.currentLED + 1) % 64
+
+    def resetSequenceClearLEDs(self):
+        self.currentLED = 0
+
+    def activateAllLEDs(self):
+        self.currentLED = 0
+
+def benchmarkCaptureSequence(objectSize=4 * 1024 * 1024, downloadAfter=True, **simulatorArgs):
+    """Runs RTICapModel.doCaptureSequence end to end against a simulated CHDK camera"""
+    # rticapapp needs PySide, only pull it in for this benchmark
+    import rticapapp
+    import CHDKPtp
+    import CHDKPtpSim
+
+    model = rticapapp.RTICapModel()
+    model.cam = CHDKPtp.CHDKPtpCapture()
+    model.cam.connect(calibrate=False, transport=CHDKPtpSim.CHDKSimulatedTransport(objectSize=objectSize, **simulatorArgs))
+    model.domeController = NullDomeController()
+
+    savePath = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        model.doCaptureSequence(savePath, downloadAfter=downloadAfter, autofocus=False, downloadUpdateCallback=lambda capNo, totalCaps, path: None)
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(savePath)
+    total = model.getTotalCapCount()
+    print "%-40s %8.2f s (%.3f s per shot)" % ("capture sequence of %i" % total, elapsed, elapsed / total)
+    _report("capture sequence download", objectSize * total, elapsed)
+
+def benchmarkCommands(shots=10, scriptStartDelays=(0, 0.03, 0.1), **simulatorArgs):
+    """Measures the time per shot of capture() (which switches to shooting mode first if need be) running each
+    script on its own and as commands to a CHDKCommandServer, against a simulated CHDK camera taking each of
+    scriptStartDelays seconds to compile and start a script"""
+    import CHDKPtp
+    import CHDKPtpSim
+
+    simulatorArgs.setdefault("shootDuration", 0.05)
+    for scriptStartDelay in scriptStartDelays:
+        for useCommandServer in (False, True):
+            sim = CHDKPtpSim.CHDKSimulatedTransport(scriptResponseDelay=scriptStartDelay, **simulatorArgs)
+            cam = CHDKPtp.CHDKPtpCapture()
+            cam.connect(calibrate=False, bulkReadSize=64 * 1024, useCommandServer=useCommandServer, transport=sim)
+            start = time.time()
+            for i in range(shots):
+                cam.capture()
+            elapsed = time.time() - start
+            label = "%s, %i ms start" % ("command server" if useCommandServer else "script each", scriptStartDelay * 1000)
+            print "%-40s %8.3f s per shot (%.1f scripts/commands per shot)" % ("capture, " + label, elapsed / shots,
+                                                                             (sim.scriptCount + sim.messageCount) / float(shots))
+            cam.eventPump.stop()
+
+def benchmarkRemoteCapture(shots=10, objectSize=4 * 1024 * 1024, **simulatorArgs):
+    """Measures the time per shot of getting an image onto the host with capture() then downloading and deleting
+    it from the card, against captureToFile() streaming it straight from the camera's memory, against a
+    simulated CHDK camera"""
+    import CHDKPtp
+    import CHDKPtpSim
+
+    simulatorArgs.setdefault("shootDuration", 0.05)
+    # roughly what saving a 4 MB jpeg to an SD card costs
+    simulatorArgs.setdefault("cardWriteDuration", 0.2)
+    savePath = tempfile.mkdtemp()
+    try:
+        for useRemoteCapture in (False, True):
+            sim = CHDKPtpSim.CHDKSimulatedTransport(objectSize=objectSize, **simulatorArgs)
+            cam = CHDKPtp.CHDKPtpCapture()
+            cam.connect(calibrate=False, bulkReadSize=64 * 1024, useCommandServer=True, useRemoteCapture=useRemoteCapture, transport=sim)
+            start = time.time()
+            for i in range(shots):
+                imgpath = os.path.join(savePath, str(i) + ".jpg")
+                if useRemoteCapture:
+                    cam.captureToFile(imgpath)
+                else:
+                    objectid = cam.capture()
+                    cam.downloadAndSaveObject(objectid, imgpath)
+                    cam.deleteObject(objectid)
+            elapsed = time.time() - start
+            label = "captureToFile" if useRemoteCapture else "capture, download and delete"
+            print "%-40s %8.3f s per shot" % (label, elapsed / shots)
+            _report(label, objectSize * shots, elapsed)
+            cam.eventPump.stop()
+    finally:
+        shutil.rmtree(savePath)
+
+def benchmarkBurst(shots=16, ledSettle=0.02, **simulatorArgs):
+    """Measures the time per frame of stepping the LEDs and shooting with capture() through a CHDKCommandServer,
+    against a burst shot from one script on the camera, against a simulated CHDK camera"""
+    import CHDKPtp
+    import CHDKPtpSim
+
+    simulatorArgs.setdefault("shootDuration", 0.05)
+    simulatorArgs.setdefault("cardWriteDuration", 0.2)
+    def nextLED(frame=None):
+        time.sleep(ledSettle)
+    for useBurst in (False, True):
+        sim = CHDKPtpSim.CHDKSimulatedTransport(**simulatorArgs)
+        cam = CHDKPtp.CHDKPtpCapture()
+        cam.connect(calibrate=False, bulkReadSize=64 * 1024, useCommandServer=True, transport=sim)
+        cam.activateShootingMode()
+        start = time.time()
+        if useBurst:
+            cam.startBurst(shots)
+            for i in range(shots):
+                nextLED()
+                cam.triggerBurstFrame()
+                cam.waitForBurstExposure()
+            # the LEDs are done with here, the camera may still be saving
+            exposed = time.time() - start
+            cam.finishBurst()
+        else:
+            for i in range(shots):
+                nextLED()
+                cam.capture()
+            exposed = time.time() - start
+        elapsed = time.time() - start
+        label = "burst" if useBurst else "capture per frame"
+        print "%-40s %8.3f s per frame under the LEDs, %.3f s per frame saved (exposure + LED settle %.3f s)" % (
+            label, exposed / shots, elapsed / shots, simulatorArgs["shootDuration"] + ledSettle)
+        cam.eventPump.stop()
+
+def benchmarkLiveView(frames=20, **simulatorArgs):
+    """Measures the time per preview of getting and decoding a live view frame, against shooting, downloading and
+    deleting a full image as the capture preview used to, against a simulated CHDK camera"""
+    import CHDKPtp
+    import CHDKPtpSim
+
+    sim = CHDKPtpSim.CHDKSimulatedTransport(**simulatorArgs)
+    cam = CHDKPtp.CHDKPtpCapture()
+    cam.connect(calibrate=False, bulkReadSize=64 * 1024, useCommandServer=True, transport=sim)
+    cam.activateShootingMode()
+    savePath = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        objectid = cam.capture()
+        cam.downloadAndSaveObject(objectid, os.path.join(savePath, "temp.jpg"))
+        cam.deleteObject(objectid)
+        print "%-40s %8.3f s per preview" % ("full capture", time.time() - start)
+    finally:
+        shutil.rmtree(savePath)
+    start = time.time()
+    for i in range(frames):
+        cam.getLiveViewFrame()
+    elapsed = time.time() - start
+    print "%-40s %8.3f s per preview (%.1f frames/s)" % ("live view", elapsed / frames, frames / elapsed)
+    cam.eventPump.stop()
+
+class _LegacyDomeController(domecontroller.DomeController):
+    """DomeController as it was before its frames were made up front and sent in one write, kept as the baseline"""
+    def activateLED(self, ledIndex):
+        seg = ledIndex // 8
+        bitPos = ledIndex % 8
+        ledData = []
+        for iSeg in range(8):
+            byteString = ''
+            for iLed in range(8):
+                if iLed == bitPos and iSeg == seg:
+                    byteString += '1'
+                else:
+                    byteString += '0'
+            ledData.append(chr(int(byteString, 2)))
+        self.sendLEDData(ledData)
+
+    def sendLEDData(self, data):
+        ser = self.ser
+        ser.flushInput()
+        ser.write(chr(int('0x42', 16)))
+        for d in data:
+            ser.write(d)
+        while ser.read(1) != chr(int('0x01', 16)):
+            pass
+
+def _fakeDome(masterfd):
+    """Acknowledges each frame written to the other end of a pty as the dome does, returns the frames it got"""
+    frames = []
+    pending = ""
+    while True:
+        try:
+            data = os.read(masterfd, 64)
+        except OSError:
+            return frames
+        if data == "":
+            return frames
+        pending += data
+        while len(pending) >= len(domecontroller.ALL_LEDS_ON_FRAME):
+            frames.append(pending[:len(domecontroller.ALL_LEDS_ON_FRAME)])
+            pending = pending[len(domecontroller.ALL_LEDS_ON_FRAME):]
+            os.write(masterfd, domecontroller.ACK)
+
+def benchmarkDome(switches=640):
+    """Measures the round trip of switching to the next LED and waiting for the dome's acknowledgement, through a
+    pty standing in for the dome's serial port"""
+    import pty
+    import threading
+    import serial
+
+    for (label, controllerClass) in (("legacy", _LegacyDomeController), ("current", domecontroller.DomeController)):
+        (masterfd, slavefd) = pty.openpty()
+        ser = serial.Serial(os.ttyname(slavefd), 9600)
+        dome = controllerClass(ser=ser, startupDelay=0)
+        frames = []
+        thread = threading.Thread(target=lambda: frames.extend(_fakeDome(masterfd)))
+        thread.setDaemon(True)
+        thread.start()
+        start = time.time()
+        for i in range(switches):
+            dome.nextLED()
+        elapsed = time.time() - start
+        ser.close()
+        os.close(slavefd)
+        os.close(masterfd)
+        thread.join(1.0)
+        if frames[:domecontroller.LED_COUNT] != list(domecontroller.SINGLE_LED_FRAMES):
+            raise Exception(label + " dome controller sent the wrong frames")
+        print "%-40s %8.1f us per LED switch" % ("dome, " + label, elapsed / switches * 1e6)
+
+benchmarks = {"getobject": benchmarkGetObject,
+              "senddata": benchmarkSendData,
+              "parse": benchmarkParse,
+              "commands": benchmarkCommands,
+              "burst": benchmarkBurst,
+              "liveview": benchmarkLiveView,
+              "dome": benchmarkDome,
+              "remotecapture": benchmarkRemoteCapture,
+              "capturesequence": benchmarkCaptureSequence}
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    if len(names) == 0:
+        names = sorted(benchmarks.keys())
+    for name in names:
+        print name
+        benchmarks[name]()
@@ -8,76 +8,80 @@ import serial
 import time
 import logging
 
+LED_COUNT = 64
+LED_COMMAND = chr(0x42) # starts every frame, followed by a byte for each segment of 8 LEDs
+ACK = chr(0x01) # sent back by the dome once it has set the LEDs
+
+def _makeFrame(ledData):
+    """Returns the frame setting the LEDs to ledData, 8 bytes, one per segment with its first LED in the top bit"""
+    if len(ledData) != 8:
+        raise Exception("LED Data not correct length")
+    return LED_COMMAND + "".join(ledData)
+
+def _makeSingleLEDFrame(ledIndex):
+    seg = ledIndex // 8
+    bitPos = ledIndex % 8
+    return _makeFrame([chr(0x80 >> bitPos) if iSeg == seg else chr(0x00) for iSeg in range(8)])
+
+# every frame we send, made once rather than each time an LED changes
+SINGLE_LED_FRAMES = tuple([_makeSingleLEDFrame(ledIndex) for ledIndex in range(LED_COUNT)])
+ALL_LEDS_ON_FRAME = _makeFrame([chr(0xFF)] * 8)
+ALL_LEDS_OFF_FRAME = _makeFrame([chr(0x00)] * 8)
+
 class DomeController:
-    def __init__(self):
+    def __init__(self, port='/dev/ttyUSB0', ser=None, startupDelay=1.5):
+        """params:
+            port - serial port the dome is on
+            ser - an already open serial port (or anything with its read/write/flushInput) to use instead of port
+            startupDelay - seconds to wait after opening the port before sending anything"""
         self.currentLED = 0
-        self.ser = serial.Serial('/dev/ttyUSB0', 9600)
+        if ser == None:
+            ser = serial.Serial(port, 9600)
+        self.ser = ser
         # if we try to send data before this delay bytes get lost for some reason
-        time.sleep(1.5) 
-        
+        time.sleep(startupDelay)
+
     def activateLED(self, ledIndex):
         """Activate the single LED given by the ledIndex, NB: The index starts at 0
         ie first LED = 0"""
-        if ledIndex >= 64:
+        if ledIndex >= LED_COUNT or ledIndex < 0:
             raise Exception("LED index out of bounds")
-        seg = ledIndex // 8
-        bitPos = ledIndex % 8
-        ledData = []
-        for iSeg in range(8):
-            byteString = ''
-            for iLed in range(8):
-                #if iSeg == seg and iLed == bitPos:
-                if iLed == bitPos and iSeg == seg:
-                    byteString += '1'
-                else:
-                    byteString += '0'
-            ledData.append(chr(int(byteString, 2)))
-        self.sendLEDData(ledData)
+        self.sendFrame(SINGLE_LED_FRAMES[ledIndex])
 
     def nextLED(self):
         #time.sleep(0.5)
         self.activateLED(self.currentLED)
         self.currentLED += 1
-        if self.currentLED >= 64:
+        if self.currentLED >= LED_COUNT:
             self.currentLED = 0
 
     def resetSequenceClearLEDs(self):
         self.currentLED = 0
-        ledData = []
-        for i in range(8):
-            ledData.append(chr(int('0x00', 16)))
-        self.sendLEDData(ledData)
-            
+        self.sendFrame(ALL_LEDS_OFF_FRAME)
+
     def activateAllLEDs(self):
         self.currentLED = 0
-        ledData = []
-        for i in range(8):
-            ledData.append(chr(int('0xFF', 16)))
-        self.sendLEDData(ledData)
-           
-    
+        self.sendFrame(ALL_LEDS_ON_FRAME)
+
+
     def sendLEDData(self, data):
+        """Sets the LEDs to data, a sequence of 8 single character strings, one per segment"""
+        self.sendFrame(_makeFrame(data))
+
+    def sendFrame(self, frame):
+        """Sends a whole frame (see SINGLE_LED_FRAMES) in one write, and waits for the dome to acknowledge it"""
         ser = self.ser
         ser.flushInput()
-        if len(data) != 8:
-            raise Exception("LED Data not correct length")
-        #time.sleep(1.5)
-        #ser.flush()
-        ser.write(chr(int('0x42', 16)))
-        #ser.flush()
-        for d in data:
-            #time.sleep(2)
-            ser.write(d)
-            #ser.flush()
+        ser.write(frame)
         logging.debug("awaiting response...")
-        while ser.read(1) != chr(int('0x01', 16)):
+        while ser.read(1) != ACK:
             pass
-        logging.debug("response received")  
+        logging.debug("response received")
 
     def close(self):
         self.ser.close()
-        
+
 if __name__ == '__main__':
     dc = DomeController()
     while True:
-        dc.nextLED()
\ No newline at end of file
+        dc.nextLED()
@@ -16,10 +16,8 @@ class NikonCurveInfo:
         (data_length, unknown, self.xaxis_start, self.xaxis_end, self.yaxis_start, self.yaxis_end,
         self.midpoint_integer, self.midpoint_decimal, coordcount) = unpacker.unpack("<IHBBBBBBB")
         
-        self.coordinates = ()
-        while coordcount:
-            self.coordinates += (unpacker.unpack("<BB"), )
-            coordcount -= 1
+        values = unpacker.unpack_values("B", coordcount * 2)
+        self.coordinates = tuple(zip(values[0::2], values[1::2]))
         
         # FIXME: The rest of the file contents are unknown
         
@@ -28,12 +26,11 @@ class NikonCurveInfo:
         
         packer.pack("<IHBBBBBBB", 2116, 24393, self.xaxis_start, self.xaxis_end, self.yaxis_start, self.yaxis_end,
                     self.midpoint_integer, self.midpoint_decimal, len(self.coordinates))
-        for c in self.coordinates:
-            packer.pack("<BB", c[0], c[1])
+        packer.pack_values("BB", [value for c in self.coordinates for value in (c[0], c[1])])
         
         # FIXME: The rest of the file is unknown
         
-        return packer.raw
+        return packer.data()
 
 
 # Values for DisableBodyControls
@@ -87,11 +84,8 @@ def CheckEvents(session):
         raise PtpSession.PtpException(ptp_response.respcode)
     
     unpacker = PtpSession.PtpUnpacker(rx[1])
-    events = ()
-    for i in xrange(0, unpacker.unpack("<H")[0]):
-        (code, param) = unpacker.unpack("<HI")
-        events += (PtpAbstractTransport.PtpEvent(code, 0xffffffff, 0xffffffff, (param, )), )
-    return events
+    values = unpacker.unpack_values("HI", unpacker.unpack("<H")[0])
+    return tuple([PtpAbstractTransport.PtpEvent(code, 0xffffffff, 0xffffffff, (param, )) for (code, param) in zip(values[0::2], values[1::2])])
 
 def PollStatus(session):
     """Poll the status of the device (e.g. for monitoring ASYNC operations such as autofocus or capture).
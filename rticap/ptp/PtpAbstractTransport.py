@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
+import array
 import struct
+import threading
+import time
+import PtpValues
 
 
 class PtpRequest:
@@ -50,13 +54,419 @@ class PtpEvent:
         return tmp
 
 
+class PtpOperationStats:
+    """Class holding the statistics gathered for one operation by PtpTransportMetrics."""
+
+    def __init__(self, histogram_size):
+        self.count = 0
+        self.latency_total = 0.0
+        self.latency_min = None
+        self.latency_max = 0.0
+        self.histogram = [0] * histogram_size
+        self.data_phases = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.data_in_seconds = 0.0
+        self.transfers = 0 # data-in phases timed, and their MB/s
+        self.rate_total = 0.0
+        self.rate_min = None
+        self.rate_max = 0.0
+
+    def mean_latency(self):
+        if self.count == 0:
+            return 0.0
+        return self.latency_total / self.count
+
+    def mean_rate(self):
+        if self.transfers == 0:
+            return 0.0
+        return self.rate_total / self.transfers
+
+
+class PtpTransportMetrics:
+    """Class gathering per-operation statistics at the boundaries of a PtpAbstractTransport.
+    
+    Operations are keyed by opcode, or by (opcode, first parameter) for opcodes listed in
+    subcommand_opcodes (e.g. CHDK, whose one opcode carries many commands)."""
+
+    # Upper bounds in milliseconds of the latency histogram buckets, the last bucket holds everything slower
+    HISTOGRAM_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.subcommand_opcodes = set()
+        self.__lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Forget everything gathered so far."""
+        
+        self.__lock.acquire()
+        try:
+            self.operations = {}
+            self.retry_count = 0
+            self.retry_seconds = 0.0
+            self.resync_count = 0
+            self.resync_bytes = 0
+            self.script_wait_count = 0
+            self.script_wait_seconds = 0.0
+            self.script_wait_max = 0.0
+            self.stream_write_seconds = 0.0
+            self.__pending = {}
+        finally:
+            self.__lock.release()
+
+    def key(self, request):
+        if request.opcode in self.subcommand_opcodes and len(request.params) > 0:
+            return (request.opcode, request.params[0])
+        return request.opcode
+
+    def begin(self, request):
+        """Note a request going out, unless this transaction has already been started."""
+        
+        self.__lock.acquire()
+        try:
+            if request.transactionid in self.__pending:
+                return
+            key = self.key(request)
+            self.__stats(key).count += 1
+            self.__pending[request.transactionid] = (time.time(), key)
+        finally:
+            self.__lock.release()
+
+    def end(self, request):
+        """Note the response to a request arriving."""
+        
+        self.__lock.acquire()
+        try:
+            pending = self.__pending.pop(request.transactionid, None)
+            if pending == None:
+                return
+            (start, key) = pending
+            latency = time.time() - start
+            stats = self.__stats(key)
+            stats.latency_total += latency
+            if stats.latency_min == None or latency < stats.latency_min:
+                stats.latency_min = latency
+            stats.latency_max = max(stats.latency_max, latency)
+            bucket = 0
+            while bucket < len(self.HISTOGRAM_BOUNDS) and latency * 1000 > self.HISTOGRAM_BOUNDS[bucket]:
+                bucket += 1
+            stats.histogram[bucket] += 1
+        finally:
+            self.__lock.release()
+
+    def data_out(self, request, size):
+        self.__lock.acquire()
+        try:
+            stats = self.__stats(self.key(request))
+            stats.data_phases += 1
+            stats.bytes_out += size
+        finally:
+            self.__lock.release()
+
+    def data_in(self, request, size, seconds):
+        self.__lock.acquire()
+        try:
+            stats = self.__stats(self.key(request))
+            stats.data_phases += 1
+            stats.bytes_in += size
+            stats.data_in_seconds += seconds
+            if size > 0 and seconds > 0:
+                rate = size / (seconds * 1024.0 * 1024.0)
+                stats.transfers += 1
+                stats.rate_total += rate
+                if stats.rate_min == None or rate < stats.rate_min:
+                    stats.rate_min = rate
+                stats.rate_max = max(stats.rate_max, rate)
+        finally:
+            self.__lock.release()
+
+    def retry(self, seconds):
+        """Note time lost to a failed read which is going to be (or has been) retried."""
+        
+        self.__lock.acquire()
+        try:
+            self.retry_count += 1
+            self.retry_seconds += seconds
+        finally:
+            self.__lock.release()
+
+    def resync(self, discarded):
+        """Note a session getting back in step with its device, throwing away discarded bytes."""
+
+        self.__lock.acquire()
+        try:
+            self.resync_count += 1
+            self.resync_bytes += discarded
+        finally:
+            self.__lock.release()
+
+    def script_wait(self, seconds):
+        """Note time spent waiting for a script on the device (e.g. CHDK's) to finish, once per script."""
+
+        self.__lock.acquire()
+        try:
+            self.script_wait_count += 1
+            self.script_wait_seconds += seconds
+            self.script_wait_max = max(self.script_wait_max, seconds)
+        finally:
+            self.__lock.release()
+
+    def stream_write(self, seconds):
+        self.__lock.acquire()
+        try:
+            self.stream_write_seconds += seconds
+        finally:
+            self.__lock.release()
+
+    def report(self, vendorId=0):
+        """Returns: The statistics gathered as a printable table."""
+        
+        lines = ["%-32s %6s %9s %9s %9s %12s %8s %20s  %s" % ("operation", "count", "mean ms", "min ms", "max ms", "bytes", "MB/s",
+                                                              "MB/s per transfer",
+                                                         "latency histogram (ms <= " + ",".join([str(b) for b in self.HISTOGRAM_BOUNDS]) + ",more)")]
+        self.__lock.acquire()
+        try:
+            for key in sorted(self.operations.keys()):
+                stats = self.operations[key]
+                if isinstance(key, tuple):
+                    name = "%s/%i" % (PtpValues.OperationNameById(key[0], vendorId), key[1])
+                else:
+                    name = PtpValues.OperationNameById(key, vendorId)
+                rate = ""
+                if stats.data_in_seconds > 0:
+                    rate = "%.2f" % (stats.bytes_in / (stats.data_in_seconds * 1024.0 * 1024.0))
+                rates = ""
+                if stats.transfers > 0:
+                    # min/mean/max over the data-in phases, so one slow GetObject stands out from the total
+                    rates = "%.1f/%.1f/%.1f" % (stats.rate_min, stats.mean_rate(), stats.rate_max)
+                lines.append("%-32s %6i %9.1f %9.1f %9.1f %12i %8s %20s  %s" % (name, stats.count, stats.mean_latency() * 1000,
+                                                                               (stats.latency_min or 0) * 1000, stats.latency_max * 1000,
+                                                                               stats.bytes_in + stats.bytes_out, rate, rates,
+                                                                               " ".join([str(c) for c in stats.histogram])))
+            lines.append("retries: %i taking %.3f s, writing to streams: %.3f s" % (self.retry_count, self.retry_seconds, self.stream_write_seconds))
+            if self.resync_count > 0:
+                lines.append("resyncs: %i discarding %i bytes" % (self.resync_count, self.resync_bytes))
+            if self.script_wait_count > 0:
+                lines.append("script waits: %i, mean %.1f ms, max %.1f ms, total %.3f s" % (self.script_wait_count,
+                             self.script_wait_seconds * 1000 / self.script_wait_count, self.script_wait_max * 1000, self.script_wait_seconds))
+        finally:
+            self.__lock.release()
+        return "\n".join(lines)
+
+    def __stats(self, key):
+        stats = self.operations.get(key)
+        if stats == None:
+            stats = PtpOperationStats(len(self.HISTOGRAM_BOUNDS) + 1)
+            self.operations[key] = stats
+        return stats
+
+
+class _TimedStream:
+    """Passes writes through to a stream, adding the time they take to a PtpTransportMetrics."""
+
+    def __init__(self, stream, metrics):
+        self.stream = stream
+        self.metrics = metrics
+
+    def write(self, data):
+        start = time.time()
+        self.stream.write(data)
+        self.metrics.stream_write(time.time() - start)
+
+
+
+class PtpDataReader:
+    """Class handing out the data of an outbound data phase in pieces, so a large payload can be sent
+    without first joining it into one string.
+
+    The data may be a string (or anything else supporting the buffer interface), a file, or an
+    iterable of strings. Unicode is sent UTF-8 encoded."""
+
+    def __init__(self, data, size=None):
+        """Create a new PtpDataReader instance.
+
+        Arguments:
+        data -- The data to send.
+        size -- Number of bytes to send. If None it is worked out from data: the length of a
+                string, what is left of a file after its current position, or the total length of
+                an iterable's strings (which then have to be read up front)."""
+
+        if isinstance(data, unicode):
+            data = data.encode("UTF-8")
+        if isinstance(data, PtpDataReader) and size == None:
+            size = data.remaining()
+        self.size = size
+        self.__offset = 0
+        self.__data = None
+        self.__file = None
+        self.__chunks = None
+        self.__pending = ""
+
+        if isinstance(data, (str, bytearray, buffer, array.array)):
+            self.__data = data
+            if size == None:
+                self.size = len(buffer(data))
+        elif hasattr(data, "read"):
+            self.__file = data
+            if size == None:
+                position = data.tell()
+                data.seek(0, 2)
+                self.size = data.tell() - position
+                data.seek(position)
+        else:
+            chunks = iter(data)
+            if size == None:
+                chunks = list(chunks)
+                self.size = sum([len(chunk) for chunk in chunks])
+                chunks = iter(chunks)
+            self.__chunks = chunks
+
+    def remaining(self):
+        """Returns: The number of bytes not yet read."""
+
+        return self.size - self.__offset
+
+    def read(self, count):
+        """Read the next piece of the data.
+
+        Arguments:
+        count -- Most bytes to read.
+
+        Returns:
+        A string or buffer of count bytes, or fewer at the end of the data."""
+
+        count = min(count, self.remaining())
+        if self.__data != None:
+            piece = buffer(self.__data, self.__offset, count)
+        elif self.__file != None:
+            piece = self.__file.read(count)
+        else:
+            pieces = [self.__pending]
+            have = len(self.__pending)
+            while have < count:
+                try:
+                    chunk = str(self.__chunks.next())
+                except StopIteration:
+                    break
+                pieces.append(chunk)
+                have += len(chunk)
+            piece = "".join(pieces)
+            self.__pending = piece[count:]
+            piece = piece[:count]
+        if len(piece) < count:
+            raise ValueError("Data ended %i bytes short" % (self.remaining() - len(piece)))
+        self.__offset += len(piece)
+        return piece
+
+    def chunks(self, chunk_size):
+        """Generator reading the rest of the data in pieces of chunk_size bytes (the last may be shorter)."""
+
+        while self.remaining() > 0:
+            yield self.read(chunk_size)
+
 
 class PtpAbstractTransport:
     """Class defining an abstract PTP transport."""
+    
+    metrics = None
 
     def __init__(self):
         raise NotImplementedError('Cannot create an instance of PtpAbstractTransport')
 
+    def enable_metrics(self, metrics=None):
+        """Start gathering per-operation statistics into self.metrics.
+        
+        Arguments:
+        metrics -- A PtpTransportMetrics to add to, or None for a new one.
+        
+        Returns:
+        The PtpTransportMetrics."""
+        
+        if self.metrics == None:
+            # wrap this instance's own methods, so every transport gets measured without any changes of its own
+            self.send_ptp_request = self.__timed_send_ptp_request(self.send_ptp_request)
+            self.send_ptp_data = self.__timed_send_ptp_data(self.send_ptp_data)
+            self.get_ptp_data = self.__timed_get_ptp_data(self.get_ptp_data)
+            self.get_ptp_response = self.__timed_get_ptp_response(self.get_ptp_response)
+            self.__waiting = threading.local() # .active while this thread is in wait_ptp_response
+            self.wait_ptp_response = self.__timed_wait_ptp_response(self.wait_ptp_response)
+            self.ptp_simple_transaction = self.__timed_ptp_simple_transaction(self.ptp_simple_transaction)
+        if metrics == None:
+            metrics = PtpTransportMetrics()
+        self.metrics = metrics
+        return metrics
+
+    def __timed_send_ptp_request(self, send_ptp_request):
+        def timed(request):
+            self.metrics.begin(request)
+            return send_ptp_request(request)
+        return timed
+
+    def __timed_send_ptp_data(self, send_ptp_data):
+        def timed(request, data, size=None):
+            # the reader works out the size without using up the data, and goes on to the transport in its place
+            reader = PtpDataReader(data, size)
+            self.metrics.data_out(request, reader.size)
+            return send_ptp_data(request, reader, reader.size)
+        return timed
+
+    def __timed_get_ptp_data(self, get_ptp_data):
+        def timed(request, stream=None):
+            if stream != None:
+                stream = _TimedStream(stream, self.metrics)
+            start = time.time()
+            try:
+                result = get_ptp_data(request, stream)
+            except:
+                self.metrics.retry(time.time() - start)
+                raise
+            if isinstance(result, PtpResponse):
+                self.metrics.end(request)
+            else:
+                self.metrics.data_in(request, result[0], time.time() - start)
+            return result
+        return timed
+
+    def __timed_get_ptp_response(self, get_ptp_response):
+        def timed(request, timeout=None):
+            start = time.time()
+            try:
+                response = get_ptp_response(request, timeout)
+            except PtpTimeoutException:
+                # wait_ptp_response reads with short timeouts until the response turns up, a miss there is
+                # just waiting, not a read which has to be made again
+                if not getattr(self.__waiting, "active", False):
+                    self.metrics.retry(time.time() - start)
+                raise
+            except:
+                self.metrics.retry(time.time() - start)
+                raise
+            self.metrics.end(request)
+            return response
+        return timed
+
+    def __timed_wait_ptp_response(self, wait_ptp_response):
+        def timed(request, timeout, poll_timeout=50, max_poll_timeout=1000):
+            # covers transports which wait without going through their own (measured) get_ptp_response
+            self.__waiting.active = True
+            try:
+                response = wait_ptp_response(request, timeout, poll_timeout, max_poll_timeout)
+            finally:
+                self.__waiting.active = False
+            self.metrics.end(request)
+            return response
+        return timed
+
+    def __timed_ptp_simple_transaction(self, ptp_simple_transaction):
+        def timed(request, tx_data=None, receiving=False):
+            # covers transports whose transaction does not go through their own (measured) methods
+            self.metrics.begin(request)
+            result = ptp_simple_transaction(request, tx_data, receiving)
+            self.metrics.end(request)
+            return result
+        return timed
+
     def NewSession(self):
         """Get a new session id for this transport.
         
@@ -74,12 +484,13 @@ class PtpAbstractTransport:
         
         raise NotImplementedError('send_ptp_request not implemented')
 
-    def send_ptp_data(self, request, data):
-        """Transport specific code to send in-memory data to a PTP device.
+    def send_ptp_data(self, request, data, size=None):
+        """Transport specific code to send data to a PTP device.
         
         Arguments:
         request -- The PtpRequest.
-        data -- String of data to send."""
+        data -- String of data to send, or a file or iterable of strings to stream it from (see PtpDataReader).
+        size -- Number of bytes to send, or None to work it out from data."""
 
         raise NotImplementedError('send_ptp_data not implemented')
 
@@ -97,21 +508,65 @@ class PtpAbstractTransport:
 
         raise NotImplementedError('get_ptp_data not implemented')
 
-    def get_ptp_response(self, request):
+    def get_ptp_response(self, request, timeout=None):
         """Transport specific code to get a PtpResponse from a PTP device.
         
         Arguments:
         request -- The PtpRequest.
+        timeout -- Milliseconds to wait, or None for the transport's default.
         
         Returns:
-        A PtpResponse object."""
+        A PtpResponse object.
+        
+        Raises PtpTimeoutException if the response did not come in time."""
 
         raise NotImplementedError('get_ptp_response not implemented')
+
+    def wait_ptp_response(self, request, timeout, poll_timeout=50, max_poll_timeout=1000):
+        """Wait for a PtpResponse which may be a long time coming, e.g. while a camera runs a script.
+        
+        The response is read with short timeouts, doubling after each miss up to max_poll_timeout, so a
+        miss costs little and the wait as a whole gives up at its deadline rather than a whole read later.
+        
+        Arguments:
+        request -- The PtpRequest.
+        timeout -- Seconds to wait in all.
+        poll_timeout -- Milliseconds to wait on the first read.
+        max_poll_timeout -- Most milliseconds to wait on any one read.
+        
+        Returns:
+        A PtpResponse object.
+        
+        Raises PtpTimeoutException if the response did not come in time."""
+
+        deadline = time.time() + timeout
+        poll = poll_timeout
+        while True:
+            remaining = int((deadline - time.time()) * 1000)
+            if remaining <= 0:
+                raise PtpTimeoutException("No response to opcode 0x%04x (transaction %i) within %.1f s" % (request.opcode, request.transactionid, timeout))
+            try:
+                return self.get_ptp_response(request, min(poll, remaining))
+            except PtpTimeoutException:
+                poll = min(poll * 2, max_poll_timeout)
     
     def check_ptp_event(self, sessionid, timeout=None):
         
         raise NotImplementedError('check_ptp_event not implemented')    
 
+    def drain_ptp_pipes(self, timeout=100):
+        """Throw away anything the device still has to send from transactions which were abandoned part way.
+        
+        Transports which cannot be left holding stale data need not override this.
+        
+        Arguments:
+        timeout -- Milliseconds of quiet after which everything is taken to have been drained.
+        
+        Returns:
+        The number of bytes thrown away."""
+        
+        return 0
+
     def ptp_simple_transaction(self, request, tx_data=None, receiving=False):
         """Perform a simple PTP operation. 
         
@@ -139,3 +594,22 @@ class PtpAbstractTransport:
             response = self.get_ptp_response(request)
 
         return (response, rx_data)
+
+
+class PtpTimeoutException(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return "PtpTimeoutException(%s)" % repr(self.value)
+
+
+class PtpDesyncException(Exception):
+    """Raised when what the device sends does not belong to the transaction in progress, see PtpSession.Resync()."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return "PtpDesyncException(%s)" % repr(self.value)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import PtpValues
+import PtpSession
+from PtpAbstractTransport import PtpTimeoutException, PtpDesyncException
+import time
+
+try:
+    import usb
+    import PtpUsbTransport
+    _usbErrors = (usb.USBError, PtpUsbTransport.UsbException)
+except ImportError:
+    # without pyusb there is no usb transport to fail
+    _usbErrors = ()
+
+
+class PtpChunkedDownload:
+    """Class downloading an object from a PTP device in fixed size chunks using GetPartialObject.
+
+    Progress is checkpointed in self.offset after every chunk, so when a chunk fails only that chunk
+    is fetched again, and a download which gave up can be carried on later by calling run() again.
+    Devices without GetPartialObject fall back to one GetObject, retried as a whole.
+
+    Only failures of the transport, and a device saying it is busy, are retried. Any other answer from
+    the device (a bad handle, access denied, ...) would be the same the next time, so is raised at once."""
+
+    # exceptions which say nothing about the object, so trying again may get it
+    transientErrors = (PtpTimeoutException, PtpDesyncException) + _usbErrors
+    # response codes of a PtpSession.PtpException worth trying again after
+    transientResponses = (PtpValues.StandardResponses.DEVICE_BUSY, )
+
+    def __init__(self, session, objectHandle, stream, objectSize=None, chunkSize=1024*1024, retries=3, retryDelay=0.1,
+                 progressCallback=None, usePartial=True, offset=0):
+        """Create a new PtpChunkedDownload instance.
+
+        Arguments:
+        session -- The PtpSession.
+        objectHandle -- The object to download.
+        stream -- Stream the object is written to, it must be able to seek and truncate to fall back to GetObject.
+        objectSize -- Size of the object in bytes, or None to look it up with GetObjectInfo.
+        chunkSize -- Bytes fetched by each GetPartialObject.
+        retries -- Times a failed chunk is tried again before giving up.
+        retryDelay -- Seconds to wait before trying a failed chunk again.
+        progressCallback -- If set, progressCallback(bytesDone, objectSize) is called after each chunk.
+        usePartial -- Set to False if the device does not support GetPartialObject.
+        offset -- Bytes already downloaded (and written to stream) by an earlier attempt."""
+
+        self.session = session
+        self.objectHandle = objectHandle
+        self.stream = stream
+        self.objectSize = objectSize
+        self.chunkSize = chunkSize
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.progressCallback = progressCallback
+        self.usePartial = usePartial
+        self.offset = offset
+
+    def done(self):
+        return self.objectSize != None and self.offset >= self.objectSize
+
+    def run(self):
+        """Download whatever is left of the object.
+
+        Returns:
+        The size of the object."""
+
+        if self.objectSize == None:
+            self.objectSize = self.__retry(self.session.GetObjectInfo, self.objectHandle).ObjectCompressedSize
+
+        if not self.usePartial:
+            self.__retry(self.__get_whole)
+        while not self.done():
+            count = min(self.chunkSize, self.objectSize - self.offset)
+            (size, data) = self.__retry(self.session.GetPartialObject, self.objectHandle, self.offset, count)
+            if size == 0:
+                raise PtpDownloadException("Device sent no data at offset %i of %i" % (self.offset, self.objectSize))
+            self.stream.write(data)
+            self.offset += size
+            self.__progress()
+        return self.objectSize
+
+    def __get_whole(self):
+        # anything a failed attempt wrote is thrown away
+        self.stream.seek(0)
+        self.stream.truncate()
+        (size, data) = self.session.GetObject(self.objectHandle, self.stream)
+        self.objectSize = size
+        self.offset = size
+        self.__progress()
+
+    def __progress(self):
+        if self.progressCallback != None:
+            self.progressCallback(self.offset, self.objectSize)
+
+    def __retry(self, func, *args):
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except (PtpSession.PtpException, ) + self.transientErrors, e:
+                if isinstance(e, PtpSession.PtpException) and e.responsecode not in self.transientResponses:
+                    raise
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                time.sleep(self.retryDelay)
+
+
+def SupportsPartialObject(deviceInfo):
+    """Returns: True if a device, from its PtpDeviceInfo, can do GetPartialObject."""
+
+    return PtpValues.StandardOperations.GET_PARTIAL_OBJECT in deviceInfo.OperationsSupported
+
+
+class PtpDownloadException(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return "PtpDownloadException(%s)" % repr(self.value)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import PtpThreadedTransport
+import threading
+import collections
+import time
+
+
+class PtpEventPump:
+    """Class running a background thread which keeps reading PtpEvents from a PtpSession into a queue.
+
+    Events arriving on the interrupt endpoint are queued as soon as they turn up, so a caller waiting for
+    a particular event wakes when it arrives rather than at its next poll. Devices which do not report
+    events over the interrupt endpoint (e.g. Nikon) can supply a pollFunc, such as NikonSupport.CheckEvents,
+    which is called every pollInterval seconds. pollFunc uses the bulk pipe while other threads may be using
+    the session, so in that case the session must be on a PtpThreadedTransport, which keeps each of their
+    transactions whole."""
+
+    def __init__(self, session, pollTimeout=250, pollFunc=None, pollInterval=0.5, maxEvents=256):
+        """Create a new PtpEventPump instance (call start() to begin reading events).
+
+        Arguments:
+        session -- The PtpSession to read events from.
+        pollTimeout -- Timeout in milliseconds of each read of the interrupt endpoint.
+        pollFunc -- If set, pollFunc(session) is called periodically and returns a tuple of further PtpEvents.
+        pollInterval -- Seconds between calls of pollFunc.
+        maxEvents -- Events no one has waited for are dropped, oldest first, beyond this many."""
+
+        if pollFunc != None and not isinstance(session.transport, PtpThreadedTransport.PtpThreadedTransport):
+            raise ValueError("pollFunc needs the session on a PtpThreadedTransport, to keep its transactions whole")
+        self.session = session
+        self.pollTimeout = pollTimeout
+        self.pollFunc = pollFunc
+        self.pollInterval = pollInterval
+        self.__events = collections.deque(maxlen=maxEvents)
+        self.__condition = threading.Condition()
+        self.__listeners = []
+        self.__running = False
+        self.__thread = None
+
+    def start(self):
+        """Start the background thread."""
+
+        if self.__thread != None:
+            return
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name="PtpEventPump")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """Stop the background thread, waiting for its current read to finish."""
+
+        self.__running = False
+        if self.__thread != None and threading.current_thread() is not self.__thread:
+            self.__thread.join()
+        self.__thread = None
+
+    def addListener(self, callback):
+        """Call callback(event) for every event as it arrives, on the pump thread, before the event is queued."""
+
+        self.__listeners.append(callback)
+
+    def removeListener(self, callback):
+        self.__listeners.remove(callback)
+
+    def waitForEvent(self, eventcodes=None, timeout=None, match=None):
+        """Wait for an event and remove it from the queue. Queued events which do not match are left alone.
+
+        Arguments:
+        eventcodes -- An event code, or a tuple of event codes, to wait for. None accepts any code.
+        timeout -- Time to wait in seconds, or None to wait forever.
+        match -- If set, match(event) must also return True.
+
+        Returns:
+        The PtpEvent, or None if no matching event arrived in time."""
+
+        if isinstance(eventcodes, int):
+            eventcodes = (eventcodes, )
+        deadline = None
+        if timeout != None:
+            deadline = time.time() + timeout
+
+        self.__condition.acquire()
+        try:
+            while True:
+                for evt in self.__events:
+                    if (eventcodes == None or evt.eventcode in eventcodes) and (match == None or match(evt)):
+                        self.__events.remove(evt)
+                        return evt
+
+                if deadline == None:
+                    # wait in slices, an untimed Condition.wait cannot be interrupted
+                    self.__condition.wait(1.0)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.__condition.wait(remaining)
+        finally:
+            self.__condition.release()
+
+    def getEvents(self):
+        """Remove and return every queued event.
+
+        Returns:
+        A tuple of PtpEvents, oldest first."""
+
+        self.__condition.acquire()
+        try:
+            events = tuple(self.__events)
+            self.__events.clear()
+            return events
+        finally:
+            self.__condition.release()
+
+    def clear(self):
+        """Discard every queued event."""
+
+        self.getEvents()
+
+    def __post(self, events):
+        # listeners first, so whatever a waiter does with an event finds them up to date
+        for evt in events:
+            for callback in list(self.__listeners):
+                callback(evt)
+
+        self.__condition.acquire()
+        try:
+            self.__events.extend(events)
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+
+    def __run(self):
+        nextPoll = time.time()
+        while self.__running:
+            events = ()
+            start = time.time()
+            try:
+                evt = self.session.CheckForEvent(self.pollTimeout)
+                if evt != None:
+                    events += (evt, )
+            except Exception:
+                # timeouts come back as errors from the transport, if it failed early don't spin
+                remaining = (self.pollTimeout / 1000.0) - (time.time() - start)
+                if remaining > 0:
+                    time.sleep(remaining)
+
+            if self.pollFunc != None and time.time() >= nextPoll:
+                try:
+                    events += tuple(self.pollFunc(self.session))
+                except Exception:
+                    pass
+                nextPoll = time.time() + self.pollInterval
+
+            if len(events) > 0:
+                self.__post(events)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import PtpValues
+import PtpThreadedTransport
+import threading
+
+
+class PtpObjectCatalog:
+    """Class keeping a local copy of the object handles on a PTP device and their PtpObjectInfos.
+
+    The handles are all read in one go the first time they are needed (refresh(readInfos=True) reads every
+    PtpObjectInfo along with them), and each PtpObjectInfo not already read the first time it is asked for,
+    after that lookups do not touch the device. Given a PtpEventPump the catalog follows OBJECT_ADDED /
+    OBJECT_REMOVED / OBJECT_INFO_CHANGED events, and starts over after events which can change the whole card
+    (stores coming and going, device resets). If the session's transport is a PtpThreadedTransport, the
+    PtpObjectInfo of each object added is read through its submit() as soon as the event arrives, which runs it
+    between other threads' transactions rather than in the middle of one, so it is ready before anything
+    queued after the event wants it. On any other transport it is read by the first caller to ask for it.
+    Without a pump, or for devices which do not report their own deletions, call remove() / refresh() to keep
+    it in step."""
+
+    # events after which nothing in the catalog can be trusted. STORAGE_INFO_CHANGED is not one of them, most
+    # cameras raise it for every shot as the free space changes
+    resetEvents = (PtpValues.StandardEvents.STORE_ADDED, PtpValues.StandardEvents.STORE_REMOVED,
+                   PtpValues.StandardEvents.DEVICE_RESET)
+
+    def __init__(self, session, eventPump=None):
+        """Create a new PtpObjectCatalog instance.
+
+        Arguments:
+        session -- The PtpSession.
+        eventPump -- If set, a PtpEventPump on session whose events keep the catalog up to date."""
+
+        self.session = session
+        self.eventPump = eventPump
+        self.__lock = threading.RLock()
+        self.__handles = None # set of object handles, or None until they are asked for
+        self.__infos = {} # handle -> PtpObjectInfo, for the objects read so far
+        if eventPump != None:
+            eventPump.addListener(self.__onEvent)
+
+    def close(self):
+        """Stop following events."""
+
+        if self.eventPump != None:
+            self.eventPump.removeListener(self.__onEvent)
+            self.eventPump = None
+
+    def refresh(self, readInfos=False):
+        """Read the object handles from the device again, dropping everything cached.
+
+        Arguments:
+        readInfos -- Also read the PtpObjectInfo of every object now rather than as each is asked for."""
+
+        handles = self.session.GetObjectHandles()
+        infos = {}
+        if readInfos:
+            for handle in handles:
+                infos[handle] = self.session.GetObjectInfo(handle)
+        self.__lock.acquire()
+        try:
+            self.__handles = set(handles)
+            self.__infos = infos
+        finally:
+            self.__lock.release()
+
+    def invalidate(self):
+        """Drop everything cached, it is read again the next time it is needed."""
+
+        self.__lock.acquire()
+        try:
+            self.__handles = None
+            self.__infos = {}
+        finally:
+            self.__lock.release()
+
+    def GetObjectHandles(self, storageId=0xffffffff, objectFormatId=None, associationId=None):
+        """Get the object handles, filtered as PtpSession.GetObjectHandles would be.
+
+        Returns: Tuple of object handles, in ascending order."""
+
+        handles = self.__sortedHandles()
+        if storageId == 0xffffffff and objectFormatId == None and associationId == None:
+            return handles
+        result = ()
+        for handle in handles:
+            info = self.GetObjectInfo(handle)
+            if storageId != 0xffffffff and info.StorageId != storageId:
+                continue
+            if objectFormatId != None and objectFormatId != 0 and info.ObjectFormat != objectFormatId:
+                continue
+            if associationId != None and info.ParentObjectHandle != associationId:
+                continue
+            result += (handle, )
+        return result
+
+    def GetObjectInfo(self, objectHandle):
+        """Get information about an object, from the catalog if it has been read before.
+
+        Returns: A PtpObjectInfo instance."""
+
+        self.__lock.acquire()
+        try:
+            if objectHandle in self.__infos:
+                return self.__infos[objectHandle]
+        finally:
+            self.__lock.release()
+
+        info = self.session.GetObjectInfo(objectHandle)
+        self.add(objectHandle, info)
+        return info
+
+    def GetObjectSize(self, objectHandle):
+        """Returns: The size in bytes of an object."""
+
+        return self.GetObjectInfo(objectHandle).ObjectCompressedSize
+
+    def GetTotalSize(self, storageId=0xffffffff, objectFormatId=None):
+        """Returns: The total size in bytes of the objects on a store (or all stores)."""
+
+        return sum([self.GetObjectSize(handle) for handle in self.GetObjectHandles(storageId, objectFormatId)])
+
+    def add(self, objectHandle, objectInfo=None):
+        """Record an object the device has gained, its PtpObjectInfo is read when first asked for if not given."""
+
+        self.__lock.acquire()
+        try:
+            if self.__handles != None:
+                self.__handles.add(objectHandle)
+            if objectInfo != None:
+                self.__infos[objectHandle] = objectInfo
+        finally:
+            self.__lock.release()
+
+    def remove(self, objectHandle):
+        """Forget an object, e.g. once it has been deleted with PtpSession.DeleteObject."""
+
+        self.__lock.acquire()
+        try:
+            if self.__handles != None:
+                self.__handles.discard(objectHandle)
+            self.__infos.pop(objectHandle, None)
+        finally:
+            self.__lock.release()
+
+    def __sortedHandles(self):
+        self.__lock.acquire()
+        try:
+            if self.__handles != None:
+                return tuple(sorted(self.__handles))
+        finally:
+            self.__lock.release()
+        self.refresh()
+        return self.__sortedHandles()
+
+    def __readAddedInfo(self, objectHandle):
+        # on the worker thread, holding the transport's transaction lock so no other thread's GetObject or
+        # script poll is part way through
+        self.__lock.acquire()
+        try:
+            if objectHandle in self.__infos:
+                return
+        finally:
+            self.__lock.release()
+        try:
+            self.GetObjectInfo(objectHandle)
+        except Exception:
+            # whoever asks for it next reads it again, and gets to see the error
+            pass
+
+    def __onEvent(self, event):
+        # runs on the pump thread, so only bookkeeping here and no transactions
+        if event.eventcode == PtpValues.StandardEvents.OBJECT_ADDED:
+            self.add(event.params[0])
+            # only a PtpThreadedTransport keeps this transaction from landing inside one running on another thread
+            if isinstance(self.session.transport, PtpThreadedTransport.PtpThreadedTransport):
+                self.session.transport.submit(self.__readAddedInfo, event.params[0])
+        elif event.eventcode == PtpValues.StandardEvents.OBJECT_REMOVED:
+            self.remove(event.params[0])
+        elif event.eventcode == PtpValues.StandardEvents.OBJECT_INFO_CHANGED:
+            self.__lock.acquire()
+            try:
+                self.__infos.pop(event.params[0], None)
+            finally:
+                self.__lock.release()
+        elif event.eventcode in self.resetEvents:
+            self.invalidate()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import PtpValues
+import PtpSession
+import threading
+
+
+class PtpPropertyCache:
+    """Class keeping a local copy of the device properties of a PTP device. Once set as a PtpSession's
+    propertyCache, GetDevicePropValue and the Get* property helpers built on it read from the cache.
+
+    refresh() reads the PtpDevicePropertyInfo of every property the device supports in one pass, after
+    that values are served from the cache until the device says they changed. Given a PtpEventPump the
+    cache drops a property on DEVICE_PROP_CHANGED and everything on DEVICE_RESET, Nikon bodies report
+    these through NikonSupport.CheckEvents, so their pump needs that as its pollFunc. Values written with
+    PtpSession.SetDevicePropValue are written through. Without a pump, call invalidate() / refresh() to
+    keep it in step."""
+
+    # events after which nothing in the cache can be trusted
+    resetEvents = (PtpValues.StandardEvents.DEVICE_RESET, )
+
+    def __init__(self, session, eventPump=None):
+        """Create a new PtpPropertyCache instance.
+
+        Arguments:
+        session -- The PtpSession.
+        eventPump -- If set, a PtpEventPump on session whose events keep the cache up to date."""
+
+        self.session = session
+        self.eventPump = eventPump
+        self.__lock = threading.RLock()
+        self.__values = {} # propertyId -> value
+        self.__infos = {} # propertyId -> PtpDevicePropertyInfo
+        self.__generation = 0 # bumped by every invalidation, so reads racing one are not cached
+        if eventPump != None:
+            eventPump.addListener(self.__onEvent)
+
+    def close(self):
+        """Stop following events, and stop being the session's propertyCache."""
+
+        if self.session.propertyCache is self:
+            self.session.propertyCache = None
+        if self.eventPump != None:
+            self.eventPump.removeListener(self.__onEvent)
+            self.eventPump = None
+
+    def refresh(self, deviceInfo=None):
+        """Read every property the device supports again, dropping everything cached. Properties the
+        device will not describe, or of types PtpValues does not know, are left to be read when asked for.
+
+        Arguments:
+        deviceInfo -- The device's PtpDeviceInfo, or None to get it from the device."""
+
+        if deviceInfo == None:
+            deviceInfo = self.session.GetDeviceInfo()
+        self.invalidate()
+        generation = self.__generation
+        infos = {}
+        for propertyId in deviceInfo.DevicePropertiesSupported:
+            try:
+                infos[propertyId] = self.session.GetDevicePropInfo(propertyId)
+            except (PtpSession.PtpException, TypeError):
+                pass
+        self.__lock.acquire()
+        try:
+            if generation == self.__generation:
+                self.__infos = infos
+                self.__values = dict([(propertyId, info.CurrentValue) for (propertyId, info) in infos.items()])
+        finally:
+            self.__lock.release()
+
+    def invalidate(self, propertyId=None):
+        """Drop a property (or with None, everything) cached, it is read again the next time it is needed."""
+
+        self.__lock.acquire()
+        try:
+            self.__generation += 1
+            if propertyId == None:
+                self.__values = {}
+                self.__infos = {}
+            else:
+                self.__values.pop(propertyId, None)
+                self.__infos.pop(propertyId, None)
+        finally:
+            self.__lock.release()
+
+    def GetDevicePropValue(self, propertyId, is_array, fmt):
+        """Get the value of a device property, from the cache if it is there.
+
+        Returns: The value."""
+
+        self.__lock.acquire()
+        try:
+            if propertyId in self.__values:
+                return self.__values[propertyId]
+            generation = self.__generation
+        finally:
+            self.__lock.release()
+
+        value = self.session.ReadDevicePropValue(propertyId, is_array, fmt)
+        self.__store(generation, propertyId, value=value)
+        return value
+
+    def GetDevicePropInfo(self, propertyId):
+        """Get the description of a device property, from the cache if it is there.
+
+        Returns: A PtpDevicePropertyInfo instance, shared with the cache so not to be changed."""
+
+        self.__lock.acquire()
+        try:
+            if propertyId in self.__infos:
+                return self.__infos[propertyId]
+            generation = self.__generation
+        finally:
+            self.__lock.release()
+
+        info = self.session.GetDevicePropInfo(propertyId)
+        self.__store(generation, propertyId, info=info)
+        return info
+
+    def set(self, propertyId, value):
+        """Record a value written to the device, e.g. by PtpSession.SetDevicePropValue."""
+
+        self.__lock.acquire()
+        try:
+            self.__values[propertyId] = value
+            if propertyId in self.__infos:
+                self.__infos[propertyId].CurrentValue = value
+        finally:
+            self.__lock.release()
+
+    def __store(self, generation, propertyId, value=None, info=None):
+        self.__lock.acquire()
+        try:
+            if generation != self.__generation:
+                return
+            if info != None:
+                self.__infos[propertyId] = info
+                value = info.CurrentValue
+            self.__values[propertyId] = value
+        finally:
+            self.__lock.release()
+
+    def __onEvent(self, event):
+        # runs on the pump thread, so only bookkeeping here and no transactions
+        if event.eventcode == PtpValues.StandardEvents.DEVICE_PROP_CHANGED:
+            self.invalidate(event.params[0])
+        elif event.eventcode in self.resetEvents:
+            self.invalidate()
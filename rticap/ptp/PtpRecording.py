@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+import PtpAbstractTransport
+import struct
+import threading
+import time
+
+try:
+    import usb
+    import PtpUsbTransport
+    _usbErrors = (usb.USBError, PtpUsbTransport.UsbException)
+except ImportError:
+    # without pyusb there is no usb transport to fail
+    _usbErrors = ()
+
+
+# Log layout: LOG_MAGIC, then records of RECORD_HEADER (kind, bulk index, seconds, body length) followed by the body.
+#
+# Bulk records (everything but events) are kept in order, their seconds is how long the call took.
+# Events are timed against the bulk traffic instead, as the polling that found them is not reproducible:
+# bulk index is how many bulk records had been logged when the event turned up, seconds how long after the last one.
+LOG_MAGIC = "PTPREC\x01\n"
+RECORD_HEADER = struct.Struct("<BIdI")
+
+RECORD_REQUEST = 1
+RECORD_DATA_OUT = 2
+RECORD_DATA_IN = 3
+RECORD_RESPONSE = 4
+RECORD_EVENT = 5
+RECORD_ERROR = 6
+
+# A DATA_IN body is the payload size, a flag saying whether the payload follows, then the payload
+DATA_IN_HEADER = struct.Struct("<IB")
+
+# An ERROR body is the name of the exception's class, a NUL, then its value. These are replayed as themselves, so
+# the host takes the same path (Resyncing, download retries, ...) as it did while recording, anything else as a
+# PtpReplayException
+REPLAYED_ERRORS = (PtpAbstractTransport.PtpTimeoutException, PtpAbstractTransport.PtpDesyncException) + _usbErrors
+
+
+def _pack_container(code, sessionid, transactionid, params):
+    return struct.pack("<HIIB%iI" % len(params), code, sessionid, transactionid, len(params), *params)
+
+def _unpack_container(body):
+    (code, sessionid, transactionid, count) = struct.unpack_from("<HIIB", body)
+    params = struct.unpack_from("<%iI" % count, body, 11)
+    return (code, sessionid, transactionid, params)
+
+def _pack_error(e):
+    for cls in REPLAYED_ERRORS:
+        if isinstance(e, cls):
+            if hasattr(e, "value"):
+                return "%s\x00%s" % (cls.__name__, e.value)
+            if getattr(e, "strerror", None) != None:
+                # pyusb 1.x adds the errno to str(e), which the replayed error would add again
+                return "%s\x00%s" % (cls.__name__, e.strerror)
+            return "%s\x00%s" % (cls.__name__, e)
+    return "%s\x00%s" % (e.__class__.__name__, repr(e))
+
+def _unpack_error(body):
+    (name, separator, value) = body.partition("\x00")
+    if separator == "":
+        # logged before the class was, as repr(e)
+        return PtpReplayException("Recorded error: %s" % body)
+    for cls in REPLAYED_ERRORS:
+        if cls.__name__ == name:
+            return cls(value)
+    return PtpReplayException("Recorded error: %s" % value)
+
+
+class _TeeStream:
+    """Passes writes through to a stream, keeping a copy while it stays under a size limit."""
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.size = 0
+        self.chunks = []
+
+    def write(self, data):
+        self.stream.write(data)
+        self.size += len(data)
+        if self.chunks != None:
+            if self.size > self.limit:
+                self.chunks = None
+            else:
+                self.chunks.append(str(data))
+
+
+class PtpRecordingTransport(PtpAbstractTransport.PtpAbstractTransport):
+    """Class defining a PTP transport which logs all traffic through an underlying transport to a file.
+
+    Data phases bigger than maxPayload bytes are logged by size only, and replayed as zeros."""
+
+    def __init__(self, transport, path, maxPayload=64*1024):
+        """Create a new PtpRecordingTransport instance.
+
+        Arguments:
+        transport -- The PtpAbstractTransport to record.
+        path -- File to write the log to.
+        maxPayload -- Largest data phase to log the contents of."""
+
+        self.transport = transport
+        self.maxPayload = maxPayload
+        self.__log = open(path, "wb")
+        self.__log.write(LOG_MAGIC)
+        self.__lock = threading.Lock()
+        self.__bulk_count = 0
+        self.__last_bulk = time.time()
+
+    def __getattr__(self, name):
+        # anything transport specific (e.g. set_bulk_read_size) goes straight through
+        return getattr(self.transport, name)
+
+    def close(self):
+        """Finish writing the log."""
+
+        self.__lock.acquire()
+        try:
+            self.__log.close()
+        finally:
+            self.__lock.release()
+
+    def NewSession(self):
+        return self.transport.NewSession()
+
+    def send_ptp_request(self, request):
+        self.__bulk(RECORD_REQUEST, _pack_container(request.opcode, request.sessionid, request.transactionid, request.params),
+                    self.transport.send_ptp_request, request)
+
+    def send_ptp_data(self, request, data, size=None):
+        reader = PtpAbstractTransport.PtpDataReader(data, size)
+        body = ""
+        if reader.size <= self.maxPayload:
+            # small enough to log, so read it all and send that on
+            body = str(reader.read(reader.size))
+            reader = PtpAbstractTransport.PtpDataReader(body)
+        self.__bulk(RECORD_DATA_OUT, body, self.transport.send_ptp_data, request, reader, reader.size)
+
+    def get_ptp_data(self, request, stream = None):
+        tee = None
+        if stream != None:
+            tee = _TeeStream(stream, self.maxPayload)
+        start = time.time()
+        try:
+            result = self.transport.get_ptp_data(request, tee)
+        except Exception, e:
+            self.__write(RECORD_ERROR, _pack_error(e), time.time() - start, True)
+            raise
+        elapsed = time.time() - start
+
+        if isinstance(result, PtpAbstractTransport.PtpResponse):
+            self.__write(RECORD_RESPONSE, _pack_container(result.respcode, result.sessionid, result.transactionid, result.params), elapsed, True)
+            return result
+
+        (data_size, data) = result
+        if tee != None:
+            payload = None
+            if tee.chunks != None:
+                payload = "".join(tee.chunks)
+        else:
+            payload = data
+            if data_size > self.maxPayload:
+                payload = None
+        if payload == None:
+            body = DATA_IN_HEADER.pack(data_size, 0)
+        else:
+            body = DATA_IN_HEADER.pack(data_size, 1) + payload
+        self.__write(RECORD_DATA_IN, body, elapsed, True)
+        return result
+
+    def get_ptp_response(self, request, timeout=None):
+        start = time.time()
+        try:
+            response = self.transport.get_ptp_response(request, timeout)
+        except Exception, e:
+            # timeouts included, the host may well carry on differently after one
+            self.__write(RECORD_ERROR, _pack_error(e), time.time() - start, True)
+            raise
+        self.__write(RECORD_RESPONSE, _pack_container(response.respcode, response.sessionid, response.transactionid, response.params), time.time() - start, True)
+        return response
+
+    def wait_ptp_response(self, request, timeout, poll_timeout=50, max_poll_timeout=1000):
+        # logged as one record, however many reads it took, as which of them missed comes down to timing
+        start = time.time()
+        try:
+            response = self.transport.wait_ptp_response(request, timeout, poll_timeout, max_poll_timeout)
+        except Exception, e:
+            self.__write(RECORD_ERROR, _pack_error(e), time.time() - start, True)
+            raise
+        self.__write(RECORD_RESPONSE, _pack_container(response.respcode, response.sessionid, response.transactionid, response.params), time.time() - start, True)
+        return response
+
+    def drain_ptp_pipes(self, timeout=100):
+        # what is thrown away was never meant for the host, so is not logged either
+        return self.transport.drain_ptp_pipes(timeout)
+
+    def check_ptp_event(self, sessionid, timeout=None):
+        # timeouts are not worth logging, replay works out its own
+        event = self.transport.check_ptp_event(sessionid, timeout)
+        if event != None:
+            self.__write(RECORD_EVENT, _pack_container(event.eventcode, event.sessionid, event.transactionid, event.params), None, False)
+        return event
+
+    def __bulk(self, kind, body, func, *args):
+        start = time.time()
+        try:
+            func(*args)
+        except Exception, e:
+            self.__write(RECORD_ERROR, _pack_error(e), time.time() - start, True)
+            raise
+        self.__write(kind, body, time.time() - start, True)
+
+    def __write(self, kind, body, elapsed, bulk):
+        self.__lock.acquire()
+        try:
+            now = time.time()
+            if bulk:
+                self.__bulk_count += 1
+                self.__last_bulk = now
+            else:
+                elapsed = now - self.__last_bulk
+            self.__log.write(RECORD_HEADER.pack(kind, self.__bulk_count, elapsed, len(body)))
+            self.__log.write(body)
+        finally:
+            self.__lock.release()
+
+
+class PtpReplayTransport(PtpAbstractTransport.PtpAbstractTransport):
+    """Class defining a PTP transport which plays back a log made by PtpRecordingTransport.
+
+    The host must make the same calls as it did while recording, each gets back what was recorded
+    after the recorded time divided by speed. Set speed to None to replay without any delays."""
+
+    def __init__(self, path, speed=1.0):
+        """Create a new PtpReplayTransport instance.
+
+        Arguments:
+        path -- The log file to replay.
+        speed -- How many times faster than recorded to replay, or None to not wait at all."""
+
+        self.speed = speed
+        self.bulk_read_size = 64 * 1024
+        self.__bulk = []
+        self.__events = []
+        self.__position = 0
+        self.__last_bulk = time.time()
+        self.__condition = threading.Condition()
+
+        log = open(path, "rb")
+        try:
+            if log.read(len(LOG_MAGIC)) != LOG_MAGIC:
+                raise PtpReplayException("%s is not a PTP session log" % path)
+            while True:
+                header = log.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                (kind, bulk_index, seconds, length) = RECORD_HEADER.unpack(header)
+                body = log.read(length)
+                if kind == RECORD_EVENT:
+                    self.__events.append((bulk_index, seconds, body))
+                else:
+                    self.__bulk.append((kind, seconds, body))
+        finally:
+            log.close()
+
+    def set_bulk_read_size(self, size):
+        self.bulk_read_size = size
+
+    def remaining(self):
+        """Returns: The number of bulk records not yet replayed."""
+
+        return len(self.__bulk) - self.__position
+
+    def send_ptp_request(self, request):
+        body = self.__next((RECORD_REQUEST, ))
+        (opcode, sessionid, transactionid, params) = _unpack_container(body)
+        if opcode != request.opcode:
+            raise PtpReplayException("Expected a request for opcode 0x%04x, got 0x%04x" % (opcode, request.opcode))
+
+    def send_ptp_data(self, request, data, size=None):
+        self.__next((RECORD_DATA_OUT, ))
+
+    def get_ptp_data(self, request, stream = None):
+        (kind, body) = self.__next((RECORD_DATA_IN, RECORD_RESPONSE), True)
+        if kind == RECORD_RESPONSE:
+            return self.__response(request, body)
+
+        (data_size, has_payload) = DATA_IN_HEADER.unpack_from(body)
+        if has_payload:
+            payload = body[DATA_IN_HEADER.size:]
+        else:
+            payload = bytearray(data_size)
+        if stream == None:
+            return (data_size, str(payload))
+        for offset in range(0, data_size, self.bulk_read_size):
+            stream.write(buffer(payload, offset, self.bulk_read_size))
+        return (data_size, None)
+
+    def get_ptp_response(self, request, timeout=None):
+        return self.__response(request, self.__next((RECORD_RESPONSE, )))
+
+    def wait_ptp_response(self, request, timeout, poll_timeout=50, max_poll_timeout=1000):
+        # recorded as a whole, see PtpRecordingTransport.wait_ptp_response
+        return self.__response(request, self.__next((RECORD_RESPONSE, )))
+
+    def check_ptp_event(self, sessionid, timeout=None):
+        deadline = None
+        if timeout:
+            deadline = time.time() + timeout / 1000.0
+        self.__condition.acquire()
+        try:
+            while True:
+                if len(self.__events) > 0:
+                    (bulk_index, seconds, body) = self.__events[0]
+                    if self.__position >= bulk_index:
+                        due = self.__last_bulk + self.__scale(seconds)
+                        if time.time() >= due:
+                            self.__events.pop(0)
+                            (code, recorded_sessionid, transactionid, params) = _unpack_container(body)
+                            return PtpAbstractTransport.PtpEvent(code, sessionid, transactionid, params)
+                        wait = due - time.time()
+                    else:
+                        wait = 1.0
+                else:
+                    wait = 1.0
+                if deadline != None:
+                    if time.time() >= deadline:
+                        return None
+                    wait = min(wait, deadline - time.time())
+                self.__condition.wait(max(wait, 0))
+        finally:
+            self.__condition.release()
+
+    def __scale(self, seconds):
+        if self.speed == None:
+            return 0
+        return seconds / self.speed
+
+    def __next(self, kinds, return_kind=False):
+        if self.__position >= len(self.__bulk):
+            raise PtpReplayException("Replay ran past the end of the log")
+        (kind, seconds, body) = self.__bulk[self.__position]
+        if kind == RECORD_ERROR:
+            self.__advance(seconds)
+            raise _unpack_error(body)
+        if kind not in kinds:
+            raise PtpReplayException("Expected record kind %i, log has %i at record %i" % (kinds[0], kind, self.__position))
+        self.__advance(seconds)
+        if return_kind:
+            return (kind, body)
+        return body
+
+    def __advance(self, seconds):
+        delay = self.__scale(seconds)
+        if delay > 0:
+            time.sleep(delay)
+        self.__condition.acquire()
+        try:
+            self.__position += 1
+            self.__last_bulk = time.time()
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+
+    def __response(self, request, body):
+        (code, sessionid, transactionid, params) = _unpack_container(body)
+        # hand back ids matching this run, they need not have started from the same place as the recording
+        return PtpAbstractTransport.PtpResponse(code, request.sessionid, request.transactionid, params)
+
+
+class PtpReplayException(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return "PtpReplayException(%s)" % repr(self.value)
@@ -1,68 +1,102 @@
 # -*- coding: utf-8 -*-
-from PtpAbstractTransport import PtpRequest, PtpResponse
+from PtpAbstractTransport import PtpRequest, PtpResponse, PtpDesyncException
+from PtpThreadedTransport import PtpThreadedTransport
 import PtpValues
 import struct
+import codecs
+import functools
+
+
+class _StructCache(dict):
+    """Compiled struct.Struct objects shared by every unpacker and packer, by format or by (count, format) for
+    repeats, compiled the first time each is looked up so a lookup is a single dict access."""
+
+    def __missing__(self, key):
+        if len(self) >= 512:
+            # repeats are cached by count, so could otherwise grow this without end
+            self.clear()
+        if isinstance(key, tuple):
+            (count, fmt) = key
+            if len(fmt) == 1:
+                compiled = struct.Struct("<%i%s" % (count, fmt))
+            else:
+                compiled = struct.Struct("<" + (fmt * count))
+        else:
+            compiled = struct.Struct(key)
+        self[key] = compiled
+        return compiled
+
+_structs = _StructCache()
+
+_utf_16_le_decode = codecs.utf_16_le_decode
+_UINT32 = _structs["<I"]
 
 
 class PtpUnpacker:
+    """Class reading PTP datasets field by field from a string, with compiled structs unpacking straight
+    from it rather than from slices of it. Anything else supporting the buffer interface is copied into
+    a string first, datasets are small and a string is the quickest to index and slice."""
     
-    def __init__(self, raw):
+    def __init__(self, raw, offset=0):
+        if type(raw) is not str:
+            raw = str(raw)
         self.raw = raw
-        self.offset = 0
-        
-        if struct.pack('<h', 1) == struct.pack('=h', 1):
-            self.endian = "L"
-        else:
-            self.endian = "B"
+        self.offset = offset
 
     def unpack(self, fmt):
-        fmtsize = struct.calcsize(fmt)
-        
-        result = struct.unpack(fmt, self.raw[self.offset:self.offset + fmtsize])
-        self.offset += fmtsize
+        compiled = _structs[fmt]
+        result = compiled.unpack_from(self.raw, self.offset)
+        self.offset += compiled.size
         return result
 
     def unpack_string(self):
-        strLen = ord(self.raw[self.offset])
-        self.offset += 1
-        
-        result = self.raw[self.offset:self.offset + (strLen * 2)].decode('UTF-16-LE')
-        self.offset += strLen * 2
-        if result[-1:] == '\0':
+        offset = self.offset
+        start = offset + 1
+        end = start + (ord(self.raw[offset]) * 2)
+        self.offset = end
+        result = _utf_16_le_decode(self.raw[start:end])[0]
+        if result[-1:] == u'\0':
             result = result[:-1]
         return result
     
     def unpack_array(self, fmt):
-        (arrayCount, ) = struct.unpack("<I", self.raw[self.offset:self.offset + 4])
-        self.offset += 4
+        (arrayCount, ) = _UINT32.unpack_from(self.raw, self.offset)
+        if arrayCount == 0:
+            self.offset += 4
+            return ()
+        compiled = _structs[(arrayCount, fmt)]
+        result = compiled.unpack_from(self.raw, self.offset + 4)
+        self.offset += 4 + compiled.size
+        return result
+
+    def unpack_values(self, fmt, count):
+        """Unpack count repeats of fmt, one after another, in a single call.
         
-        fmtsize = struct.calcsize(fmt)
-        result = struct.unpack("<%i%s" % (arrayCount, fmt), self.raw[self.offset:self.offset + (fmtsize * arrayCount)])
-        self.offset += arrayCount * fmtsize
+        Returns: A flat tuple of every field."""
+        if count == 0:
+            return ()
+        compiled = _structs[(count, fmt)]
+        result = compiled.unpack_from(self.raw, self.offset)
+        self.offset += compiled.size
         return result
-    
-    def convert_endian(self, bytes):
-        if self.endian == "L":
-            return bytes[::-1]
-        else:
-            return bytes
 
-    def decode_uint128(self, bytes):
-        return reduce(lambda acc,v: (acc << 8) | (v & 0xff), self.convert_endian(bytes))
+    def unpack_uint128(self):
+        (low, high) = self.unpack("<QQ")
+        return (high << 64) | low
 
-    def decode_int128(self, bytes):
-        tmp = reduce(lambda acc,v: (acc << 8) | (v & 0xff), self.convert_endian(bytes))
-        if tmp & 2**127:
-            tmp = -(((~tmp)+1) & ((2**128)-1))
-        return tmp
+    def unpack_int128(self):
+        value = self.unpack_uint128()
+        if value & (1 << 127):
+            value -= 1 << 128
+        return value
 
     def unpack_simpletype(self, is_array, fmt):
         if not is_array:
             if fmt == "_INT128":
-                return self.decode_int128(self.unpack_array("16B"))
+                return self.unpack_int128()
             
             elif fmt == "_UINT128":
-                return self.decode_uint128(self.unpack_array("16B"))
+                return self.unpack_uint128()
 
             elif fmt == "_STR":
                 return self.unpack_string()
@@ -71,71 +105,91 @@ class PtpUnpacker:
                 return self.unpack("<" + fmt)[0]
             
         else:
-            if fmt == "_INT128":
-                tmp = [self.decode_int128(item) for item in self.unpack_array("16B")]
+            (arrayCount, ) = self.unpack("<I")
+            return self.unpack_simpletypes(fmt, arrayCount)
 
-            elif fmt == "_UINT128":
-                tmp = [self.decode_uint128(item) for item in self.unpack_array("16B")]
-                
-            elif fmt == "_STR":
-                (arrayCount, ) = struct.unpack("<I", self.raw[self.offset:self.offset + 4])
-                self.offset += 4
-                
-                result = ()
-                while arrayCount:
-                    result += self.unpack_string()
-                    arrayCount -= 1
-                return result
+    def unpack_simpletypes(self, fmt, count):
+        """Unpack count values of a (non array) simple type, one after another.
+        
+        Returns: A tuple of the values."""
+        
+        if fmt == "_INT128":
+            return tuple([self.unpack_int128() for i in xrange(count)])
+
+        elif fmt == "_UINT128":
+            return tuple([self.unpack_uint128() for i in xrange(count)])
             
-            else:
-                return self.unpack_array(fmt)
+        elif fmt == "_STR":
+            return tuple([self.unpack_string() for i in xrange(count)])
+        
+        else:
+            return self.unpack_values(fmt, count)
 
 
 class PtpPacker:
+    """Class building PTP datasets field by field in a bytearray, which grows as needed and is packed
+    into in place, so the dataset is never joined up from strings. data() hands it out without a copy."""
     
-    def __init__(self):
-        self.raw = ""
+    def __init__(self, size=256):
+        self.buffer = bytearray(size)
+        self.offset = 0
+
+    def data(self):
+        """Returns: A read only buffer of what has been packed so far, sharing memory with self.buffer."""
         
-        if struct.pack('<h', 1) == struct.pack('=h', 1):
-            self.endian = "L"
-        else:
-            self.endian = "B"
+        return buffer(self.buffer, 0, self.offset)
 
     def pack(self, fmt, *params):
-        self.raw += struct.pack(fmt, *params)
+        self.__pack_into(_structs[fmt], params)
+
+    def pack_values(self, fmt, values):
+        """Pack a flat sequence of fields, fmt repeated as often as it takes, in a single call."""
+        
+        count = len(values) / len(fmt)
+        if count == 0:
+            return
+        self.__pack_into(_structs[(count, fmt)], values)
+
+    def pack_bytes(self, data):
+        """Copy a string (or anything else supporting the buffer interface) in as it is."""
+        
+        data = buffer(data)
+        self.__reserve(len(data))
+        self.buffer[self.offset:self.offset + len(data)] = data
+        self.offset += len(data)
 
     def pack_string(self, string):
-        self.raw += struct.pack("<B", len(string) + 1)
-        self.raw += string.encode('UTF-16-LE')
-        self.raw += u'\u0000'
+        if len(string) == 0:
+            # the empty string has no terminator either
+            self.pack("<B", 0)
+            return
+        encoded = (string + u'\0').encode('UTF-16-LE')
+        if len(encoded) > 255 * 2:
+            raise ValueError("PTP strings are at most 255 characters, including the terminator")
+        self.pack("<B", len(encoded) / 2)
+        self.pack_bytes(encoded)
     
     def pack_array(self, fmt, data):
-        self.raw += struct.pack("<I", len(data))
-        self.raw += struct.pack("<%i%s" % (len(data), fmt), data)
-    
-    def convert_endian(self, bytes):
-        if self.endian == "L":
-            return bytes[::-1]
-        else:
-            return bytes
+        self.pack("<I", len(data))
+        self.pack_values(fmt, data)
 
-    def encode_uint128(self, value):
-        tmp = ""
-        for i in range(0, 16):
-            tmp += chr(value & 0xff)
-            value >>= 8
-        return self.convert_endian(tmp)
+    def pack_uint128(self, value):
+        if value < 0 or value >> 128:
+            raise struct.error("UINT128 out of range: %r" % value)
+        self.pack("<QQ", value & 0xffffffffffffffff, value >> 64)
 
-    def encode_int128(self, value):
-        return self.encode_uint128(self, value)
+    def pack_int128(self, value):
+        if value < -(1 << 127) or value >= (1 << 127):
+            raise struct.error("INT128 out of range: %r" % value)
+        self.pack_uint128(value & ((1 << 128) - 1))
 
     def pack_simpletype(self, is_array, fmt, value):
         if not is_array:
             if fmt == "_INT128":
-                raw += self.encode_int128(value)
+                self.pack_int128(value)
             
             elif fmt == "_UINT128":
-                raw += self.encode_uint128(value)
+                self.pack_uint128(value)
 
             elif fmt == "_STR":
                 self.pack_string(value)
@@ -144,20 +198,37 @@ class PtpPacker:
                 self.pack("<" + fmt, value)
             
         else:
-            if fmt == "_INT128":
-                self.pack_array("16B", [self.encode_int128(item) for item in value])
+            self.pack("<I", len(value))
+            self.pack_simpletypes(fmt, value)
 
-            elif fmt == "_UINT128":
-                self.pack_array("16B", [self.encode_uint128(item) for item in value])
+    def pack_simpletypes(self, fmt, values):
+        """Pack (non array) simple type values one after another, without a count."""
+        
+        if fmt == "_INT128":
+            for item in values:
+                self.pack_int128(item)
 
-            elif fmt == "_STR":
-                self.pack("<I", len(value))
-                for str in value:
-                    self.pack_string(str)
+        elif fmt == "_UINT128":
+            for item in values:
+                self.pack_uint128(item)
 
-            else:
-                return self.pack_array(fmt, value)
+        elif fmt == "_STR":
+            for item in values:
+                self.pack_string(item)
+
+        else:
+            self.pack_values(fmt, values)
+
+    def __reserve(self, count):
+        needed = self.offset + count
+        if needed > len(self.buffer):
+            # at least double, so packing n fields copies O(n) bytes in all
+            self.buffer.extend(bytearray(max(needed, 2 * len(self.buffer)) - len(self.buffer)))
 
+    def __pack_into(self, compiled, values):
+        self.__reserve(compiled.size)
+        compiled.pack_into(self.buffer, self.offset, *values)
+        self.offset += compiled.size
 
 
 class PtpDeviceInfo:
@@ -226,19 +297,39 @@ class PtpDevicePropertyInfo:
             self.StepSize = unpacker.unpack_simpletype(is_array, fmt)
         elif form == 2:
             (count, ) = unpacker.unpack("<H")
-            self.Enumeration = ()
-            while count:
-                tmp = unpacker.unpack_simpletype(is_array, fmt)
-                self.Enumeration += (tmp, )
-                count-=1
+            if is_array:
+                self.Enumeration = tuple([unpacker.unpack_simpletype(is_array, fmt) for i in xrange(count)])
+            else:
+                self.Enumeration = unpacker.unpack_simpletypes(fmt, count)
  
 
+def Resyncing(retry):
+    """Decorator for operations taking a PtpSession as their first argument. If the device turns out to be out
+    of step with the session, the session is resynced and, if retry is set, the operation run once more.
+    Operations which change the device, or write to a stream, should not retry as the first try may have got
+    part or all of the way."""
+    
+    def decorate(operation):
+        def resyncing(session, *args, **kwargs):
+            try:
+                return operation(session, *args, **kwargs)
+            except PtpDesyncException:
+                session.Resync()
+                if not retry:
+                    raise
+            return operation(session, *args, **kwargs)
+        return functools.wraps(operation)(resyncing)
+    return decorate
+
+
 class PtpSession:
     "Class implementing a session over an underlying PTP transport"
     
     def __init__(self, transport):
         self.transport = transport
         self.sessionid = 0
+        self.resyncs = 0
+        self.propertyCache = None # if set, a PtpPropertyCache property values are read from
         self.__transactionid = 0
 
     def __del__(self):
@@ -259,6 +350,19 @@ class PtpSession:
             self.__transactionid = 1
         return self.__transactionid
 
+    def Resync(self):
+        """Get back in step with the device after a transaction went wrong part way through, by throwing away
+        whatever the device still has to send. The session carries on with the next transaction id, so
+        anything from the old transactions which turns up late is recognised and skipped.
+        
+        Returns: The number of bytes thrown away."""
+        
+        discarded = self.transport.drain_ptp_pipes()
+        self.resyncs += 1
+        if self.transport.metrics != None:
+            self.transport.metrics.resync(discarded)
+        return discarded
+
     def CheckForEvent(self, timeout=None):
         """Check if the device has sent an event.
         
@@ -288,6 +392,7 @@ class PtpSession:
         if ptp_response.respcode != PtpValues.StandardResponses.OK:
             raise PtpException(ptp_response.respcode)
 
+    @Resyncing(retry=True)
     def GetDeviceInfo(self):
         """Get Device info from a PTP device.
         
@@ -299,6 +404,7 @@ class PtpSession:
             raise PtpException(ptp_response.respcode)
         return PtpDeviceInfo(rx[1])
 
+    @Resyncing(retry=True)
     def GetStorageIDs(self):
         """Get list of storages a PTP device.
         
@@ -312,6 +418,7 @@ class PtpSession:
         unpacker = PtpUnpacker(rx[1])
         return unpacker.unpack_array("I")
     
+    @Resyncing(retry=True)
     def GetStorageInfo(self, storageId):
         """Get information about a storage on a PTP device.
         
@@ -323,6 +430,7 @@ class PtpSession:
             raise PtpException(ptp_response.respcode)
         return PtpStorageInfo(rx[1])
 
+    @Resyncing(retry=False)
     def FormatStore(self, storageId, fsType=None):
         """Format a store on a PTP device.
         
@@ -338,7 +446,17 @@ class PtpSession:
             raise PtpException(ptp_response.respcode)
 
     def GetDevicePropValue(self, propertyId, is_array, fmt):
-        """Get the value of a device property.
+        """Get the value of a device property, from self.propertyCache if there is one.
+        
+        Returns: The value ."""
+        
+        if self.propertyCache != None:
+            return self.propertyCache.GetDevicePropValue(propertyId, is_array, fmt)
+        return self.ReadDevicePropValue(propertyId, is_array, fmt)
+
+    @Resyncing(retry=True)
+    def ReadDevicePropValue(self, propertyId, is_array, fmt):
+        """Read the value of a device property from the device, whether or not it is cached.
         
         Returns: The value ."""
         
@@ -350,6 +468,7 @@ class PtpSession:
         unpacker = PtpUnpacker(rx[1])
         return unpacker.unpack_simpletype(is_array, fmt)
 
+    @Resyncing(retry=False)
     def SetDevicePropValue(self, propertyId, is_array, fmt, value):
         """Set the value of a device property.
         
@@ -359,10 +478,13 @@ class PtpSession:
         packer.pack_simpletype(is_array, fmt, value)
 
         ptp_request = PtpRequest(PtpValues.StandardOperations.SET_DEVICE_PROP_VALUE, self.sessionid, self.NewTransaction(), (propertyId,))
-        (ptp_response, rx) = self.transport.ptp_simple_transaction(ptp_request, tx_data = packer.raw)
+        (ptp_response, rx) = self.transport.ptp_simple_transaction(ptp_request, tx_data = packer.data())
         if ptp_response.respcode != PtpValues.StandardResponses.OK:
             raise PtpException(ptp_response.respcode)
+        if self.propertyCache != None:
+            self.propertyCache.set(propertyId, value)
 
+    @Resyncing(retry=True)
     def GetDevicePropInfo(self, propertyId):
         """Get the description of a device property.
         
@@ -374,6 +496,7 @@ class PtpSession:
             raise PtpException(ptp_response.respcode)
         return PtpDevicePropertyInfo(rx[1])
     
+    @Resyncing(retry=True)
     def GetNumObjects(self, storageId=0xffffffff, objectFormatId=None, associationId=None):
         """Get the number of objects.
         
@@ -393,6 +516,7 @@ class PtpSession:
             raise PtpException(ptp_response.respcode)
         return ptp_response.params[0]
 
+    @Resyncing(retry=True)
     def GetObjectHandles(self, storageId=0xffffffff, objectFormatId=None, associationId=None):
         """Get the object handles.
         
@@ -414,6 +538,7 @@ class PtpSession:
         unpacker = PtpUnpacker(rx[1])
         return unpacker.unpack_array("I")
 
+    @Resyncing(retry=True)
     def GetObjectInfo(self, objectHandle):
         """Get information about an object on a PTP device.
         
@@ -425,6 +550,7 @@ class PtpSession:
             raise PtpException(ptp_response.respcode)
         return PtpObjectInfo(rx[1])
     
+    @Resyncing(retry=False)
     def GetObject(self, objectHandle, stream=None):
         """Get an object on a PTP device.
         
@@ -438,6 +564,7 @@ class PtpSession:
             raise PtpException(ptp_response.respcode)
         return rx_data
     
+    @Resyncing(retry=False)
     def GetThumb(self, objectHandle, stream=None):
         """Get a thumbnail on a PTP device.
         
@@ -451,6 +578,7 @@ class PtpSession:
             raise PtpException(ptp_response.respcode)
         return rx_data
 
+    @Resyncing(retry=False)
     def GetPartialObject(self, objectHandle, offset=0, count=0xffffffff, stream=None):
         """Get a partial object on a PTP device.
         
@@ -464,6 +592,7 @@ class PtpSession:
             raise PtpException(ptp_response.respcode)
         return rx_data
 
+    @Resyncing(retry=False)
     def DeleteObject(self, objectHandle, objectFormatId=None):
         """Delete an object from a PTP device.
         
@@ -478,6 +607,24 @@ class PtpSession:
         if ptp_response.respcode != PtpValues.StandardResponses.OK:
             raise PtpException(ptp_response.respcode)
 
+    @Resyncing(retry=False)
+    def SendObject(self, data, size=None):
+        """Send the object announced by the preceding SendObjectInfo to a PTP device.
+        
+        Arguments:
+        data -- String of the object, or a file or iterable of strings to stream it from.
+        size -- Size of the object in bytes, or None to work it out from data.
+        
+        Returns:"""
+
+        ptp_request = PtpRequest(PtpValues.StandardOperations.SEND_OBJECT, self.sessionid, self.NewTransaction())
+        self.transport.send_ptp_request(ptp_request)
+        self.transport.send_ptp_data(ptp_request, data, size)
+        ptp_response = self.transport.get_ptp_response(ptp_request)
+        if ptp_response.respcode != PtpValues.StandardResponses.OK:
+            raise PtpException(ptp_response.respcode)
+
+    @Resyncing(retry=False)
     def InitiateCapture(self, storageId=None, objectFormatId=None):
         """Trigger an image capture.
         
@@ -509,7 +656,7 @@ class PtpSession:
         return self.GetDevicePropValue(PtpValues.StandardProperties.COMPRESSION_SETTING, False, "B")
 
     def SetCompressionSetting(self, value):
-        return self.GetDevicePropValue(PtpValues.StandardProperties.COMPRESSION_SETTING, False, "B", value)
+        return self.SetDevicePropValue(PtpValues.StandardProperties.COMPRESSION_SETTING, False, "B", value)
 
     def GetWhiteBalance(self):
         return self.GetDevicePropValue(PtpValues.StandardProperties.WHITE_BALANCE, False, "H")
@@ -588,6 +735,60 @@ class PtpSession:
 
 
 
+class AsyncPtpSession:
+    "Class running PtpSession operations on the worker thread of a PtpThreadedTransport, each returning a PtpFuture"
+
+    def __init__(self, transport):
+        """Arguments:
+        transport -- A PtpThreadedTransport, or any other transport which will be wrapped in one."""
+
+        if not isinstance(transport, PtpThreadedTransport):
+            transport = PtpThreadedTransport(transport)
+        self.transport = transport
+        self.session = PtpSession(transport)
+
+    def Call(self, func, *args, **kwargs):
+        """Queue func(session, *args, **kwargs) on the worker thread, where session is the underlying PtpSession.
+
+        Returns: A PtpFuture for the result."""
+
+        return self.transport.submit(func, self.session, *args, **kwargs)
+
+    def OpenSession(self):
+        return self.transport.submit(self.session.OpenSession)
+
+    def CloseSession(self):
+        return self.transport.submit(self.session.CloseSession)
+
+    def GetDeviceInfo(self):
+        return self.transport.submit(self.session.GetDeviceInfo)
+
+    def GetObjectHandles(self, storageId=0xffffffff, objectFormatId=None, associationId=None):
+        return self.transport.submit(self.session.GetObjectHandles, storageId, objectFormatId, associationId)
+
+    def GetObjectInfo(self, objectHandle):
+        return self.transport.submit(self.session.GetObjectInfo, objectHandle)
+
+    def GetObject(self, objectHandle, stream=None):
+        return self.transport.submit(self.session.GetObject, objectHandle, stream)
+
+    def GetThumb(self, objectHandle, stream=None):
+        return self.transport.submit(self.session.GetThumb, objectHandle, stream)
+
+    def GetPartialObject(self, objectHandle, offset=0, count=0xffffffff, stream=None):
+        return self.transport.submit(self.session.GetPartialObject, objectHandle, offset, count, stream)
+
+    def DeleteObject(self, objectHandle, objectFormatId=None):
+        return self.transport.submit(self.session.DeleteObject, objectHandle, objectFormatId)
+
+    def SendObject(self, data, size=None):
+        return self.transport.submit(self.session.SendObject, data, size)
+
+    def CheckForEvent(self, timeout=None):
+        return self.transport.submit(self.session.CheckForEvent, timeout)
+
+
+
 class PtpException(Exception):
 
     def __init__(self, responsecode):
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+import PtpAbstractTransport
+import threading
+import Queue
+import collections
+import sys
+
+
+class PtpFuture:
+    """Class encapsulating the pending result of an operation queued on a PtpThreadedTransport."""
+
+    def __init__(self):
+        self.__finished = threading.Event()
+        self.__lock = threading.Lock()
+        self.__callbacks = []
+        self.__result = None
+        self.__exc_info = None
+
+    def done(self):
+        """Returns: True if the operation has finished (successfully or not)."""
+        return self.__finished.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the operation to finish.
+
+        Arguments:
+        timeout -- Time to wait in seconds, or None to wait forever.
+
+        Returns:
+        The value returned by the operation. If it raised, the same exception is raised here."""
+
+        if not self.__finished.wait(timeout):
+            raise PtpFutureTimeout(timeout)
+        if self.__exc_info != None:
+            raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+        return self.__result
+
+    def exception(self, timeout=None):
+        """Wait for the operation to finish.
+
+        Returns:
+        The exception raised by the operation, or None."""
+
+        if not self.__finished.wait(timeout):
+            raise PtpFutureTimeout(timeout)
+        if self.__exc_info != None:
+            return self.__exc_info[1]
+        return None
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once the operation finishes. The callback runs on the worker thread,
+        or straight away on the calling thread if the operation has already finished."""
+
+        self.__lock.acquire()
+        try:
+            if not self.__finished.is_set():
+                self.__callbacks.append(callback)
+                return
+        finally:
+            self.__lock.release()
+        callback(self)
+
+    def _finish(self, result, exc_info):
+        self.__lock.acquire()
+        try:
+            self.__result = result
+            self.__exc_info = exc_info
+            self.__finished.set()
+            callbacks = self.__callbacks
+            self.__callbacks = []
+        finally:
+            self.__lock.release()
+        for callback in callbacks:
+            callback(self)
+
+
+class PtpThreadedTransport(PtpAbstractTransport.PtpAbstractTransport):
+    """Class defining a PTP transport which runs all I/O of an underlying transport on one dedicated worker thread.
+
+    The usual transport methods block the caller until the worker has carried them out, so a PtpSession works
+    on top of it unchanged. submit() queues any operation and returns a PtpFuture straight away instead.
+
+    Transactions are kept whole: once a thread has sent a request, no other thread's transaction (nor any operation
+    queued through submit()) runs until its response has been read or the transaction has failed, so nothing can
+    get between a request and its data or response."""
+
+    # queued by a thread finishing a transaction, so the worker looks again at the operations held back by it
+    __RESUME = object()
+
+    def __init__(self, transport):
+        """Create a new PtpThreadedTransport instance.
+
+        Arguments:
+        transport -- The PtpAbstractTransport to do the I/O with."""
+
+        self.transport = transport
+        self.__queue = Queue.Queue()
+        # held from a request going out until the end of its transaction, by the thread which sent it, or by
+        # the worker while it runs an operation queued through submit()
+        self.__transaction = threading.Lock()
+        self.__owner = None # calling thread holding __transaction
+        self.__worker = threading.Thread(target=self.__run, name="PtpThreadedTransport")
+        self.__worker.daemon = True
+        self.__worker.start()
+
+    def __getattr__(self, name):
+        # anything transport specific (e.g. set_bulk_read_size) goes straight through
+        return getattr(self.transport, name)
+
+    def close(self):
+        """Stop the worker thread once every operation already queued has run."""
+
+        self.__queue.put(None)
+        if threading.current_thread() is not self.__worker:
+            self.__worker.join()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) to run on the worker thread.
+
+        Returns:
+        A PtpFuture for its result."""
+
+        return self.__submit(True, func, args, kwargs)
+
+    def __submit(self, whole, func, args, kwargs):
+        future = PtpFuture()
+        self.__queue.put((future, func, args, kwargs, whole))
+        return future
+
+    def enable_metrics(self, metrics=None):
+        # measured on the transport doing the I/O, so its own read retries are counted too
+        self.metrics = self.transport.enable_metrics(metrics)
+        return self.metrics
+
+    def NewSession(self):
+        return self.transport.NewSession()
+
+    def send_ptp_request(self, request):
+        return self.__call(False, self.transport.send_ptp_request, request)
+
+    def send_ptp_data(self, request, data, size=None):
+        return self.__call(False, self.transport.send_ptp_data, request, data, size)
+
+    def get_ptp_data(self, request, stream = None):
+        result = self.__call(False, self.transport.get_ptp_data, request, stream)
+        if isinstance(result, PtpAbstractTransport.PtpResponse):
+            # the response came in place of any data, which ends the transaction
+            self.__end()
+        return result
+
+    def get_ptp_response(self, request, timeout=None):
+        return self.__call(True, self.transport.get_ptp_response, request, timeout)
+
+    def wait_ptp_response(self, request, timeout, poll_timeout=50, max_poll_timeout=1000):
+        # one operation for the whole wait, rather than one per read
+        return self.__call(True, self.transport.wait_ptp_response, request, timeout, poll_timeout, max_poll_timeout)
+
+    def drain_ptp_pipes(self, timeout=100):
+        return self.__call(True, self.transport.drain_ptp_pipes, timeout)
+
+    def check_ptp_event(self, sessionid, timeout=None):
+        # events come in on their own endpoint, so waiting for one need not hold up the worker
+        return self.transport.check_ptp_event(sessionid, timeout)
+
+    def ptp_simple_transaction(self, request, tx_data=None, receiving=False):
+        # run the whole transaction as one operation so nothing else can be interleaved with it
+        return self.__call(True, self.transport.ptp_simple_transaction, request, tx_data, receiving)
+
+    def __call(self, last, func, *args):
+        # operations queued through submit() call back in here from the worker, which must not wait on itself,
+        # and already holds the transaction lock
+        if threading.current_thread() is self.__worker:
+            return func(*args)
+        self.__begin()
+        try:
+            result = self.__submit(False, func, args, {}).result()
+        except:
+            # a transaction which failed part way is over, whatever it left behind is for Resyncing to deal with
+            self.__end()
+            raise
+        if last:
+            self.__end()
+        return result
+
+    def __begin(self):
+        if self.__owner is not threading.current_thread():
+            self.__transaction.acquire()
+            self.__owner = threading.current_thread()
+
+    def __end(self):
+        if self.__owner is threading.current_thread():
+            self.__owner = None
+            self.__transaction.release()
+            self.__queue.put(self.__RESUME)
+
+    def __run(self):
+        held = collections.deque() # operations queued through submit() while another thread's transaction was open
+        closing = False
+        while not closing or len(held) > 0:
+            item = self.__queue.get()
+            if item == None:
+                closing = True
+            elif item is not self.__RESUME:
+                if item[4]:
+                    held.append(item)
+                else:
+                    # a step of the transaction holding the lock
+                    self.__execute(item)
+            while len(held) > 0 and self.__transaction.acquire(False):
+                try:
+                    self.__execute(held.popleft())
+                finally:
+                    self.__transaction.release()
+
+    def __execute(self, item):
+        (future, func, args, kwargs, whole) = item
+        try:
+            result = func(*args, **kwargs)
+        except:
+            future._finish(None, sys.exc_info())
+        else:
+            future._finish(result, None)
+
+
+class PtpFutureTimeout(Exception):
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def __str__(self):
+        return "PtpFutureTimeout(%s)" % repr(self.timeout)
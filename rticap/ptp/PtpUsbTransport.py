@@ -2,6 +2,8 @@
 import PtpAbstractTransport
 import usb
 import struct
+import array
+import time
 
 import encodings.utf_8
 
@@ -14,6 +16,9 @@ class PtpUsbTransport(PtpAbstractTransport.PtpAbstractTransport):
     PTP_USB_CONTAINER_DATA                  = 2
     PTP_USB_CONTAINER_RESPONSE              = 3
     PTP_USB_CONTAINER_EVENT                 = 4
+    
+    DEFAULT_BULK_READ_SIZE                  = 64 * 1024
+    DEFAULT_BULK_WRITE_SIZE                 = 64 * 1024
 
     def __init__(self, device):
         """Create a new PtpUsbTransport instance.
@@ -31,12 +36,16 @@ class PtpUsbTransport(PtpAbstractTransport.PtpAbstractTransport):
         self.__bulkin = None
         self.__bulkout = None
         self.__irqin = None
+        self.__bulkin_packet_size = 512
+        self.__bulkout_packet_size = 512
         for ep in device.configurations[0].interfaces[0][0].endpoints:
             if ep.type == usb.ENDPOINT_TYPE_BULK:
                 if (ep.address & usb.ENDPOINT_DIR_MASK) == usb.ENDPOINT_IN:
                     self.__bulkin = ep.address
+                    self.__bulkin_packet_size = ep.maxPacketSize
                 elif (ep.address & usb.ENDPOINT_DIR_MASK) == usb.ENDPOINT_OUT:
                     self.__bulkout = ep.address
+                    self.__bulkout_packet_size = ep.maxPacketSize
             elif ep.type == usb.ENDPOINT_TYPE_INTERRUPT:
                 self.__irqin = ep.address
                 
@@ -50,6 +59,8 @@ class PtpUsbTransport(PtpAbstractTransport.PtpAbstractTransport):
         self.__usb_handle.claimInterface(device.configurations[0].interfaces[0][0])
         self.usb_read_timeout = 5000
         self.usb_write_timeout = 5000
+        self.set_bulk_read_size(self.DEFAULT_BULK_READ_SIZE)
+        self.set_bulk_write_size(self.DEFAULT_BULK_WRITE_SIZE)
 
         
     def __del__(self):
@@ -62,6 +73,28 @@ class PtpUsbTransport(PtpAbstractTransport.PtpAbstractTransport):
             pass
 
     
+    def get_bulk_packet_size(self):
+        """Get the max packet size of the bulk in endpoint."""
+        return self.__bulkin_packet_size
+    
+    def set_bulk_read_size(self, size):
+        """Set the largest single bulk read used while receiving a data phase.
+        
+        Arguments:
+        size -- Size in bytes, rounded up to a whole number of endpoint packets."""
+        
+        packets = max(1, (size + self.__bulkin_packet_size - 1) // self.__bulkin_packet_size)
+        self.bulk_read_size = packets * self.__bulkin_packet_size
+    
+    def set_bulk_write_size(self, size):
+        """Set the largest single bulk write used while sending a data phase.
+        
+        Arguments:
+        size -- Size in bytes, rounded up to a whole number of endpoint packets."""
+        
+        packets = max(1, (size + self.__bulkout_packet_size - 1) // self.__bulkout_packet_size)
+        self.bulk_write_size = packets * self.__bulkout_packet_size
+    
     def send_ptp_request(self, request):
         length = 12 + (len(request.params) * 4)
         buffer = struct.pack("<IHHI", length, self.PTP_USB_CONTAINER_COMMAND, request.opcode, request.transactionid)
@@ -72,82 +105,85 @@ class PtpUsbTransport(PtpAbstractTransport.PtpAbstractTransport):
             raise UsbException(usb.USBError)
 
     
-    def send_ptp_data(self, request, data):
-        buffer = struct.pack("<IHHI", 12 + len(data), self.PTP_USB_CONTAINER_DATA, request.opcode, request.transactionid)
-        #buffer += data
-
-        # NOTE: UNTESTED CODE
-        while len(buffer) > 0:
-            tmp = self.__usb_handle.bulkWrite(self.__bulkout, buffer, self.usb_write_timeout)
-            if tmp == 0:
-                raise UsbException(usb.USBError)
-
-            buffer = buffer[tmp:]
-            
-            
-        while len(data) > 0:
-            tmp = self.__usb_handle.bulkWrite(self.__bulkout, data, self.usb_write_timeout)
-            if tmp == 0:
-                raise UsbException(usb.USBError)
-
-            data = data[tmp:]
-            
+    def send_ptp_data(self, request, data, size=None):
+        reader = PtpAbstractTransport.PtpDataReader(data, size)
+        
+        # Containers too big for the length field say so with 0xffffffff and are ended by a short packet
+        length = 12 + reader.size
+        if length > 0xffffffff:
+            length = 0xffffffff
+        
+        # The header goes out in the same transfer as the start of the payload, and every write after
+        # that is a whole number of packets, so only the last packet of the container can be short
+        pkt = array.array('B', struct.pack("<IHHI", length, self.PTP_USB_CONTAINER_DATA, request.opcode, request.transactionid))
+        pkt.fromstring(reader.read(self.bulk_write_size - 12))
+        self.__usb_bulkwrite(pkt)
+        while reader.remaining() > 0:
+            pkt = array.array('B')
+            pkt.fromstring(reader.read(self.bulk_write_size))
+            self.__usb_bulkwrite(pkt)
+        
+        # A container filling its last packet exactly needs a zero length packet to end it
+        if (12 + reader.size) % self.__bulkout_packet_size == 0:
+            self.__usb_handle.bulkWrite(self.__bulkout, array.array('B'), self.usb_write_timeout)
 
 
     def get_ptp_data(self, request, stream = None):
         # Get the header
-        pkt = self.__usb_bulkread()
-        (data_size, container_type, code, transactionid) = struct.unpack("<IHHI", pkt[0:12])
-        
-        # Make sure transactionid is correct
-        if transactionid != request.transactionid:
-            raise UsbException("Received unexpected PTP USB transactionid")
+        pkt = self.__read_container(request)
+        (data_size, container_type, code, transactionid) = struct.unpack_from("<IHHI", pkt)
         
         # Handle the possibility of receiving a RESPONSE instead of data (e.g. on error condition)
         if container_type == self.PTP_USB_CONTAINER_RESPONSE:
-            return self.__decode_ptp_response(request, pkt)
+            return self.__decode_ptp_response(request, pkt.tostring())
             # FIXME
         elif container_type != self.PTP_USB_CONTAINER_DATA:
-            raise UsbException("Received unexpected PTP USB container type (%i)" % container_type)
+            raise PtpAbstractTransport.PtpDesyncException("Received unexpected PTP USB container type (%i)" % container_type)
         
         # Make sure it is sane (paranoia mode++)
         if code != request.opcode:
-            raise UsbException("Received unexpected PTP USB opcode")
-        if transactionid != request.transactionid:
-            raise UsbException("Received unexpected PTP USB opcode")
+            raise PtpAbstractTransport.PtpDesyncException("Received unexpected PTP USB opcode (0x%04x != 0x%04x)" % (code, request.opcode))
         data_size -= 12
         
         # Deal with the piece of the data body we've already read
         toread = len(pkt) - 12
         if toread > data_size: 
             toread = data_size
-            
-        buffer = None
-        if (stream == None):
-            buffer = pkt[12:12+toread]
+        
+        # The header tells us the full payload size, so preallocate it once and copy
+        # each packet straight into place rather than growing a string per packet
+        payload = None
+        if stream == None:
+            payload = bytearray(data_size)
+            payload[0:toread] = buffer(pkt, 12, toread)
         else:
-            stream.write(pkt[12:12+toread])
+            stream.write(buffer(pkt, 12, toread))
         done = toread
 
-        # Read the rest of the data
+        # Read the rest of the data, never asking for more than is left of this container (rounded
+        # up to whole packets) so a read cannot run on into the response
         while done != data_size:
-            pkt = self.__usb_bulkread()
+            urb_size = data_size - done
+            urb_size += -urb_size % self.__bulkin_packet_size
+            pkt = self.__usb_bulkread_array(min(urb_size, self.bulk_read_size))
 
             toread = len(pkt)
             if toread > (data_size - done):
                 toread = data_size - done
                 
             if stream == None:
-                buffer += pkt[0:toread]
+                payload[done:done + toread] = buffer(pkt, 0, toread)
             else:
-                stream.write(pkt[0:toread])
+                stream.write(buffer(pkt, 0, toread))
             done += toread
 
-        return (data_size, buffer)
+        if payload != None:
+            payload = str(payload)
+        return (data_size, payload)
 
 
-    def get_ptp_response(self, request):
-        return self.__decode_ptp_response(request, self.__usb_bulkread())
+    def get_ptp_response(self, request, timeout=None):
+        return self.__decode_ptp_response(request, self.__read_container(request, timeout).tostring())
     
     def check_ptp_event(self, sessionid, timeout=None):
         if timeout == None:
@@ -171,35 +207,107 @@ class PtpUsbTransport(PtpAbstractTransport.PtpAbstractTransport):
 
         return PtpAbstractTransport.PtpEvent(code, sessionid, transactionid, params)
 
+    def drain_ptp_pipes(self, timeout=100):
+        discarded = 0
+        while True:
+            try:
+                pkt = self.__usb_read(self.__bulkin, self.bulk_read_size, timeout)
+            except PtpAbstractTransport.PtpTimeoutException:
+                return discarded
+            if len(pkt) == 0:
+                return discarded
+            discarded += len(pkt)
+
+    def __is_stale(self, transactionid, current):
+        """Is transactionid from before current, allowing for the ids wrapping around."""
+        return 0 < ((current - transactionid) & 0xffffffff) < 0x80000000
+
+    def __read_container(self, request, timeout=None):
+        """Read the first packet of the next container belonging to request.
+        
+        Containers left behind by earlier transactions (e.g. a response which came after waiting for it had
+        timed out, or the rest of an abandoned download) are read to their end and thrown away."""
+        while True:
+            pkt = self.__usb_bulkread_array(timeout=timeout)
+            if len(pkt) < 12:
+                raise PtpAbstractTransport.PtpDesyncException("Received a %i byte packet where a PTP USB container should start" % len(pkt))
+            (data_size, container_type, code, transactionid) = struct.unpack_from("<IHHI", pkt)
+            if transactionid == request.transactionid:
+                return pkt
+            if not self.__is_stale(transactionid, request.transactionid) or data_size == 0xffffffff or \
+               container_type not in (self.PTP_USB_CONTAINER_DATA, self.PTP_USB_CONTAINER_RESPONSE):
+                raise PtpAbstractTransport.PtpDesyncException("Received unexpected PTP USB transactionid (%i != %i)" % (transactionid, request.transactionid))
+            
+            # Skip the rest of it
+            remaining = data_size - len(pkt)
+            while remaining > 0:
+                urb_size = remaining + (-remaining % self.__bulkin_packet_size)
+                remaining -= len(self.__usb_bulkread_array(min(urb_size, self.bulk_read_size), timeout))
+
     def __decode_ptp_response(self, request, pkt):
         # Read the packet
         (data_size, container_type, code, transactionid) = struct.unpack("<IHHI", pkt[0:12])
 
         # Make sure it is sane (paranoia mode++)
         if data_size > 32:
-            raise UsbException("Received unexpected data size (%i) for PTP response" % data_size)            
+            raise PtpAbstractTransport.PtpDesyncException("Received unexpected data size (%i) for PTP response" % data_size)            
         if container_type != self.PTP_USB_CONTAINER_RESPONSE:
-            raise UsbException("Received unexpected PTP USB container type (%i)" % container_type)
+            raise PtpAbstractTransport.PtpDesyncException("Received unexpected PTP USB container type (%i)" % container_type)
         if transactionid != request.transactionid:
-            raise UsbException("Received unexpected PTP USB transactionid (%i != %i)" % (transactionid, request.transactionid))
+            raise PtpAbstractTransport.PtpDesyncException("Received unexpected PTP USB transactionid (%i != %i)" % (transactionid, request.transactionid))
 
         param_count = (data_size - 12) / 4
         params = struct.unpack("<" + ("I" * param_count), pkt[12: 12 + (4*param_count)])
         return PtpAbstractTransport.PtpResponse(code, request.sessionid, transactionid, params)
     
 
-    def __usb_bulkread(self, urb_size=512, timeout=None, ep=None):
+    def __usb_bulkwrite(self, pkt):
+        """Write all of an array of unsigned bytes, carrying on after short writes."""
+        done = 0
+        while done < len(pkt):
+            if done == 0:
+                tmp = self.__usb_handle.bulkWrite(self.__bulkout, pkt, self.usb_write_timeout)
+            else:
+                tmp = self.__usb_handle.bulkWrite(self.__bulkout, pkt[done:], self.usb_write_timeout)
+            if tmp == 0:
+                raise UsbException(usb.USBError)
+            done += tmp
+
+    def __usb_bulkread(self, urb_size=None, timeout=None, ep=None):
+        return self.__usb_bulkread_array(urb_size, timeout, ep).tostring()
+    
+    def __usb_bulkread_array(self, urb_size=None, timeout=None, ep=None):
+        """Read a packet as an array of unsigned bytes, avoiding any per-byte conversion."""
+        if urb_size == None:
+            urb_size = self.__bulkin_packet_size
         if timeout == None:
             timeout = self.usb_read_timeout
         if ep == None:
             ep = self.__bulkin
 
-        tmp = ''.join([chr(x) for x in self.__usb_handle.bulkRead(ep, urb_size, timeout)])
+        start = time.time()
+        tmp = self.__usb_read(ep, urb_size, timeout)
         if len(tmp) == 0:
             # Retry...
-            tmp = ''.join([chr(x) for x in self.__usb_handle.bulkRead(ep, urb_size, timeout)])
+            if self.metrics != None:
+                self.metrics.retry(time.time() - start)
+            tmp = self.__usb_read(ep, urb_size, timeout)
+        
+        # Older pyusb hands back a tuple of ints, newer versions an array already
+        if not isinstance(tmp, array.array):
+            tmp = array.array('B', tmp)
         return tmp
     
+    def __usb_read(self, ep, urb_size, timeout):
+        try:
+            return self.__usb_handle.bulkRead(ep, urb_size, timeout)
+        except usb.USBError, e:
+            # pyusb 1.x raises USBTimeoutError, older versions a USBError which says so
+            message = str(e).lower()
+            if e.__class__.__name__ == "USBTimeoutError" or "timeout" in message or "timed out" in message:
+                raise PtpAbstractTransport.PtpTimeoutException("No reply from endpoint 0x%02x within %i ms" % (ep, timeout))
+            raise
+
     def __hexdump(self, data):
         print
         for b in data:
@@ -1,8 +1,26 @@
 # -*- coding: utf-8 -*-
-import inspect
 
 
 
+# value -> name indexes of the classes below, built the first time each is looked up in, keyed by (class, match)
+# as a class may be indexed on more than one kind of value
+_indexes = {}
+
+def _Index(cls, match):
+    index = _indexes.get((cls, match))
+    if index == None:
+        index = {}
+        # in name order, so a value with more than one name keeps the first as before
+        for name in sorted(dir(cls)):
+            value = getattr(cls, name)
+            if match(value):
+                index.setdefault(value[0] if type(value) == tuple else value, (name, value))
+        _indexes[(cls, match)] = index
+    return index
+
+def _IsId(value):
+    return type(value) == int
+
 def NameById(vendorId, inst, id):
     # Find the vendor
     if id & 0x8000:
@@ -13,9 +31,10 @@ def NameById(vendorId, inst, id):
     # Try lookup
     result = "%04x" % id
     if inst != None:
-        for op in inspect.getmembers(inst, lambda op: type(op) == int and op == id):
-            result = op[0]
-            break
+        # inst may be one of the classes below or an instance of it
+        found = _Index(getattr(inst, "__class__", inst), _IsId).get(id)
+        if found != None:
+            result = found[0]
 
     return "%s:%s" % (vendor, result)
 
@@ -49,14 +68,13 @@ class SimpleTypes:
 
 
 
+def _IsSimpleType(value):
+    return type(value) == tuple and len(value) == 3
+
 def SimpleTypeDetailsById(typeId):
-    result = None
+    """Returns: A tuple of (name, (typeId, is_array, fmt)), or None for an unknown type."""
     
-    for op in inspect.getmembers(SimpleTypes(), lambda op: type(op) == tuple and len(op) == 3 and op[0] == typeId):
-        result = op
-        break
-    
-    return result
+    return _Index(SimpleTypes, _IsSimpleType).get(typeId)
 
 
 
@@ -82,9 +100,9 @@ def VendorNameById(vendorId):
     result = "UNKNOWN_%04x" % vendorId
 
     # Try and find the code
-    for op in inspect.getmembers(Vendors(), lambda op: type(op) == int and op == vendorId):
-        result = op[0]
-        break
+    found = _Index(Vendors, _IsId).get(vendorId)
+    if found != None:
+        result = found[0]
 
     return result
 
@@ -606,7 +624,7 @@ class StandardAssociationTypes:
 def AssociationTypeNameById(typeId, vendorId=Vendors.STANDARD):
     inst = None
     if (vendorId == Vendors.STANDARD) or not (typeId & 0x8000):
-        inst = StandardFilesystemTypes()
+        inst = StandardAssociationTypes()
         
     return NameById(vendorId, inst, typeId)
 
@@ -1 +1 @@
-__all__ = ["PtpAbstractTransport", "PtpValues", "PtpSession", "PtpUsbTransport" ]
+__all__ = ["PtpAbstractTransport", "PtpValues", "PtpSession", "PtpUsbTransport", "PtpThreadedTransport", "PtpEventPump", "PtpRecording", "PtpDownload", "PtpObjectCatalog", "PtpPropertyCache" ]
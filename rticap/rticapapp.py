@@ -39,12 +39,16 @@ class RTICapModel:
     #######
     
     totalCapCount = 64
+    useRemoteCapture = False # images go straight from the cameras' memory to disk, see CHDKPtpCapture.captureToFile()
+    useBurstSequence = False # each camera shoots the whole sequence from one script, see CHDKPtpCapture.startBurst()
+    greyColorTable = [QtGui.qRgb(i, i, i) for i in range(256)] # for live view images
     
     def __init__(self):
         #self.cam = GCamCapture.GCamCapture()
         #self.cam = CHDKPtp.CHDKPtpCapture()
         #self.domeController = domecontroller.DomeController()
         self.cam = None
+        self.cams = [] # every connected camera, self.cam is the first of them and is used for previews
         self.domeController = None
         
     def connectedAndReady(self):
@@ -54,13 +58,34 @@ class RTICapModel:
             return False
         
     def connectCamera(self):
+        """Connects to every camera found, each gets a worker thread of its own so they can all shoot and download at once"""
+        self.cams = []
         try:
-            self.cam = CHDKPtp.CHDKPtpCapture()
-            self.cam.connect()
-            return True
+            devices = CHDKPtp.CHDKPtpCapture.findCameras()
         except:
+            devices = ()
+        for device in devices:
+            try:
+                cam = CHDKPtp.CHDKPtpCapture()
+                cam.connect(device=device, useWorkerThread=True, useRemoteCapture=self.useRemoteCapture)
+                self.cams.append(cam)
+            except:
+                logging.exception("could not connect to camera " + str(device))
+        if len(self.cams) == 0:
             self.cam = None
             return False
+        self.cam = self.cams[0]
+        return True
+    
+    def getCameras(self):
+        if len(self.cams) == 0 and self.cam != None:
+            return [self.cam]
+        return self.cams
+    
+    def _forAllCameras(self, methodName, *args):
+        """Calls the named method of every camera at once, each on its own worker thread, returns a list of the results"""
+        futures = [cam.inBackground(getattr(cam, methodName), *args) for cam in self.getCameras()]
+        return [future.result() for future in futures]
         
     def connectLighting(self):
         try:
@@ -90,8 +115,7 @@ class RTICapModel:
         #    self.cam.save_from_cam(camfolder, camfilename, "temp.jpg")
         #    self.cam.delete_from_cam(camfolder, camfilename)
         #elif isinstance(self.cam, CHDKPtp.CHDKPtpCapture):
-        self.cam.activateShootingMode()
-        self.cam.disableFlash()
+        self.cam.disableFlash() # switches to shooting mode first if need be
         objectid = self.cam.capture()
         self.cam.downloadAndSaveObject(objectid, "temp.jpg")
         self.cam.deleteObject(objectid)
@@ -101,9 +125,25 @@ class RTICapModel:
         #domeControl.resetSequenceClearLEDs()
         return pixmap
         
-    def doCaptureSequence(self, savePath, downloadAfter=True, autofocus=True, captureUpdateCallback=None, downloadUpdateCallback=None):
+    def getLiveViewImage(self):
+        """Returns a QPixmap of the camera's live view, greyscale and at the size of the camera's screen, quick
+        enough to call several times a second"""
+        (width, height, bytesperline, luma) = self.cam.getLiveViewFrame()
+        data = str(luma)
+        image = QtGui.QImage(data, width, height, bytesperline, QtGui.QImage.Format_Indexed8)
+        image.setColorTable(self.greyColorTable)
+        pixmap = QtGui.QPixmap.fromImage(image)
+        if width > 2 * height:
+            # the viewport of most cameras has half as many rows as it is shown with
+            pixmap = pixmap.scaled(width, height * 2)
+        return pixmap
+        
+    def doCaptureSequence(self, savePath, downloadAfter=True, autofocus=True, captureUpdateCallback=None, downloadUpdateCallback=None,
+                          thumbnailUpdateCallback=None):
         """captureUpdateCallback(capNo, totalCaps)
-        downloadUpdateCallback(capNo, totalCaps, savePath)"""
+        downloadUpdateCallback(capNo, totalCaps, savePath)
+        thumbnailUpdateCallback(capNo, totalCaps, thumbnailData) - if given, the first camera's thumbnail of each shot is
+            fetched and passed as jpeg data straight after the shot, and the shot is left to download in the background"""
         # find path that does not exist
         testno = 0
         pathprefix = os.path.join(savePath, "capture")
@@ -115,6 +155,14 @@ class RTICapModel:
         # we have found one that does not exist
         os.mkdir(cappath)
         
+        # with more than one camera each view gets a directory of its own
+        cams = self.getCameras()
+        campaths = [cappath]
+        if len(cams) > 1:
+            campaths = [os.path.join(cappath, "camera" + str(i + 1)) for i in range(len(cams))]
+            for campath in campaths:
+                os.mkdir(campath)
+        
         #domeControl = domecontroller.DomeController()
         domeControl = self.domeController
         domeControl.resetSequenceClearLEDs()
@@ -123,20 +171,29 @@ class RTICapModel:
         domeControl.activateAllLEDs()
         logging.debug("activateAllLEDs")
         if autofocus:
-            self.cam.unlockAutofocus()
+            self._forAllCameras("unlockAutofocus")
             logging.debug("unlockAutofocus")
-            self.cam.autofocus()
+            self._forAllCameras("autofocus")
             logging.debug("autofocus")
-            self.cam.lockAutofocus()
+            self._forAllCameras("lockAutofocus")
             logging.debug("lockAutofocus")
         domeControl.resetSequenceClearLEDs()
-        self.cam.disableFlash()
+        self._forAllCameras("disableFlash")
         caps = []
+        downloads = [] # queued downloads not yet reported, see _queueDownloads()
         total = self.totalCapCount
-        for capno in range(1,total+1):
+        sequence = range(1,total+1)
+        if self.useBurstSequence and not all([cam.remoteCapture for cam in cams]):
+            shots = self._captureBurst(cams, campaths, total, captureUpdateCallback)
+            if thumbnailUpdateCallback != None:
+                for (capno, cam, objectid, imgpath) in shots[::len(cams)]:
+                    thumbnailUpdateCallback(capno, total, cams[0].inBackground(cams[0].getThumbnail, objectid).result())
+            caps.extend(shots)
+            sequence = () # all shot already
+        for capno in sequence:
             domeControl.nextLED()
-            imgpath = os.path.join(cappath, str(capno) + ".jpg")
-            logging.debug("IMAGEPATH" + str(imgpath))           
+            imgpaths = [os.path.join(campath, str(capno) + ".jpg") for campath in campaths]
+            logging.debug("IMAGEPATH" + str(imgpaths))           
             #if isinstance(self.cam, GCamCapture.GCamCapture):
             #    (camfolder, camfilename) = self.cam.capture()
             #    captureUpdateCallback(capno, total)
@@ -144,15 +201,39 @@ class RTICapModel:
             #    self.cam.delete_from_cam(camfolder, camfilename)
             #    downloadUpdateCallback(capno, total, imgpath)
             #elif isinstance(self.cam, CHDKPtp.CHDKPtpCapture):
-            objectid = self.cam.capture()
+            # every camera shoots under this LED before we move on to the next one
+            if all([cam.remoteCapture for cam in cams]):
+                # each image arrives with its shot, there is nothing on the cards to download
+                futures = [cam.inBackground(cam.captureToFile, imgpath) for (cam, imgpath) in zip(cams, imgpaths)]
+                for future in futures:
+                    future.result()
+                if captureUpdateCallback != None:
+                    captureUpdateCallback(capno, total)
+                if thumbnailUpdateCallback != None:
+                    # the thumbnail in the image's Exif data, decoding the whole image would hold up the sequence
+                    thumbnail = CHDKPtp.readJpegThumbnail(imgpaths[0])
+                    if thumbnail != None:
+                        thumbnailUpdateCallback(capno, total, thumbnail)
+                if downloadUpdateCallback != None:
+                    for imgpath in imgpaths:
+                        downloadUpdateCallback(capno, total, imgpath)
+                continue
+            objectids = self._forAllCameras("capture")
             if captureUpdateCallback != None:
                 captureUpdateCallback(capno, total)
+            shots = [(capno, cam, objectid, imgpath) for (cam, objectid, imgpath) in zip(cams, objectids, imgpaths)]
+            if thumbnailUpdateCallback != None:
+                # fetched before the shot's download is queued so it does not have to wait behind it
+                thumbnail = cams[0].inBackground(cams[0].getThumbnail, objectids[0]).result()
+                thumbnailUpdateCallback(capno, total, thumbnail)
             if downloadAfter:
-                caps.append((objectid, imgpath))
+                caps.extend(shots)
+            elif thumbnailUpdateCallback != None:
+                # the thumbnail stands in for the image, so move on to the next shot while this one downloads
+                downloads.extend(self._queueDownloads(shots))
+                downloads = self._reportDownloads(downloads, total, downloadUpdateCallback, wait=False)
             else:
-                self.cam.downloadAndSaveObject(objectid, imgpath)
-                self.cam.deleteObject(objectid)
-                downloadUpdateCallback(capno, total, imgpath)
+                self._downloadShots(shots, total, downloadUpdateCallback)
             #else:
             #    raise Exception("self.cam is not an instance of a recognised class")
             
@@ -162,18 +243,16 @@ class RTICapModel:
         domeControl.resetSequenceClearLEDs()
         #self.cam.unlockAutofocus()
         
-        if downloadAfter:
-            i = 1
-            for capobjectid, capimgpath in caps:
-                logging.debug("downloading object " + str(capobjectid) + " to " + capimgpath)
-                self.cam.downloadAndSaveObject(capobjectid, capimgpath)
-                self.cam.deleteObject(capobjectid)
-                logging.debug("object " + str(capobjectid) + " download done")
-                downloadUpdateCallback(i, total, capimgpath)
-                i += 1
+        self._reportDownloads(downloads, total, downloadUpdateCallback)
+        if downloadAfter or self.useBurstSequence:
+            self._downloadShots(caps, total, downloadUpdateCallback)
             logging.debug("all downloads done")
             
         logging.debug("capture sequence finished")
+        for cam in cams:
+            metricsReport = cam.getMetricsReport()
+            if metricsReport != None:
+                logging.debug("transport metrics:\n" + metricsReport)
         
         #if baseLPFilePath != None:
         #    logging.debug("generating lp file")
@@ -182,6 +261,53 @@ class RTICapModel:
         #    lpgen.generateLPFile(baseLPFilePath, imagePaths, lpOutputPath)
         #    logging.debug("lp file generated at " + lpOutputPath)
         
+    def _captureBurst(self, cams, campaths, total, captureUpdateCallback=None):
+        """Shoots the whole sequence as a burst on every camera, the host only steps the LEDs between exposures,
+        returns a list of (capNo, cam, objectid, imgpath) for _downloadShots()"""
+        self._forAllCameras("startBurst", total)
+        for capno in range(1,total+1):
+            self.domeController.nextLED()
+            # every camera exposes under this LED before we move on to the next one
+            self._forAllCameras("triggerBurstFrame")
+            self._forAllCameras("waitForBurstExposure")
+            if captureUpdateCallback != None:
+                captureUpdateCallback(capno, total)
+        shots = []
+        for (cam, campath, objectids) in zip(cams, campaths, self._forAllCameras("finishBurst")):
+            shots.extend([(capno, cam, objectid, os.path.join(campath, str(capno) + ".jpg"))
+                          for (capno, objectid) in zip(range(1,total+1), objectids)])
+        # in order of capture number, as the callbacks are made
+        shots.sort(key=lambda shot: shot[0])
+        return shots
+    
+    def _downloadShots(self, shots, total, downloadUpdateCallback=None):
+        """Downloads and deletes each of shots, a list of (capNo, cam, objectid, imgpath). The downloads are queued
+        on each camera's worker thread so different cameras download at the same time, but callbacks are made from
+        this thread in the order of shots."""
+        self._reportDownloads(self._queueDownloads(shots), total, downloadUpdateCallback)
+    
+    def _queueDownloads(self, shots):
+        """Queues the download and deletion of each of shots on its camera's worker thread, returns a list of
+        (capNo, imgpath, future) to pass to _reportDownloads()"""
+        def download(cam, objectid, imgpath):
+            logging.debug("downloading object " + str(objectid) + " to " + imgpath)
+            cam.downloadAndSaveObject(objectid, imgpath)
+            cam.deleteObject(objectid)
+            logging.debug("object " + str(objectid) + " download done")
+        
+        return [(capno, imgpath, cam.inBackground(download, cam, objectid, imgpath)) for (capno, cam, objectid, imgpath) in shots]
+    
+    def _reportDownloads(self, downloads, total, downloadUpdateCallback=None, wait=True):
+        """Makes the callbacks for queued downloads in order, waiting for each to finish. If wait is False it stops
+        at the first download still going instead, returns the downloads not yet reported"""
+        downloads = list(downloads)
+        while len(downloads) > 0 and (wait or downloads[0][2].done()):
+            (capno, imgpath, future) = downloads.pop(0)
+            future.result()
+            if downloadUpdateCallback != None:
+                downloadUpdateCallback(capno, total, imgpath)
+        return downloads
+    
     def getTotalCapCount(self):
         return self.totalCapCount;
     
@@ -193,17 +319,17 @@ class RTICapModel:
     
     def unlockAutofocus(self):
         logging.debug("unlockAutofocus()")
-        self.cam.unlockAutofocus()
+        self._forAllCameras("unlockAutofocus")
         
     def lockAutofocus(self):
         logging.debug("lockAutofocus()")
-        self.cam.lockAutofocus()
+        self._forAllCameras("lockAutofocus")
         
     def autofocus(self):
-        self.cam.unlockAutofocus()
+        self._forAllCameras("unlockAutofocus")
         logging.debug("autofocus()")
-        self.cam.autofocus()  
-        self.cam.lockAutofocus()
+        self._forAllCameras("autofocus")
+        self._forAllCameras("lockAutofocus")
         
 if __name__ == "__main__":
     rticapapp = RTICapApp()
@@ -79,6 +79,10 @@ class Ui_capturePreview(object):
         self.autofocusLockStatusLabel.setAlignment(QtCore.Qt.AlignCenter)
         self.autofocusLockStatusLabel.setObjectName("autofocusLockStatusLabel")
         self.gridLayout_3.addWidget(self.autofocusLockStatusLabel, 2, 0, 1, 1)
+        self.liveViewButton = QtGui.QPushButton(self.groupBox_2)
+        self.liveViewButton.setCheckable(True)
+        self.liveViewButton.setObjectName("liveViewButton")
+        self.gridLayout_3.addWidget(self.liveViewButton, 3, 0, 1, 1)
         self.gridLayout.addWidget(self.groupBox_2, 1, 1, 1, 1)
 
         self.retranslateUi(capturePreview)
@@ -95,4 +99,5 @@ class Ui_capturePreview(object):
         self.lockAutofocusButton.setText(QtGui.QApplication.translate("capturePreview", "Autofocus and Lock", None, QtGui.QApplication.UnicodeUTF8))
         self.unlockAutofocusButton.setText(QtGui.QApplication.translate("capturePreview", "Unlock Focus", None, QtGui.QApplication.UnicodeUTF8))
         self.autofocusLockStatusLabel.setText(QtGui.QApplication.translate("capturePreview", "---", None, QtGui.QApplication.UnicodeUTF8))
+        self.liveViewButton.setText(QtGui.QApplication.translate("capturePreview", "Live View", None, QtGui.QApplication.UnicodeUTF8))
 
@@ -10,6 +10,7 @@ from captureSequence import Ui_CaptureSequence
 from topMenu import Ui_topMenu
 from connect import Ui_connect
 import appconfig
+import logging
 
 class RTICapGUI:
 
@@ -52,6 +53,7 @@ class RTICapGUI:
             self.topMenu.setGUIModeEnabled(self.capConfig, False)
 
 class CapturePreviewGUIMode:
+    liveViewInterval = 100 # milliseconds between live view frames
     
     def __init__(self, rticapmodel):
         self.rticapmodel = rticapmodel
@@ -64,6 +66,10 @@ class CapturePreviewGUIMode:
         self.capturePreviewWidget.setActivateSingleLightIndexChangedCallback(self._activateSingleLightIndexChangedCallback)
         self.capturePreviewWidget.setUnlockAutofocusCallback(self._unlockAutofocusCallback)
         self.capturePreviewWidget.setAutofocusCallback(self._autofocusCallback)
+        self.capturePreviewWidget.setLiveViewCallback(self._liveViewCallback)
+        self.liveViewTimer = QtCore.QTimer()
+        self.liveViewTimer.setInterval(self.liveViewInterval)
+        self.liveViewTimer.timeout.connect(self._updateLiveView)
         self.updateAutofocusStatus()
             
     def getWidget(self):
@@ -73,9 +79,26 @@ class CapturePreviewGUIMode:
         return "Capture Preview"
     
     def doNewPreviewCapture(self):
+        # the full image replaces the live view
+        self.capturePreviewWidget.setLiveViewChecked(False)
         pixmap = self.rticapmodel.getNewPreviewImage()
         self.capturePreviewWidget.setPreviewImage(pixmap)
         
+    def _liveViewCallback(self, checked):
+        if checked:
+            self.liveViewTimer.start()
+        else:
+            self.liveViewTimer.stop()
+    
+    def _updateLiveView(self):
+        try:
+            pixmap = self.rticapmodel.getLiveViewImage()
+        except:
+            logging.exception("live view failed")
+            self.capturePreviewWidget.setLiveViewChecked(False)
+            return
+        self.capturePreviewWidget.setLiveViewImage(pixmap)
+        
     def _activateSingleLightIndexChangedCallback(self):
         """Callback for when the index of the single light combo box is changed so we must activate the light it corresponds to"""
         lightIndex = self.capturePreviewWidget.getSingleLightCurrentIndex()
@@ -99,6 +122,7 @@ class CapturePreviewGUIMode:
 class CaptureConfigGUIMode:
     # TODO: Use event system to notify when eg appConfig changes so all classes can reload it and so update it
     configPath = 'config/CaptureConfig.pkl'
+    showThumbnails = True # show each shot's thumbnail as soon as it is taken rather than each image once it has downloaded
     def __init__(self, rticapmodel, qtapp):
         self.qtapp = qtapp
         self.rticapmodel = rticapmodel
@@ -134,7 +158,14 @@ class CaptureConfigGUIMode:
         self.config.setValue('ImageSavePath', saveDir)
         self.stackedLayout.setCurrentWidget(self.captureSequenceWidget) # switch to capture sequence
         currcapno = 1
-        self.rticapmodel.doCaptureSequence(saveDir, autofocus=autofocus, captureUpdateCallback=self._captureUpdateCallback, downloadUpdateCallback=self._downloadUpdateCallback)
+        thumbnailUpdateCallback = None
+        downloadAfter = True
+        if self.showThumbnails:
+            thumbnailUpdateCallback = self._thumbnailUpdateCallback
+            # the thumbnail stands in for each image, so they download in the background as the sequence goes on
+            downloadAfter = False
+        self.rticapmodel.doCaptureSequence(saveDir, downloadAfter=downloadAfter, autofocus=autofocus, captureUpdateCallback=self._captureUpdateCallback,
+                                           downloadUpdateCallback=self._downloadUpdateCallback, thumbnailUpdateCallback=thumbnailUpdateCallback)
         
         self.stackedLayout.setCurrentWidget(self.captureConfigWidget) # switch back to capture config
 
@@ -145,7 +176,12 @@ class CaptureConfigGUIMode:
     
     def _downloadUpdateCallback(self, capNo, totalCaps, savePath):
         self.captureSequenceWidget.setCaptureSize(totalCaps)
-        self.captureSequenceWidget.setCurrentDownloadNumber(capNo, savePath)
+        self.captureSequenceWidget.setCurrentDownloadNumber(capNo, savePath, showImage=not self.showThumbnails)
+        self.qtapp.processEvents()
+    
+    def _thumbnailUpdateCallback(self, capNo, totalCaps, thumbnailData):
+        self.captureSequenceWidget.setCaptureSize(totalCaps)
+        self.captureSequenceWidget.setCurrentThumbnail(capNo, thumbnailData)
         self.qtapp.processEvents()
 
 class ConnectGUIMode:
@@ -193,6 +229,7 @@ class MainWindow(QtGui.QMainWindow):
         self.ui.topFrame.setLayout(self.topFrameLayout)
         
 class CapturePreviewWidget(QtGui.QWidget):
+    viewScale = 0.35
     def __init__(self, parent=None, lights=[]):
         super(CapturePreviewWidget, self).__init__(parent)
         self.ui = Ui_capturePreview()
@@ -200,7 +237,7 @@ class CapturePreviewWidget(QtGui.QWidget):
         # make and add the graphics scene to siplay the preview image
         self.previewGraphicsScene = QtGui.QGraphicsScene()
         self.ui.previewGraphicsView.setScene(self.previewGraphicsScene)
-        self.ui.previewGraphicsView.scale(0.35, 0.35)
+        self.ui.previewGraphicsView.scale(self.viewScale, self.viewScale)
         if len(lights) > 0:
             self.ui.activateSingleLightComboBox.addItems(lights)
         else:
@@ -219,11 +256,23 @@ class CapturePreviewWidget(QtGui.QWidget):
         self.previewGraphicsScene.addPixmap(pixmap)
         self.previewGraphicsScene.setSceneRect(0,0,pixmap.width(),pixmap.height())
     
+    def setLiveViewImage(self, pixmap):
+        """Shows a live view frame, scaled up to the size a captured image is shown at"""
+        width = int(self.ui.previewGraphicsView.viewport().width() / self.viewScale)
+        self.setPreviewImage(pixmap.scaledToWidth(width, QtCore.Qt.FastTransformation))
+    
     def setCaptureCallback(self, capturecallback):
         ''' sets the callback which will inform the app that a new image is wanted 
         capturecallback should be of form func() '''
         self.ui.newCaptureButton.clicked.connect(capturecallback)
                 
+    def setLiveViewCallback(self, callback):
+        ''' callback should be of form func(checked), called as live view is turned on and off '''
+        self.ui.liveViewButton.toggled.connect(callback)
+        
+    def setLiveViewChecked(self, checked):
+        self.ui.liveViewButton.setChecked(checked)
+        
     def setUnlockAutofocusCallback(self, callback):
         self.ui.unlockAutofocusButton.clicked.connect(callback)
         
@@ -275,13 +324,14 @@ class CaptureConfigWidget(QtGui.QWidget):
         return self.ui.autofocusGroupBox.isChecked()
         
 class CaptureSequenceWidget(QtGui.QWidget):
+    viewScale = 0.35
     def __init__(self, parent=None):
         super(CaptureSequenceWidget, self).__init__(parent)
         self.ui = Ui_CaptureSequence()
         self.ui.setupUi(self)
         self.viewImageScene = QtGui.QGraphicsScene()
         self.ui.viewImageGraphicsView.setScene(self.viewImageScene)
-        self.ui.viewImageGraphicsView.scale(0.35, 0.35)
+        self.ui.viewImageGraphicsView.scale(self.viewScale, self.viewScale)
         
     def setCaptureSize(self, max):
         self.capSize = max
@@ -290,10 +340,18 @@ class CaptureSequenceWidget(QtGui.QWidget):
         dspTxt = "Done capture: " + str(currentNo) + " of " + str(self.capSize)
         self.ui.captureProgressLabel.setText(dspTxt)
         
-    def setCurrentDownloadNumber(self, currentNo, saveFilePath):
+    def setCurrentDownloadNumber(self, currentNo, saveFilePath, showImage=True):
         dspTxt = "\nDownloaded capture " + str(currentNo) + " to: " + saveFilePath
         self.ui.captureProgressLabel.setText(dspTxt)
-        self.setViewImage(QtGui.QPixmap(saveFilePath))
+        if showImage:
+            self.setViewImage(QtGui.QPixmap(saveFilePath))
+    
+    def setCurrentThumbnail(self, currentNo, thumbnailData):
+        """Shows a capture's jpeg thumbnail, scaled up to fill the width of the view"""
+        pixmap = QtGui.QPixmap()
+        pixmap.loadFromData(thumbnailData)
+        width = int(self.ui.viewImageGraphicsView.viewport().width() / self.viewScale)
+        self.setViewImage(pixmap.scaledToWidth(width, QtCore.Qt.SmoothTransformation))
     
     def setDisplayTest(self, text):
         self.ui.captureProgressLabel.setText(text)    